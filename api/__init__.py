@@ -1,8 +1,7 @@
 import os
+import time
 
 from flask import Flask
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
 
 
 def _load_config(app: Flask):
@@ -16,21 +15,74 @@ def _load_config(app: Flask):
         raise ValueError('Invalid FLASK_ENV environment variable!')
     # Loading configuration from config.py depending on FLASK_ENV environment variable (e.g. passed through Docker)
     app.config.from_object(config[flask_env])
+    if not app.config['FIXER_API_KEY']:
+        raise KeyError('No API key for the Fixer API (source of all the currency rates) was given!')
+
+
+def _set_logging(app: Flask):
+    from api.logs import init_logging
+    init_logging(app)
 
 
 def _set_sentry(app: Flask):
     sentry_dsn = app.config['SENTRY_DSN']
     if sentry_dsn:
-        sentry_sdk.init(dsn=sentry_dsn, integrations=[FlaskIntegration()])
+        # Imported only when needed -- Sentry SDK and its integrations are expensive to import
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
+        options = {}
+        if app.config['TRACING_EXPORTER'] == 'sentry':
+            # Enables the performance monitoring in Sentry, but the sampling itself is done by `api.tracing` --
+            # only its (already sampled) transactions are sent
+            options['traces_sample_rate'] = 0.0
+        sentry_sdk.init(dsn=sentry_dsn, integrations=[FlaskIntegration()], **options)
 
 
-def create_app():
-    app = Flask(__name__)
+def _set_tracing(app: Flask):
+    from api.tracing import init_tracing
+    init_tracing(app)
+
+
+def _set_cache(app: Flask):
+    from api.cache import init_cache
+    init_cache(app)
+
+
+def _set_limits(app: Flask):
+    from api.limits import init_limits
+    init_limits(app)
 
-    _load_config(app)
-    _set_sentry(app)
 
+def _register_blueprints(app: Flask):
     from api.views import currency_converter_bp
     app.register_blueprint(currency_converter_bp)
+    if app.config['PROFILING_TOKEN']:
+        from api.profiler import profiler_bp
+        app.register_blueprint(profiler_bp)
+
+
+def _start_refresher(app: Flask):
+    if app.config['RATES_REFRESHER'] and not app.config['SERVER_PRELOAD']:
+        from api.currencies import CurrencyResource
+        CurrencyResource.start_refresher(app)
+
+
+def create_app():
+    app = Flask(__name__)
+
+    # Duration of each step (in seconds) is kept for the startup profile (see `api/startup.py`)
+    profile = {}
+    steps = (
+        _load_config, _set_logging, _set_sentry, _set_tracing, _set_cache, _set_limits, _register_blueprints,
+        _start_refresher
+    )
+    for step in steps:
+        start = time.perf_counter()
+        step(app)
+        profile[step.__name__.lstrip('_')] = time.perf_counter() - start
+    app.extensions['startup_profile'] = profile
+
+    if app.config['STARTUP_PROFILE']:
+        app.logger.info('Startup profile: %s', ', '.join(f'{k}={v * 1000:.2f} ms' for k, v in profile.items()))
 
     return app
@@ -0,0 +1,278 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterator, Optional, Tuple, Type, TypeVar
+from urllib.parse import urlsplit
+
+from flask import Flask, current_app as app
+
+
+T = TypeVar('T')
+# Gets the current value (None if there's none) and returns the new value together with a result for the caller
+Updater = Callable[[Optional[bytes]], Tuple[bytes, T]]
+
+
+class LRUCache:
+    """
+
+    Thread-safe in-process (L1) cache keeping at most `maxsize` least recently used entries.
+
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Without the lock (and without marking the entry as used) -- a cheap check before `get`
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SharedCache:
+    """
+
+    Base of the (L2) stores shared by all the processes of the app, possibly on different nodes. Besides the
+    plain values it provides leases -- locks expiring on their own, so a crashed holder can't block the others.
+
+    The store is only an optimization -- when it's unavailable, the errors are logged and it behaves as empty.
+
+    """
+    # Errors of the underlying store which are logged (and not raised)
+    errors: Tuple[Type[Exception], ...] = ()
+    # Lease token given out when the store is unavailable -- nothing can be coordinated then, so the caller goes
+    # ahead on its own rather than not at all
+    LOCAL_LEASE = 'local'
+
+    def _get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    def _update(self, key: str, updater: Updater, ttl: float) -> T:
+        raise NotImplementedError
+
+    def _acquire_lease(self, name: str, token: str, ttl: float) -> bool:
+        raise NotImplementedError
+
+    def _release_lease(self, name: str, token: str):
+        raise NotImplementedError
+
+    def _log(self, e: Exception):
+        app.logger.warning(f'Shared cache {type(self).__name__} is unavailable: {e}')
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self._get(key)
+        except self.errors as e:
+            self._log(e)
+            return None
+
+    def set(self, key: str, value: bytes, ttl: float):
+        try:
+            self._set(key, value, ttl)
+        except self.errors as e:
+            self._log(e)
+
+    def update(self, key: str, updater: Updater, ttl: float) -> Optional[T]:
+        """
+
+        Atomically replaces the value with the one computed from it -- no other process can change it in between.
+
+        :param key: key of the value
+        :param updater: function computing the new value (see `Updater`); may be called more times
+        :param ttl: the new value expires after this many seconds
+        :return: the result returned by the updater or None if the store is unavailable
+
+        """
+        try:
+            return self._update(key, updater, ttl)
+        except self.errors as e:
+            self._log(e)
+            return None
+
+    def acquire_lease(self, name: str, ttl: float) -> Optional[str]:
+        """
+
+        Acquires the lease if nobody else holds it.
+
+        :param name: name of the lease
+        :param ttl: the lease expires after this many seconds even if it isn't released
+        :return: token for releasing the lease or None if somebody else holds it
+
+        """
+        token = uuid.uuid4().hex
+        try:
+            return token if self._acquire_lease(name, token, ttl) else None
+        except self.errors as e:
+            self._log(e)
+            return self.LOCAL_LEASE
+
+    def release_lease(self, name: str, token: str):
+        if token == self.LOCAL_LEASE:
+            return
+        try:
+            self._release_lease(name, token)
+        except self.errors as e:
+            self._log(e)
+
+
+class SqliteCache(SharedCache):
+    """
+
+    Shared cache in a local SQLite file -- shared by the processes of one node (and used in the tests).
+
+    """
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path: str):
+        self.path = path
+        # SQLite connections can't be shared between threads
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)'
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection, pid = getattr(self._local, 'connection', (None, None))
+        # Neither can they be used in a forked process (e.g. a server worker if the app was created in the master)
+        if connection is None or pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.connection = connection, os.getpid()
+        return connection
+
+    def _get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            'SELECT value FROM entries WHERE key = ? AND expires > ?', (key, time.time())
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def _set(self, key: str, value: bytes, ttl: float):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, value, time.time() + ttl)
+        )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connection()
+        # The write lock is taken right away -- nobody else can change anything until the commit
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _update(self, key: str, updater: Updater, ttl: float) -> T:
+        with self._transaction() as connection:
+            now = time.time()
+            row = connection.execute(
+                'SELECT value FROM entries WHERE key = ? AND expires > ?', (key, now)
+            ).fetchone()
+            value, result = updater(row[0] if row is not None else None)
+            connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, value, now + ttl))
+        return result
+
+    def _acquire_lease(self, name: str, token: str, ttl: float) -> bool:
+        key = f'lease:{name}'
+        with self._transaction() as connection:
+            now = time.time()
+            connection.execute('DELETE FROM entries WHERE key = ? AND expires <= ?', (key, now))
+            return connection.execute(
+                'INSERT OR IGNORE INTO entries VALUES (?, ?, ?)', (key, token.encode(), now + ttl)
+            ).rowcount == 1
+
+    def _release_lease(self, name: str, token: str):
+        self._connection().execute('DELETE FROM entries WHERE key = ? AND value = ?', (f'lease:{name}', token.encode()))
+
+
+class RedisCache(SharedCache):
+    """
+
+    Shared cache in Redis (or any server speaking its protocol) -- shared by all the nodes.
+
+    """
+    # Deletes the lease only if it's still held by the given token (and not already expired and taken by another)
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url: str):
+        # Optional dependency -- needed (and imported) only when Redis is configured
+        import redis
+        self.errors = (redis.RedisError,)
+        self._watch_error = redis.WatchError
+        self._redis = redis.Redis.from_url(url)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return self._redis.get(key)
+
+    def _set(self, key: str, value: bytes, ttl: float):
+        self._redis.set(key, value, px=int(ttl * 1000))
+
+    def _update(self, key: str, updater: Updater, ttl: float) -> T:
+        # Optimistic locking -- the transaction fails (and it's tried again) if the key is changed after the `watch`
+        with self._redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    value, result = updater(pipe.get(key))
+                    pipe.multi()
+                    pipe.set(key, value, px=int(ttl * 1000))
+                    pipe.execute()
+                    return result
+                except self._watch_error:
+                    continue
+
+    def _acquire_lease(self, name: str, token: str, ttl: float) -> bool:
+        return bool(self._redis.set(f'lease:{name}', token, nx=True, px=int(ttl * 1000)))
+
+    def _release_lease(self, name: str, token: str):
+        self._redis.eval(self.RELEASE_SCRIPT, 1, f'lease:{name}', token)
+
+
+BACKENDS = {
+    # `sqlite:///relative/path.db` or `sqlite:////absolute/path.db`
+    'sqlite': lambda url: SqliteCache(url.path[1:]),
+    'redis': lambda url: RedisCache(url.geturl()),
+    'rediss': lambda url: RedisCache(url.geturl()),
+    'unix': lambda url: RedisCache(url.geturl())
+}
+
+
+def init_cache(app: Flask):
+    cache_url = app.config['CACHE_URL']
+    if not cache_url:
+        app.extensions['shared_cache'] = None
+        return
+    url = urlsplit(cache_url)
+    if url.scheme not in BACKENDS:
+        raise ValueError(f'Invalid CACHE_URL configuration: {cache_url}!')
+    app.extensions['shared_cache'] = BACKENDS[url.scheme](url)
@@ -0,0 +1,175 @@
+import gzip
+import json
+from functools import lru_cache
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from flask import Response, jsonify, request, current_app as app
+
+from api.cache import LRUCache
+
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain'}
+
+
+@lru_cache(maxsize=None)
+def _brotli():
+    # Brotli is optional (and imported only when the first response is compressed) -- without it the responses
+    # are compressed only with gzip
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _supported_encodings() -> Tuple[str, ...]:
+    # Order matters -- when the client accepts both encodings with the same quality, the first one wins
+    return ('br', 'gzip') if _brotli() is not None else ('gzip',)
+
+
+def negotiate_encoding() -> Optional[str]:
+    """
+
+    Chooses the best content encoding for the current request based on its `Accept-Encoding` header.
+
+    :return: name of the encoding or None if the response should be sent uncompressed
+
+    """
+    return request.accept_encodings.best_match(_supported_encodings())
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return _brotli().compress(data, quality=app.config['COMPRESSION_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=app.config['COMPRESSION_GZIP_LEVEL'])
+
+
+class PrecompressedPayload:
+    """
+
+    Serialized response body together with its compressed variants, all computed once at creation.
+
+    """
+
+    def __init__(self, data: bytes, mimetype: str = 'application/json'):
+        self.mimetype = mimetype
+        self.variants = {None: data}
+        for encoding in _supported_encodings():
+            self.variants[encoding] = compress(data, encoding)
+
+    def to_bytes(self) -> bytes:
+        # Header line with the mimetype and the sizes of the variants followed by the variants themselves
+        header = {'mimetype': self.mimetype, 'variants': [(e, len(data)) for e, data in self.variants.items()]}
+        return b'\n'.join((json.dumps(header).encode(), *self.variants.values()))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'PrecompressedPayload':
+        header, body = data.split(b'\n', 1)
+        header = json.loads(header)
+        payload = cls.__new__(cls)
+        payload.mimetype = header['mimetype']
+        payload.variants = {}
+        offset = 0
+        for encoding, size in header['variants']:
+            payload.variants[encoding] = body[offset:offset + size]
+            offset += size + 1
+        # The payload could have been stored by a process with different compression libraries
+        for encoding in _supported_encodings():
+            if encoding not in payload.variants:
+                payload.variants[encoding] = compress(payload.variants[None], encoding)
+        return payload
+
+    def to_response(self, status: int = 200) -> Response:
+        encoding = negotiate_encoding()
+        response = Response(self.variants[encoding], status=status, mimetype=self.mimetype)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+class PayloadCache:
+    """
+
+    Stores `PrecompressedPayload`s under arbitrary keys, each valid only for one version of the underlying data
+    (identified globally, e.g. by a digest of the data -- the keys in the shared cache are the same in all the
+    processes).
+    The most recently used ones are kept in the process (L1), all of them also in the shared cache (L2, if
+    configured) -- a payload is then built by one process only and the others load it from there.
+
+    """
+    MAX_PAYLOADS = 256
+
+    def __init__(self):
+        self._payloads = LRUCache(self.MAX_PAYLOADS)
+
+    @staticmethod
+    def _shared_key(key: Hashable, version: Hashable) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return ':'.join(map(str, ('payload', *parts, version)))
+
+    def get(self, key: Hashable, version: Hashable, build: Callable[[], Any]) -> PrecompressedPayload:
+        """
+
+        Returns the stored payload for the `key` if it was built for the same `version`, otherwise builds
+        (and stores) a new one from the JSON serializable object returned by `build`.
+
+        :param key: identification of the payload (e.g. the endpoint and its parameters)
+        :param version: identifier of the data the payload is built from, the same in all the processes (e.g.
+            `RatesSnapshot.rates_digest`); None means unknown version -- such payloads are never stored
+        :param build: callable returning the object to be serialized
+        :return: the precompressed payload
+
+        """
+        cached = self._payloads.get(key)
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1]
+        if version is None:
+            return PrecompressedPayload(jsonify(build()).get_data())
+
+        shared = app.extensions.get('shared_cache')
+        data = shared.get(self._shared_key(key, version)) if shared is not None else None
+        if data is not None:
+            payload = PrecompressedPayload.from_bytes(data)
+        else:
+            payload = PrecompressedPayload(jsonify(build()).get_data())
+            if shared is not None:
+                shared.set(self._shared_key(key, version), payload.to_bytes(), app.config['CACHE_TTL'])
+        # Single entry with both -- concurrent readers see either the old or the new one, never a mix
+        self._payloads.set(key, (version, payload))
+        return payload
+
+    def clear(self):
+        self._payloads.clear()
+
+
+def compress_response(response: Response) -> Response:
+    """
+
+    Compresses the dynamic response on the fly if the client accepts it and the response is big enough.
+
+    :param response: the response to be sent
+    :return: the same (possibly compressed) response
+
+    """
+    if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
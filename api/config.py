@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class BaseConfig:
@@ -10,13 +11,79 @@ class BaseConfig:
     TESTING = False
     DEBUG = False
 
-    FIXER_LATEST_URL = 'http://data.fixer.io/api/latest'
-    FIXER_SUPPORTED_URL = 'http://data.fixer.io/api/symbols'
+    # Overridable e.g. to point the app to a local stand-in of the Fixer API (see `benchmarks/fixer_stub.py`)
+    FIXER_LATEST_URL = os.getenv('FIXER_LATEST_URL', 'http://data.fixer.io/api/latest')
+    FIXER_SUPPORTED_URL = os.getenv('FIXER_SUPPORTED_URL', 'http://data.fixer.io/api/symbols')
+    # Checked when the app is created (not here) -- importing the config must stay cheap and side-effect free
     FIXER_API_KEY = os.getenv('FIXER_API_KEY')
-    if not FIXER_API_KEY:
-        raise KeyError('No API key for the Fixer API (source of all the currency rates) was given!')
+    # Timeout (in seconds) of the requests to the Fixer API -- a hung request would block everybody waiting for
+    # the refresh
+    FIXER_TIMEOUT = float(os.getenv('FIXER_TIMEOUT', 10))
+
+    # Age (in seconds) of the currency data after which they are fetched from the Fixer API again
+    RATES_REFRESH_INTERVAL = int(os.getenv('RATES_REFRESH_INTERVAL', 3600))
+    # Delay (in seconds) before the next attempt after a failed refresh -- meanwhile the old data are served
+    RATES_RETRY_INTERVAL = 60
+    # Refreshes the data in a background thread (instead of only on demand when they get too old)
+    RATES_REFRESHER = bool(os.getenv('RATES_REFRESHER'))
+    # The app is created in the master process of the server before forking the workers (see
+    # `api/gunicorn_config.py`) -- no threads can be started then, the workers start them after the fork
+    SERVER_PRELOAD = bool(os.getenv('SERVER_PRELOAD'))
+
+    # Shared (L2) cache of the currency data and the rendered responses -- `redis://host:port/db` (any server
+    # speaking the Redis protocol) or `sqlite:///path/to/file.db`; without it every process works on its own
+    CACHE_URL = os.getenv('CACHE_URL')
+    # For how long (in seconds) the entries are kept in the shared cache
+    CACHE_TTL = 24 * 3600
+    # For how long (in seconds) one process may be fetching the data from the Fixer API before another takes over
+    CACHE_LEASE_SECONDS = 30
+
+    # Sustained number of requests per second allowed to one client (0 turns the limit off) and how many more
+    # it can make at once after being idle
+    RATE_LIMIT = float(os.getenv('RATE_LIMIT', 0))
+    RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', 20))
+    # Clients are told apart by their IP address, or by this header if it holds one of the known API keys
+    # (comma-separated in `RATE_LIMIT_API_KEYS`) -- unknown keys are ignored, they could be made up for each request
+    RATE_LIMIT_KEY_HEADER = 'X-API-Key'
+    RATE_LIMIT_API_KEYS = frozenset(filter(None, os.getenv('RATE_LIMIT_API_KEYS', '').split(',')))
+    # Counts the requests of the clients in the shared cache (see `CACHE_URL`) -- the limit is then for all the
+    # processes together, not for each of them
+    RATE_LIMIT_SHARED = bool(os.getenv('RATE_LIMIT_SHARED'))
+    # Conversions (including the matrices) processed by one process at the same time (0 means unlimited) -- the others
+    # are rejected right away
+    MAX_CONCURRENT_CONVERSIONS = int(os.getenv('MAX_CONCURRENT_CONVERSIONS', 0))
+
+    # `json` -- JSON lines written to stderr by a background thread (the requests never wait for the output),
+    # `text` -- Flask's plain synchronous output
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+    # Records queued for the output -- when it can't keep up, the next ones are dropped
+    LOG_QUEUE_SIZE = 10000
+    # Fraction of the records of these (high-volume) events that are logged
+    LOG_SAMPLE_RATES = {
+        'UnknownCurrencyException': 0.1,
+        'UnknownSymbolException': 0.1,
+        'InvalidAmountException': 0.1,
+        'InvalidParameterException': 0.1,
+        'TooManyRequestsException': 0.01
+    }
 
     SENTRY_DSN = os.getenv('SENTRY_DSN')
+    # Logs the duration of the individual steps of `create_app()`
+    STARTUP_PROFILE = bool(os.getenv('STARTUP_PROFILE'))
+
+    # Fraction of the requests whose processing stages are traced (0 turns the tracing off)
+    TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', 0))
+    # Where the traces are exported -- `file` (JSON lines in `TRACING_FILE`) or `sentry` (requires `SENTRY_DSN`)
+    TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'file')
+    # Absolute -- not wherever the server happens to be started from
+    TRACING_FILE = os.getenv('TRACING_FILE', os.path.join(tempfile.gettempdir(), 'currency-converter-traces.jsonl'))
+
+    # The on-demand profiling endpoints (`/_profile`) are available only if this token is set -- it must be sent
+    # in the `Authorization: Bearer <token>` header
+    PROFILING_TOKEN = os.getenv('PROFILING_TOKEN')
+    PROFILING_MAX_SECONDS = 300
+    PROFILING_MAX_REQUESTS = 10000
+
     CURRENCY_SYMBOLS = {
         '€': 'EUR',
         '£': 'GBP',
@@ -37,6 +104,34 @@ class BaseConfig:
         '₿': 'BTC'
     }
 
+    # Number of decimal places of the converted amounts (the minor unit according to ISO 4217) of the currencies
+    # which don't use the default 2
+    CURRENCY_MINOR_UNITS = {
+        **dict.fromkeys((
+            'BIF', 'BYR', 'CLP', 'DJF', 'GNF', 'ISK', 'JPY', 'KMF', 'KRW', 'PYG', 'RWF', 'UGX', 'VND', 'VUV', 'XAF',
+            'XOF', 'XPF'
+        ), 0),
+        **dict.fromkeys(('BHD', 'IQD', 'JOD', 'KWD', 'LYD', 'OMR', 'TND'), 3),
+        'CLF': 4,
+        # Not in ISO 4217 -- in satoshis
+        'BTC': 8,
+        # No minor unit in ISO 4217 -- precise enough for the fractions of a troy ounce
+        'XAU': 6,
+        'XAG': 4
+    }
+
+    # Responses smaller than this (in bytes) are sent uncompressed -- the gain is not worth the CPU time
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_GZIP_LEVEL = 6
+    COMPRESSION_BROTLI_QUALITY = 5
+    # Base currencies whose all-output conversions (with the default amount) are serialized and compressed
+    # only once per rates version and then served as stored bytes
+    PRECOMPRESSED_BASES = ['EUR', 'USD', 'GBP', 'CZK']
+
+    # Limits of the `/currency_matrix` request -- the response grows with bases * targets * amounts
+    MATRIX_MAX_CURRENCIES = 50
+    MATRIX_MAX_AMOUNTS = 10
+
 
 class ProductionConfig(BaseConfig):
     """
@@ -54,6 +149,7 @@ class DevelopmentConfig(BaseConfig):
 
     """
     DEBUG = True
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
 
 
 class TestingConfig(BaseConfig):
@@ -63,3 +159,4 @@ class TestingConfig(BaseConfig):
 
     """
     TESTING = True
+    LOG_FORMAT = 'text'
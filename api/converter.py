@@ -1,15 +1,77 @@
-from decimal import Decimal, ROUND_HALF_UP
-from typing import List, Dict
+from decimal import Context, Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Dict, List, Mapping, Sequence
 
 from api.currencies import CurrencyResource
+from api.exceptions import InvalidAmountException
+from api.tracing import span
 
 
 class CurrencyConverter:
     @classmethod
-    def convert(cls, amount: float, input_currency: str, output_currency: List[str]) -> Dict[str, float]:
-        decimal_amount = Decimal(amount)
+    def convert(
+            cls, amount: float, input_currency: str, output_currency: Sequence[str], rounding: str = ROUND_HALF_UP
+    ) -> Dict[str, float]:
         rates = CurrencyResource.get_currency_rates(input_currency, output_currency)
-        cents = Decimal('0.01')
-        return {
-            k: float((decimal_amount * Decimal(v)).quantize(cents, rounding=ROUND_HALF_UP)) for k, v in rates.items()
-        }
+        snapshot = CurrencyResource.get_snapshot()
+        return cls.convert_rates(amount, rates, snapshot.quantizers, snapshot.quantize_context, rounding)
+
+    @classmethod
+    def convert_rates(
+            cls,
+            amount: float,
+            rates: Mapping[str, Decimal],
+            quantizers: Mapping[str, Decimal],
+            context: Context,
+            rounding: str = ROUND_HALF_UP
+    ) -> Dict[str, float]:
+        """
+
+        Converts the amount by the rates, each result rounded to the precision of its currency.
+
+        :param amount: amount to convert
+        :param rates: rates in the form of {output_currency: rate}
+        :param quantizers: exponents of the output currencies for `Decimal.quantize` (see `RatesSnapshot`)
+        :param context: context for `Decimal.quantize` (see `RatesSnapshot`)
+        :param rounding: the `decimal` rounding mode
+        :return: converted amounts in the form of {output_currency: amount}
+
+        """
+        decimal_amount = Decimal(amount)
+        with span('convert', output_count=len(rates)):
+            try:
+                return {
+                    k: float((decimal_amount * v).quantize(quantizers[k], rounding=rounding, context=context))
+                    for k, v in rates.items()
+                }
+            except InvalidOperation:
+                raise cls._too_large(amount)
+
+    @classmethod
+    def convert_matrix(
+            cls, amounts: Sequence[float], bases: Sequence[str], targets: Sequence[str], rounding: str = ROUND_HALF_UP
+    ) -> List[Dict[str, Dict[str, float]]]:
+        cross_rates = CurrencyResource.get_cross_rates(bases, targets)
+        snapshot = CurrencyResource.get_snapshot()
+        quantizers, context = snapshot.quantizers, snapshot.quantize_context
+        result = []
+        with span('convert_matrix', output_count=len(amounts) * len(bases) * len(targets)):
+            for amount in amounts:
+                decimal_amount = Decimal(amount)
+                try:
+                    result.append({
+                        base: {
+                            target: float(
+                                (decimal_amount * rate).quantize(quantizers[target], rounding=rounding, context=context)
+                            )
+                            for target, rate in row.items()
+                        }
+                        for base, row in cross_rates.items()
+                    })
+                except InvalidOperation:
+                    raise cls._too_large(amount)
+        return result
+
+    @staticmethod
+    def _too_large(amount: float) -> InvalidAmountException:
+        # Even the context of the snapshot can't hold the converted amount -- it would be out of the range of float
+        return InvalidAmountException(str(amount), 'is too large to convert')
@@ -1,83 +1,304 @@
+import threading
+import time
 from decimal import Decimal
-from typing import List, Dict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
 
-from flask import current_app as app
-import requests
+from flask import Flask, has_request_context, request, current_app as app
 
-from api.exceptions import FixerApiException, UnknownCurrencyException, CacheHitSignal
+from api.cache import SharedCache
+from api.exceptions import FixerApiException, CacheHitSignal
+from api.snapshot import RatesSnapshot
+from api.tracing import span
+
+if TYPE_CHECKING:
+    import requests
 
 
 class CurrencyResource:
-    e_tag = None
-    date = None
-    supported = None
+    # The current snapshot -- replaced as a whole by a single assignment, never modified
+    snapshot: Optional[RatesSnapshot] = None
+    # Functions called with (new snapshot, previous snapshot) whenever a new snapshot is published
+    listeners: List[Callable[[RatesSnapshot, Optional[RatesSnapshot]], None]] = []
+    # Only the refresh takes this lock (to fetch the data only once), readers never do
+    _refresh_lock = threading.Lock()
+    # `time.monotonic()` before which no refresh is attempted (after a failed one)
+    _retry_after = 0.0
+    # Key of the snapshot (and of the lease for fetching it) in the shared cache
+    SHARED_KEY = 'rates_snapshot'
+    # How often (in seconds) the shared cache is checked while another process is fetching the data
+    SHARED_POLL_INTERVAL = 1.0
 
     @classmethod
-    def _dispatch_request(cls, url: str, params: Dict[str, str], headers: Dict[str, str] = None) -> requests.Response:
+    def _dispatch_request(cls, url: str, params: Dict[str, str], headers: Dict[str, str] = None) -> 'requests.Response':
+        # Imported only when the first request to the Fixer API is made -- keeps the startup of the app fast
+        import requests
         access_key = app.config['FIXER_API_KEY']
-        response = requests.get(url, params={**params, 'access_key': access_key}, headers=headers)
+        try:
+            response = requests.get(
+                url, params={**params, 'access_key': access_key}, headers=headers, timeout=app.config['FIXER_TIMEOUT']
+            )
+        except requests.RequestException as e:
+            # Connection errors, timeouts, ... -- handled the same way as the errors reported by the Fixer API
+            raise FixerApiException(url, None, f'{type(e).__name__}: {e}')
         cls._check_response(response, url)
         return response
 
+    @staticmethod
+    def _invalid_response(url: str, e: Exception) -> FixerApiException:
+        return FixerApiException(url, None, f'Invalid response: {type(e).__name__}: {e}')
+
     @classmethod
-    def _check_response(cls, response: requests.Response, url: str):
+    def _check_response(cls, response: 'requests.Response', url: str):
         if response.status_code == 200:
-            response = response.json()
-            if response['success'] is False:
-                code = response['error']['code']
-                info = response['error']['info']
-                raise FixerApiException(url, code, info)
+            try:
+                data = response.json()
+                if data['success'] is False:
+                    raise FixerApiException(url, data['error']['code'], data['error']['info'])
+            except (ValueError, KeyError, TypeError) as e:
+                raise cls._invalid_response(url, e)
         elif response.status_code == 304:
             raise CacheHitSignal
         else:
             raise FixerApiException(response.url, response.status_code, response.reason)
 
     @classmethod
-    def _check_currencies(cls, *currencies: str):
-        supported = cls.get_supported_currencies()
-        for currency in currencies:
-            if currency not in supported.keys():
-                raise UnknownCurrencyException(currency)
-
-    @classmethod
-    def get_supported_currencies(cls) -> Dict[str, str]:
+    def _fetch_supported(cls, previous: Optional[RatesSnapshot]) -> Tuple[Dict[str, str], str, str]:
         # Headers for ETags -- caching the previous result and reducing the response payload
         headers = {
-            'If-None-Match': cls.e_tag,
-            'If-Modified-Since': cls.date
+            'If-None-Match': previous.e_tag if previous else None,
+            'If-Modified-Since': previous.date if previous else None
         }
         url = app.config['FIXER_SUPPORTED_URL']
-        try:
-            response = cls._dispatch_request(url, {}, headers)
-            # Following lines of code won't be executed if there's a `CacheHitSignal` -- the stored values
-            # are still valid and they can be presented to the users
-            cls.supported = response.json()['symbols']
-            cls.e_tag = response.headers['Etag']
-            cls.date = response.headers['Date']
-        except CacheHitSignal:
-            pass
-        return cls.supported
-
-    @classmethod
-    def get_currency_rates(cls, input_currency: str, output_currencies: List[str]) -> Dict[str, Decimal]:
+        with span('fetch_supported_currencies') as s:
+            try:
+                response = cls._dispatch_request(url, {}, headers)
+            except CacheHitSignal:
+                # The stored values are still valid and they can be presented to the users
+                s.set('cache', 'hit')
+                return previous.supported, previous.e_tag, previous.date
+            s.set('cache', 'miss')
+            try:
+                return dict(response.json()['symbols']), response.headers['Etag'], response.headers['Date']
+            except (ValueError, KeyError, TypeError) as e:
+                raise cls._invalid_response(url, e)
+
+    @classmethod
+    def _fetch_rates(cls) -> Tuple[Dict[str, Decimal], Optional[int]]:
+        # Rates of all the currencies (empty `symbols`) -- any conversion can be then computed from them
         url = app.config['FIXER_LATEST_URL']
-        if len(output_currencies) > 0:
-            output_currencies.append(input_currency)
-        else:
-            cls._check_currencies(input_currency)
-        cls._check_currencies(*output_currencies)
-        # The free plan for Fixer API does not allow changing the base currency, therefore we always get rates
-        # for the EUR->(`output_currencies` + `input_currency`) conversion. For example we need the GBP->CZK
-        # conversion -- from the Fixer API we get EUR->GBP and EUR->CZK -- from this we can compute GBP->CZK as
-        # EUR->CZK / EUR->GBP
-        response = cls._dispatch_request(url, {'symbols': ','.join(output_currencies)})
-
-        def _from_eur(eur_to_target: str, eur_to_base: str) -> Decimal:
-            return Decimal(eur_to_target) / Decimal(eur_to_base)
-
-        rates = response.json()['rates']
-        result = {
-            k: _from_eur(v, rates[input_currency]) for k, v in rates.items() if k != input_currency
-        }
+        with span('fetch_currency_rates'):
+            response = cls._dispatch_request(url, {'symbols': ''})
+        try:
+            # Parsed right to `Decimal` -- exactly the values sent by the Fixer API, not their binary approximations
+            data = response.json(parse_float=Decimal)
+            rates = {code: Decimal(rate) for code, rate in data['rates'].items()}
+            if not all(rate.is_finite() and rate > 0 for rate in rates.values()):
+                raise ValueError('Rates must be positive numbers')
+            return rates, data.get('timestamp')
+        except (ValueError, KeyError, TypeError, ArithmeticError) as e:
+            raise cls._invalid_response(url, e)
+
+    @classmethod
+    def _publish(cls, snapshot: RatesSnapshot):
+        previous = cls.snapshot
+        # A single reference assignment -- readers get either the whole previous or the whole new snapshot
+        cls.snapshot = snapshot
+        for listener in cls.listeners:
+            listener(snapshot, previous)
+
+    @classmethod
+    def _fetch(cls, previous: Optional[RatesSnapshot]) -> RatesSnapshot:
+        supported, e_tag, date = cls._fetch_supported(previous)
+        rates, timestamp = cls._fetch_rates()
+        return RatesSnapshot.create(
+            version=previous.version + 1 if previous else 1,
+            supported=supported,
+            rates=rates,
+            e_tag=e_tag,
+            date=date,
+            timestamp=timestamp,
+            minor_units=app.config['CURRENCY_MINOR_UNITS'],
+            # What hasn't changed keeps its version -- and the data derived from it stay valid
+            previous=previous
+        )
+
+    @classmethod
+    def _load_shared(cls, shared: SharedCache) -> Optional[RatesSnapshot]:
+        with span('load_shared_snapshot') as s:
+            data = shared.get(cls.SHARED_KEY)
+            s.set('cache', 'hit' if data is not None else 'miss')
+        return RatesSnapshot.from_bytes(data, app.config['CURRENCY_MINOR_UNITS']) if data is not None else None
+
+    @classmethod
+    def _wait_for_shared(cls, shared: SharedCache) -> Optional[RatesSnapshot]:
+        deadline = time.monotonic() + app.config['CACHE_LEASE_SECONDS']
+        while time.monotonic() < deadline:
+            time.sleep(cls.SHARED_POLL_INTERVAL)
+            snapshot = cls._load_shared(shared)
+            if snapshot is not None:
+                return snapshot
+        return None
+
+    @classmethod
+    def _refresh_shared(cls, shared: SharedCache, previous: Optional[RatesSnapshot]) -> RatesSnapshot:
+        latest = cls._load_shared(shared)
+        # Only newer data replace the previous ones
+        if latest is None or (previous is not None and latest.created <= previous.created):
+            latest = previous
+        if latest is not None and not cls._is_expired(latest):
+            # Another process has already fetched the data
+            return latest
+
+        token = shared.acquire_lease(cls.SHARED_KEY, app.config['CACHE_LEASE_SECONDS'])
+        if token is None:
+            # Another process is fetching the data right now -- the stale ones are served meanwhile, only the very
+            # first request (with no data at all) waits for them
+            if latest is not None:
+                return latest
+            latest = cls._wait_for_shared(shared)
+            if latest is not None:
+                return latest
+            return cls._store_first_shared(shared, cls._fetch(None))
+        try:
+            snapshot = cls._fetch(latest)
+            shared.set(cls.SHARED_KEY, snapshot.to_bytes(), app.config['CACHE_TTL'])
+        finally:
+            shared.release_lease(cls.SHARED_KEY, token)
+        return snapshot
+
+    @classmethod
+    def _store_first_shared(cls, shared: SharedCache, snapshot: RatesSnapshot) -> RatesSnapshot:
+        # The holder of the lease didn't deliver in time (e.g. it crashed) and the snapshot had to be fetched
+        # without it -- it's stored only if the shared cache is still empty, otherwise the snapshot from there is
+        # used, so there's never a second history of the versions next to the shared one
+        def updater(value: Optional[bytes]) -> Tuple[bytes, Optional[bytes]]:
+            return (value, value) if value is not None else (snapshot.to_bytes(), None)
+
+        stored = shared.update(cls.SHARED_KEY, updater, app.config['CACHE_TTL'])
+        if stored is None:
+            return snapshot
+        return RatesSnapshot.from_bytes(stored, app.config['CURRENCY_MINOR_UNITS'])
+
+    @classmethod
+    def refresh(cls) -> RatesSnapshot:
+        """
+
+        Publishes a new snapshot with the data fetched from the Fixer API. With the shared cache configured, only
+        one process at a time fetches them, the others take the snapshot from the shared cache.
+
+        :return: the current snapshot -- the previous one if another process is fetching the data right now
+
+        """
+        previous = cls.snapshot
+        shared = app.extensions.get('shared_cache')
+        snapshot = cls._fetch(previous) if shared is None else cls._refresh_shared(shared, previous)
+        if snapshot is not previous:
+            cls._publish(snapshot)
+        return snapshot
+
+    @classmethod
+    def _is_expired(cls, snapshot: RatesSnapshot) -> bool:
+        return time.time() - snapshot.created >= app.config['RATES_REFRESH_INTERVAL']
+
+    @classmethod
+    def _is_stale(cls, snapshot: RatesSnapshot) -> bool:
+        return cls._is_expired(snapshot) and time.monotonic() >= cls._retry_after
+
+    @classmethod
+    def _current_snapshot(cls) -> RatesSnapshot:
+        snapshot = cls.snapshot
+        if snapshot is None:
+            # Nothing to serve yet -- the first requests have to wait for the data
+            with cls._refresh_lock:
+                if cls.snapshot is None:
+                    cls.refresh()
+                return cls.snapshot
+        if not cls._is_stale(snapshot) or not cls._refresh_lock.acquire(blocking=False):
+            # Either fresh enough or somebody else is already refreshing it -- served as it is meanwhile
+            return snapshot
+        try:
+            refreshed = cls.refresh()
+            if refreshed is snapshot:
+                # Another process is fetching the data -- not asking the shared cache on every request meanwhile
+                cls._retry_after = time.monotonic() + cls.SHARED_POLL_INTERVAL
+            return refreshed
+        except FixerApiException as e:
+            # Stale data are better than no data -- the refresh is retried later
+            cls._retry_after = time.monotonic() + app.config['RATES_RETRY_INTERVAL']
+            app.logger.error(e.logger_msg, extra={'event': 'FixerApiException', 'stale_version': snapshot.version})
+            return snapshot
+        finally:
+            cls._refresh_lock.release()
+
+    @classmethod
+    def get_snapshot(cls) -> RatesSnapshot:
+        """
+
+        Returns the current snapshot (refreshing it, if it's too old). Within a request, the first returned
+        snapshot is pinned, so the whole request works with one version of the data.
+
+        :return: the snapshot
+
+        """
+        if not has_request_context():
+            return cls._current_snapshot()
+        snapshot = request.environ.get('api.snapshot')
+        if snapshot is None:
+            with span('get_snapshot') as s:
+                previous = cls.snapshot
+                snapshot = request.environ['api.snapshot'] = cls._current_snapshot()
+                s.set('version', snapshot.version)
+                s.set('cache', 'hit' if snapshot is previous else 'miss')
+        return snapshot
+
+    @classmethod
+    def get_currency_rates(cls, input_currency: str, output_currencies: Sequence[str]) -> Dict[str, Decimal]:
+        snapshot = cls.get_snapshot()
+        with span('get_currency_rates', output_count=len(output_currencies), version=snapshot.version):
+            return snapshot.cross_rates(input_currency, output_currencies)
+
+    @classmethod
+    def get_cross_rates(cls, bases: Sequence[str], targets: Sequence[str]) -> Dict[str, Dict[str, Decimal]]:
+        snapshot = cls.get_snapshot()
+        with span('get_cross_rates', base_count=len(bases), target_count=len(targets), version=snapshot.version):
+            return snapshot.cross_rates_matrix(bases, targets)
+
+    # ---------------------------------------------------- Refresher --------------------------------------------------
+
+    @classmethod
+    def _refresh_periodically(cls, flask_app: Flask, stop: threading.Event):
+        with flask_app.app_context():
+            while not stop.is_set():
+                try:
+                    with cls._refresh_lock:
+                        snapshot = cls.refresh()
+                    # Until the snapshot expires -- it could have been fetched by another process a while ago
+                    interval = max(
+                        snapshot.created + app.config['RATES_REFRESH_INTERVAL'] - time.time(), cls.SHARED_POLL_INTERVAL
+                    )
+                except FixerApiException as e:
+                    app.logger.error(e.logger_msg, extra={'event': 'FixerApiException'})
+                    interval = app.config['RATES_RETRY_INTERVAL']
+                except Exception:
+                    # The thread must never die -- without it the data would be refreshed only by the requests
+                    app.logger.exception('Unexpected error when refreshing the currency data')
+                    interval = app.config['RATES_RETRY_INTERVAL']
+                stop.wait(interval)
+
+    @classmethod
+    def start_refresher(cls, flask_app: Flask) -> threading.Event:
+        """
+
+        Starts a daemon thread refreshing the snapshot every `RATES_REFRESH_INTERVAL` seconds, so the requests
+        (almost) never have to wait for the Fixer API. Has to be called in every worker process (after the fork).
+
+        :param flask_app: the app whose configuration is used
+        :return: event stopping the refresher when set
 
-        return result
+        """
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=cls._refresh_periodically, args=(flask_app, stop), name='rates-refresher', daemon=True
+        )
+        thread.start()
+        return stop
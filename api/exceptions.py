@@ -1,3 +1,8 @@
+import math
+
+from api.logs import redact
+
+
 class CustomException(Exception):
     def __init__(self, display_msg: str, logger_msg: str):
         self.display_msg = display_msg
@@ -7,7 +12,9 @@ class CustomException(Exception):
 class FixerApiException(CustomException):
     def __init__(self, url: str, code: int, info: str):
         display_msg = 'An error occurred when processing your request. Please, try it later.'
-        logger_msg = f'An error occurred when requesting the Fixer API. URL: {url}, CODE: {code}, INFO: {info}'
+        # The URL (and the errors of `requests` quoting it) contains the API key
+        logger_msg = (f'An error occurred when requesting the Fixer API. URL: {redact(url)}, CODE: {code}, '
+                      f'INFO: {redact(str(info))}')
         super().__init__(display_msg, logger_msg)
 
 
@@ -27,9 +34,25 @@ class UnknownCurrencyException(CustomException):
 
 
 class InvalidAmountException(CustomException):
-    def __init__(self, amount: str):
-        display_msg = f'Invalid parameter `amount`. {amount} is not a number'
-        logger_msg = f'Could not convert string {amount} to float'
+    def __init__(self, amount: str, reason: str = 'is not a number'):
+        display_msg = f'Invalid parameter `amount`. {amount} {reason}'
+        logger_msg = f'Could not convert amount {amount}: {reason}'
+        super().__init__(display_msg, logger_msg)
+
+
+class InvalidParameterException(CustomException):
+    def __init__(self, parameter: str, reason: str):
+        display_msg = f'Invalid parameter `{parameter}`. {reason}'
+        logger_msg = f'Invalid parameter {parameter}: {reason}'
+        super().__init__(display_msg, logger_msg)
+
+
+class TooManyRequestsException(CustomException):
+    def __init__(self, retry_after: float, reason: str):
+        # Whole seconds -- the `Retry-After` header doesn't allow fractions
+        self.retry_after = max(1, math.ceil(retry_after))
+        display_msg = f'Too many requests. Please, try it again in {self.retry_after} s.'
+        logger_msg = f'Request rejected: {reason}'
         super().__init__(display_msg, logger_msg)
 
 
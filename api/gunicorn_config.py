@@ -0,0 +1,88 @@
+"""
+
+Gunicorn configuration with the worker profiles for production:
+
+* `sync` -- `2 * cores + 1` single-threaded processes; one slow call to the Fixer API blocks a whole process
+* `gthread` (the default) -- a process per core, each with `GUNICORN_THREADS` threads; the waiting for the Fixer API
+  (or the shared cache) doesn't block other requests and far fewer processes (and memory) are needed
+* `gevent` -- a process per core, each with up to `GUNICORN_CONNECTIONS` greenlets (requires the `gevent` package)
+
+Run with `gunicorn -c api/gunicorn_config.py "api:create_app()"` and choose the profile by the `GUNICORN_PROFILE`
+environment variable. `GUNICORN_WORKERS`, `GUNICORN_THREADS`, `GUNICORN_CONNECTIONS` and `GUNICORN_KEEPALIVE` override
+the values of the profile.
+
+"""
+import multiprocessing
+import os
+
+
+CORES = int(os.getenv('CORES_NUM') or multiprocessing.cpu_count())
+PROFILES = {
+    'sync': {
+        'worker_class': 'sync',
+        'workers': 2 * CORES + 1,
+        'threads': 1,
+        'preload_app': True
+    },
+    'gthread': {
+        'worker_class': 'gthread',
+        'workers': CORES,
+        'threads': 8,
+        'preload_app': True
+    },
+    'gevent': {
+        'worker_class': 'gevent',
+        'workers': CORES,
+        'worker_connections': 1000,
+        # The workers monkey-patch the standard library only after the fork -- the app (with its locks) has to be
+        # created after that, not in the master
+        'preload_app': False
+    }
+}
+
+profile = os.getenv('GUNICORN_PROFILE', 'gthread')
+if profile not in PROFILES:
+    raise ValueError(f'Invalid GUNICORN_PROFILE configuration: {profile}!')
+settings = PROFILES[profile]
+
+bind = os.getenv('GUNICORN_BIND', ':8000')
+worker_class = settings['worker_class']
+workers = int(os.getenv('GUNICORN_WORKERS') or settings['workers'])
+threads = int(os.getenv('GUNICORN_THREADS') or settings.get('threads', 1))
+worker_connections = int(os.getenv('GUNICORN_CONNECTIONS') or settings.get('worker_connections', 1000))
+
+# The app is created once in the master and the workers share its memory (copy-on-write) -- they start faster and
+# take less memory. No threads may be started before the fork though (see `post_fork`).
+preload_app = settings['preload_app']
+if preload_app:
+    os.environ['SERVER_PRELOAD'] = '1'
+
+# Longer than the idle timeout of the usual load balancers (60 s) -- otherwise the balancer may send a request over
+# a connection the worker is just closing. Ignored by the sync workers (they don't support keep-alive).
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 75))
+timeout = 30
+graceful_timeout = 30
+# The workers are restarted now and then (against slow leaks) -- with the jitter not all of them at once
+max_requests = 10000
+max_requests_jitter = 1000
+# The workers' heartbeat files in memory -- a disk-backed /tmp (e.g. in Docker) can block them
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')
+
+
+def post_fork(server, worker):
+    """
+
+    Starts the background refresh of the currency data and the log output in every worker -- threads don't survive
+    the fork, so with the preloaded app they can't be started by `create_app()` in the master.
+
+    """
+    if not preload_app:
+        return
+    app = worker.app.wsgi()
+    if app.config['LOG_FORMAT'] == 'json':
+        from api.logs import start_logging
+        start_logging(app)
+    if app.config['RATES_REFRESHER']:
+        from api.currencies import CurrencyResource
+        CurrencyResource.start_refresher(app)
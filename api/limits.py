@@ -0,0 +1,114 @@
+import threading
+import time
+from typing import Optional, Tuple
+
+from flask import Flask, request, current_app as app
+
+from api.cache import LRUCache, SharedCache
+from api.exceptions import TooManyRequestsException
+
+
+class RateLimiter:
+    """
+
+    Token bucket per client -- each one holds at most `burst` tokens, refilled at `rate` tokens per second, and every
+    request takes one. The buckets are kept in the process or, if given, in the shared cache (falling back to the
+    process when the shared cache is unavailable).
+
+    """
+    # The buckets of the least recently seen clients are dropped -- they would be full by then anyway
+    MAX_CLIENTS = 10000
+
+    def __init__(self, rate: float, burst: int, shared: SharedCache = None):
+        self.rate = rate
+        self.burst = burst
+        self.shared = shared
+        self._buckets = LRUCache(self.MAX_CLIENTS)
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float, updated: float, now: float) -> Tuple[float, float]:
+        tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0.0
+        return tokens, (1 - tokens) / self.rate
+
+    def _take_local(self, client: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens, wait = self._take(tokens, updated, now)
+            self._buckets.set(client, (tokens, now))
+        return wait
+
+    def _take_shared(self, client: str) -> Optional[float]:
+        def updater(value: Optional[bytes]) -> Tuple[bytes, float]:
+            # Wall clock -- the buckets are shared by processes (and nodes) with unrelated monotonic clocks
+            now = time.time()
+            tokens, updated = map(float, value.split(b':')) if value is not None else (self.burst, now)
+            tokens, wait = self._take(tokens, updated, now)
+            return f'{tokens}:{now}'.encode(), wait
+
+        # An untouched bucket gets full in `burst / rate` seconds -- no need to keep it any longer
+        return self.shared.update(f'rate_limit:{client}', updater, max(self.burst / self.rate, 1))
+
+    def take(self, client: str) -> float:
+        """
+
+        Takes a token from the bucket of the client.
+
+        :param client: identification of the client
+        :return: 0 if the request is allowed, otherwise how long (in seconds) the client should wait
+
+        """
+        wait = self._take_shared(client) if self.shared is not None else None
+        return wait if wait is not None else self._take_local(client)
+
+
+def init_limits(app: Flask):
+    config = app.config
+    limiter = None
+    if config['RATE_LIMIT'] > 0:
+        shared = app.extensions['shared_cache'] if config['RATE_LIMIT_SHARED'] else None
+        limiter = RateLimiter(config['RATE_LIMIT'], config['RATE_LIMIT_BURST'], shared)
+    app.extensions['rate_limiter'] = limiter
+    slots = config['MAX_CONCURRENT_CONVERSIONS']
+    app.extensions['conversion_slots'] = threading.BoundedSemaphore(slots) if slots > 0 else None
+
+
+def _client() -> str:
+    # Only a known key gets its own bucket -- otherwise a client sending a new key with every request would get
+    # a full bucket every time (and push the real clients out of the buckets kept)
+    key = request.headers.get(app.config['RATE_LIMIT_KEY_HEADER'])
+    if key and key in app.config['RATE_LIMIT_API_KEYS']:
+        return f'key:{key}'
+    return f'ip:{request.remote_addr}'
+
+
+def admit_request(limit_concurrency: bool):
+    """
+
+    Rejects the request if its client exceeded the rate limit or (if `limit_concurrency`) if too many conversions
+    are being processed already. Nothing waits -- the excess requests are rejected right away.
+
+    :param limit_concurrency: whether the request takes one of the `MAX_CONCURRENT_CONVERSIONS` slots
+    :raise TooManyRequestsException: if the request is rejected
+
+    """
+    limiter = app.extensions['rate_limiter']
+    if limiter is not None:
+        wait = limiter.take(_client())
+        if wait > 0:
+            raise TooManyRequestsException(wait, f'rate limit exceeded by {request.remote_addr}')
+
+    slots = app.extensions['conversion_slots']
+    if limit_concurrency and slots is not None:
+        if not slots.acquire(blocking=False):
+            raise TooManyRequestsException(1, 'too many concurrent conversions')
+        request.environ['api.conversion_slot'] = slots
+
+
+def release_request():
+    # Called both after the request and at its teardown (errors skip the former) -- the slot is released only once
+    slots = request.environ.pop('api.conversion_slot', None)
+    if slots is not None:
+        slots.release()
@@ -0,0 +1,156 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict
+
+from flask import Flask, Response, request, current_app
+from flask.logging import default_handler
+
+
+# Secrets sent in query strings (e.g. the key of the Fixer API in its URLs)
+SECRET_PATTERN = re.compile(r'((?:access_key|api_key|token)=)[^&\s,]+', re.IGNORECASE)
+# Attributes every `LogRecord` has -- anything else was passed in `extra` and belongs to the structured fields
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def redact(text: str) -> str:
+    return SECRET_PATTERN.sub(r'\1***', text)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+
+    Formats the records as JSON lines -- the message (with the secrets redacted) and the structured fields passed
+    in `extra` (e.g. `event`, `path` or `status`).
+
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': redact(record.getMessage())
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+
+    Lets through only a fraction of the records of the high-volume events (e.g. unknown currencies sent by a broken
+    client). The kept records carry the `sample_rate`, so the counts can be scaled back.
+
+    """
+
+    def __init__(self, sample_rates: Dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sample_rate = self.sample_rates.get(getattr(record, 'event', None))
+        if sample_rate is None:
+            return True
+        record.sample_rate = sample_rate
+        return random.random() < sample_rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+
+    Hands the records over to the `QueueListener` thread which does the actual I/O. When the queue is full (the
+    output can't keep up), the records are dropped and counted instead of blocking the request.
+
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _start_timer():
+    request.environ['api.request_start'] = time.perf_counter()
+
+
+def _log_access(response: Response) -> Response:
+    # After all the other `after_request` functions of the app's blueprints -- the final status and size
+    start = request.environ.get('api.request_start')
+    duration = (time.perf_counter() - start) * 1000 if start is not None else None
+    current_app.logger.info(
+        '%s %s %s', request.method, request.full_path.rstrip('?'), response.status_code,
+        extra={
+            'event': 'access',
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': duration,
+            'size': response.calculate_content_length(),
+            'remote_addr': request.remote_addr
+        }
+    )
+    return response
+
+
+def init_logging(app: Flask):
+    log_format = app.config['LOG_FORMAT']
+    if log_format not in ('json', 'text'):
+        raise ValueError(f'Invalid LOG_FORMAT configuration: {log_format}!')
+    if log_format == 'json':
+        # The access log as structured records on the same queue -- instead of the plain access log of the server
+        app.before_request(_start_timer)
+        app.after_request(_log_access)
+    # With the preloaded app the master keeps Flask's handler -- the listener thread wouldn't survive the fork
+    if log_format == 'json' and not app.config['SERVER_PRELOAD']:
+        start_logging(app)
+
+
+def start_logging(app: Flask):
+    """
+
+    Replaces Flask's synchronous handler of the app's logger by the queue one and starts the thread writing the
+    queued records (with the preloaded app in every worker after the fork, see `api/gunicorn_config.py`).
+
+    :param app: the app whose logger is set up
+
+    """
+    stop_logging(app)
+    config = app.config
+    handler = DroppingQueueHandler(queue.Queue(config['LOG_QUEUE_SIZE']))
+    # Formatted (and redacted) before being queued -- the listener only writes the lines
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SamplingFilter(config['LOG_SAMPLE_RATES']))
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+
+    # The logger is shared by all the instances of the app
+    for previous in app.logger.handlers[:]:
+        if previous is default_handler or isinstance(previous, DroppingQueueHandler):
+            app.logger.removeHandler(previous)
+    app.logger.addHandler(handler)
+    app.logger.setLevel(logging.DEBUG if app.debug else logging.INFO)
+    app.extensions['log_listener'] = listener
+    # Writes out what's left in the queue
+    atexit.register(stop_logging, app)
+
+
+def stop_logging(app: Flask):
+    listener = app.extensions.pop('log_listener', None)
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,155 @@
+import math
+import sys
+from decimal import ROUND_CEILING, ROUND_DOWN, ROUND_FLOOR, ROUND_HALF_DOWN, ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_UP
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+
+from api.exceptions import InvalidAmountException, InvalidParameterException, UnknownSymbolException
+
+
+class ConversionRequest(NamedTuple):
+    amount: float
+    input_currency: str
+    output_currencies: Tuple[str, ...]
+    rounding: str = ROUND_HALF_UP
+
+
+class MatrixRequest(NamedTuple):
+    bases: Tuple[str, ...]
+    targets: Tuple[str, ...]
+    amounts: Tuple[float, ...]
+    rounding: str = ROUND_HALF_UP
+
+
+class RequestParser:
+    """
+
+    Parses the query parameters of the conversion request. Symbols and already seen currency codes are translated
+    through one precompiled table to interned strings, so the later lookups in the currency index (and the
+    deduplication of the output currencies) compare mostly by identity.
+
+    """
+    DEFAULT_AMOUNT = 1.0
+    DEFAULT_INPUT_CURRENCY = 'CZK'
+    # Values of the `rounding` parameter mapped to the `decimal` rounding modes
+    ROUNDING_MODES = {
+        'half_up': ROUND_HALF_UP,
+        'half_even': ROUND_HALF_EVEN,
+        'half_down': ROUND_HALF_DOWN,
+        'up': ROUND_UP,
+        'down': ROUND_DOWN,
+        'ceiling': ROUND_CEILING,
+        'floor': ROUND_FLOOR
+    }
+    # The table of seen tokens is bounded -- otherwise junk inputs could grow it indefinitely
+    MAX_TOKENS = 1024
+
+    def __init__(self, symbols: Mapping[str, str], max_matrix_currencies: int = 50, max_matrix_amounts: int = 10):
+        self.max_matrix_currencies = max_matrix_currencies
+        self.max_matrix_amounts = max_matrix_amounts
+        self._symbols = {symbol: sys.intern(code.upper()) for symbol, code in symbols.items()}
+        self._tokens: Dict[str, str] = dict(self._symbols)
+
+    def _translate(self, token: str) -> str:
+        translated = self._tokens.get(token)
+        if translated is not None:
+            return translated
+        if len(token) == 1:
+            raise UnknownSymbolException(token)
+        translated = sys.intern(token.upper())
+        if len(self._tokens) < self.MAX_TOKENS:
+            self._tokens[token] = translated
+        return translated
+
+    @staticmethod
+    def _arg(args: Mapping[str, str], name: str) -> Optional[str]:
+        # `MultiDict.get` raises (and catches) an exception for every missing parameter -- most of them are missing
+        return args[name] if name in args else None
+
+    @staticmethod
+    def _to_float(amount: str) -> float:
+        try:
+            value = float(amount)
+        except ValueError:
+            raise InvalidAmountException(amount)
+        # `nan` and `inf` parse as floats, but can't be converted (nor serialized to JSON)
+        if not math.isfinite(value):
+            raise InvalidAmountException(amount)
+        return value
+
+    def _parse_currencies(self, currencies: str) -> Tuple[str, ...]:
+        # `dict.fromkeys` removes the duplicates while keeping the order of the currencies
+        return tuple(dict.fromkeys(map(self._translate, currencies.split(','))))
+
+    def parse_amount(self, args: Mapping[str, str]) -> float:
+        amount = self._arg(args, 'amount')
+        if amount is None:
+            return self.DEFAULT_AMOUNT
+        return self._to_float(amount)
+
+    def parse_input_currency(self, args: Mapping[str, str]) -> str:
+        input_currency = self._arg(args, 'input_currency')
+        if input_currency is None:
+            return self.DEFAULT_INPUT_CURRENCY
+        return self._translate(input_currency) if input_currency else input_currency
+
+    def parse_output_currencies(self, args: Mapping[str, str]) -> Tuple[str, ...]:
+        output_currency = self._arg(args, 'output_currency')
+        if not output_currency:
+            return ()
+        return self._parse_currencies(output_currency)
+
+    def parse_rounding(self, args: Mapping[str, str]) -> str:
+        rounding = self._arg(args, 'rounding')
+        if not rounding:
+            return ROUND_HALF_UP
+        try:
+            return self.ROUNDING_MODES[rounding.lower()]
+        except KeyError:
+            raise InvalidParameterException('rounding', f'Use one of: {", ".join(self.ROUNDING_MODES)}.')
+
+    def parse_since(self, args: Mapping[str, str]) -> int:
+        since = self._arg(args, 'since')
+        if not since:
+            return 0
+        try:
+            since = int(since)
+        except ValueError:
+            since = -1
+        if since < 0:
+            raise InvalidParameterException('since', 'A timestamp (non-negative integer) is required.')
+        return since
+
+    def parse_debug(self, args: Mapping[str, str]) -> bool:
+        return self._arg(args, 'debug') == '1'
+
+    def parse(self, args: Mapping[str, str]) -> ConversionRequest:
+        return ConversionRequest(
+            self.parse_amount(args),
+            self.parse_input_currency(args),
+            self.parse_output_currencies(args),
+            self.parse_rounding(args)
+        )
+
+    def parse_matrix(self, args: Mapping[str, str]) -> MatrixRequest:
+        """
+
+        Parses the request for the conversion matrix -- `bases` and `targets` are comma-separated currencies (if
+        only one of them is given, it is used for both) and `amounts` comma-separated numbers (defaults to 1).
+
+        """
+        bases = self._arg(args, 'bases') or self._arg(args, 'targets')
+        targets = self._arg(args, 'targets') or bases
+        if not bases:
+            raise InvalidParameterException('bases', 'At least one of `bases` or `targets` is required.')
+        bases, targets = self._parse_currencies(bases), self._parse_currencies(targets)
+        for name, currencies in (('bases', bases), ('targets', targets)):
+            if len(currencies) > self.max_matrix_currencies:
+                raise InvalidParameterException(name, f'At most {self.max_matrix_currencies} currencies are allowed.')
+
+        amounts = self._arg(args, 'amounts')
+        if not amounts:
+            return MatrixRequest(bases, targets, (self.DEFAULT_AMOUNT,), self.parse_rounding(args))
+        amounts = tuple(dict.fromkeys(map(self._to_float, amounts.split(','))))
+        if len(amounts) > self.max_matrix_amounts:
+            raise InvalidParameterException('amounts', f'At most {self.max_matrix_amounts} amounts are allowed.')
+        return MatrixRequest(bases, targets, amounts, self.parse_rounding(args))
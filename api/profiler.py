@@ -0,0 +1,203 @@
+import cProfile
+import hmac
+import io
+import marshal
+import pickle
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+from flask import Blueprint, Response, request, jsonify, current_app as app
+
+
+profiler_bp = Blueprint('profiler', __name__, url_prefix='/_profile')
+
+
+class ProfilingSession:
+    """
+
+    On-demand profile of the live worker -- a CPU profile (cProfile) of the served requests and a snapshot of the
+    memory allocations (tracemalloc), captured for the given number of seconds or requests.
+
+    """
+
+    def __init__(self, seconds: Optional[float], requests: Optional[int]):
+        self.seconds = seconds
+        self.requests = requests
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.profiled_requests = 0
+        self.finished = False
+        self.cpu_stats = None
+        self.snapshot = None
+        self._profile = cProfile.Profile()
+        # One `cProfile.Profile` cannot profile more threads at once -- concurrent requests are simply skipped
+        self._profile_lock = threading.Lock()
+        self._finish_lock = threading.Lock()
+        tracemalloc.start()
+        # Finished on time even if no request comes -- tracing every allocation is not left on in an idle worker
+        self._timer = None
+        if seconds:
+            self._timer = threading.Timer(seconds, self.finish)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def poll(self) -> bool:
+        """
+
+        Finishes the session if its time or number of requests is up.
+
+        :return: True if the session is finished
+
+        """
+        if not self.finished and (
+                (self.deadline is not None and time.monotonic() >= self.deadline)
+                or (self.requests is not None and self.profiled_requests >= self.requests)
+        ):
+            self.finish()
+        return self.finished
+
+    def enable(self) -> bool:
+        if self.poll() or not self._profile_lock.acquire(blocking=False):
+            return False
+        self._profile.enable()
+        return True
+
+    def disable(self):
+        self._profile.disable()
+        self.profiled_requests += 1
+        self._profile_lock.release()
+        self.poll()
+
+    def finish(self):
+        with self._finish_lock:
+            if self.finished:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            # Waits for the request being profiled right now
+            with self._profile_lock:
+                self._profile.create_stats()
+                self.cpu_stats = marshal.dumps(self._profile.stats)
+                self.snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                self.finished = True
+
+    def status(self) -> dict:
+        return {
+            'finished': self.finished,
+            'seconds': self.seconds,
+            'requests': self.requests,
+            'profiled_requests': self.profiled_requests
+        }
+
+
+# ------------------------------------------------------ Helpers ------------------------------------------------------
+
+
+def _session() -> Optional[ProfilingSession]:
+    return app.extensions.get('profiling_session')
+
+
+def _get_limit(name: str, type_: type, maximum: float):
+    value = request.args.get(name, type=type_)
+    if value is None:
+        return None
+    if not 0 < value <= maximum:
+        raise ValueError(f'Parameter `{name}` must be between 0 and {maximum}.')
+    return value
+
+
+def _finished_session() -> ProfilingSession:
+    session = _session()
+    if session is None or not session.poll():
+        raise LookupError('There is no finished profiling session.')
+    return session
+
+
+# -------------------------------------------------- Hooks ------------------------------------------------------------
+
+
+@profiler_bp.before_request
+def authenticate():
+    token = app.config['PROFILING_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        return jsonify({'error': 'Unauthorized.'}), 401
+
+
+@profiler_bp.before_app_request
+def start_request_profile():
+    session = _session()
+    if session is not None and request.blueprint != profiler_bp.name and session.enable():
+        request.environ['api.profiling_session'] = session
+
+
+@profiler_bp.teardown_app_request
+def stop_request_profile(exception: Exception = None):
+    session = request.environ.pop('api.profiling_session', None)
+    if session is not None:
+        session.disable()
+
+
+@profiler_bp.errorhandler(ValueError)
+def handle_value_error(e: ValueError) -> (Response, int):
+    return jsonify({'error': str(e)}), 400
+
+
+@profiler_bp.errorhandler(LookupError)
+def handle_lookup_error(e: LookupError) -> (Response, int):
+    return jsonify({'error': str(e)}), 409
+
+
+# -------------------------------------------------- Routes -----------------------------------------------------------
+
+
+@profiler_bp.route('/start', methods=['POST'])
+def start() -> (Response, int):
+    seconds = _get_limit('seconds', float, app.config['PROFILING_MAX_SECONDS'])
+    requests = _get_limit('requests', int, app.config['PROFILING_MAX_REQUESTS'])
+    if seconds is None and requests is None:
+        raise ValueError('One of the parameters `seconds` or `requests` is required.')
+    session = _session()
+    if session is not None and not session.poll():
+        raise LookupError('Another profiling session is running.')
+    session = ProfilingSession(seconds, requests)
+    app.extensions['profiling_session'] = session
+    return jsonify(session.status()), 202
+
+
+@profiler_bp.route('', methods=['GET'])
+def status() -> (Response, int):
+    session = _session()
+    if session is None:
+        raise LookupError('There is no profiling session.')
+    session.poll()
+    return jsonify(session.status()), 200
+
+
+@profiler_bp.route('/cpu', methods=['GET'])
+def cpu() -> Response:
+    # The same format as written by `cProfile.Profile.dump_stats` -- readable by `pstats`, snakeviz etc.
+    return Response(
+        _finished_session().cpu_stats,
+        mimetype='application/octet-stream',
+        headers={'Content-Disposition': 'attachment; filename=cpu.prof'}
+    )
+
+
+@profiler_bp.route('/allocations', methods=['GET'])
+def allocations() -> Response:
+    snapshot = _finished_session().snapshot
+    if request.args.get('format') == 'text':
+        top = request.args.get('top', default=50, type=int)
+        output = io.StringIO()
+        for statistic in snapshot.statistics('lineno')[:top]:
+            print(statistic, file=output)
+        return Response(output.getvalue(), mimetype='text/plain')
+    # The same format as written by `tracemalloc.Snapshot.dump` -- readable by `tracemalloc.Snapshot.load`
+    return Response(
+        pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL),
+        mimetype='application/octet-stream',
+        headers={'Content-Disposition': 'attachment; filename=allocations.snapshot'}
+    )
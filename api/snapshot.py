@@ -0,0 +1,243 @@
+import hashlib
+import json
+import sys
+import time
+from decimal import Context, Decimal
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from api.exceptions import UnknownCurrencyException
+
+
+DEFAULT_MINOR_UNITS = 2
+
+
+def _digest(content: Mapping) -> str:
+    return hashlib.blake2b(json.dumps(content, sort_keys=True).encode(), digest_size=10).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _quantizer(minor_units: int) -> Decimal:
+    # One instance shared by all the currencies (and all the snapshots) with the same precision
+    return Decimal(1).scaleb(-minor_units)
+
+
+@lru_cache(maxsize=None)
+def _quantize_context(max_minor_units: int) -> Context:
+    # The default context (28 digits) can't hold e.g. 1e18 BTC to its 8 decimals -- this one holds any amount
+    # a float can represent to the precision of any currency. Bigger amounts signal `InvalidOperation` (`Emax`).
+    max_exponent = sys.float_info.max_10_exp - 1
+    return Context(prec=max_exponent + 1 + max_minor_units, Emax=max_exponent)
+
+
+class RatesSnapshot(NamedTuple):
+    """
+
+    One immutable version of all the currency data -- the supported currencies together with the EUR rates of all
+    of them. A new snapshot is published as a whole (see `CurrencyResource.refresh`), so readers never see
+    a partially updated state and they don't need any locks.
+
+    """
+    version: int
+    # Interned currency codes mapped to their full names
+    supported: Mapping[str, str]
+    # Interned currency codes of the supported currencies (which have a rate) mapped to their ordinal numbers
+    ordinals: Mapping[str, int]
+    # EUR->currency rates of all the currencies
+    rates: Mapping[str, Decimal]
+    # Exponents for `Decimal.quantize` of the converted amounts of all the currencies (according to their precision)
+    quantizers: Mapping[str, Decimal]
+    # Context for `Decimal.quantize` with enough precision for all the quantizers
+    quantize_context: Context
+    # Validators of the supported currencies from the Fixer API (for the conditional requests)
+    e_tag: Optional[str]
+    date: Optional[str]
+    # Timestamp of the rates according to the Fixer API
+    timestamp: Optional[int]
+    # When the snapshot was created (`time.time()`)
+    created: float
+    # Point in time the data are as of -- the timestamp of the rates (or, if the Fixer API didn't send any, when they
+    # were fetched), so unlike the versions counted by each process, it's the same in all the processes (and after
+    # restarts) which fetched the same rates
+    as_of: int
+    # Digests of the supported currencies and of the rates (with the precision of the currencies) -- identify
+    # the data derived from them (e.g. the payloads in the shared cache) the same way in all the processes, unlike
+    # the versions
+    supported_digest: str
+    rates_digest: str
+    # Points in time (`as_of`) at which the individual rates last changed (or were added), at which the currencies
+    # without a rate were removed and at which the supported currencies last changed -- what changed since any point
+    # in time from `history_start` on can be told from them alone
+    changed_at: Mapping[str, int]
+    removed_at: Mapping[str, int]
+    supported_changed_at: int
+    # The first snapshot of the history the changes were tracked in (in this process or in the shared cache) was
+    # as of this point in time -- the changes before it are unknown
+    history_start: int
+
+    @classmethod
+    def create(
+            cls,
+            version: int,
+            supported: Mapping[str, str],
+            rates: Mapping[str, object],
+            e_tag: str = None,
+            date: str = None,
+            timestamp: int = None,
+            created: float = None,
+            minor_units: Mapping[str, int] = None,
+            previous: 'RatesSnapshot' = None,
+            as_of: int = None,
+            changed_at: Mapping[str, int] = None,
+            removed_at: Mapping[str, int] = None,
+            supported_changed_at: int = None,
+            history_start: int = None
+    ) -> 'RatesSnapshot':
+        """
+
+        Creates the snapshot -- with the `previous` one, the history of the changes is carried over and the points in
+        time at which the data changed are kept for everything that is still the same (otherwise they are given or,
+        for a brand new snapshot, all `as_of`).
+
+        """
+        supported = {sys.intern(code): name for code, name in supported.items()}
+        # `Decimal` is created once here, not for every request -- from the string, so a float (e.g. 1.138) gives
+        # the same decimal number as in the JSON it was parsed from, not its binary approximation
+        rates = {sys.intern(code): Decimal(str(rate)) for code, rate in rates.items()}
+        created = time.time() if created is None else created
+        if as_of is None:
+            as_of = timestamp if timestamp is not None else int(created)
+        if previous is not None:
+            # Never back in time and never the same point in time for different data -- the changes would be told wrong
+            if as_of <= previous.as_of:
+                as_of = previous.as_of
+                if rates != previous.rates or supported != previous.supported:
+                    as_of += 1
+            changed_at = {
+                code: previous.changed_at[code] if previous.rates.get(code) == rate else as_of
+                for code, rate in rates.items()
+            }
+            removed_at = {code: at for code, at in previous.removed_at.items() if code not in rates}
+            removed_at.update((code, as_of) for code in previous.rates if code not in rates)
+            supported_changed_at = previous.supported_changed_at if supported == previous.supported else as_of
+            history_start = previous.history_start
+        else:
+            changed_at = changed_at or dict.fromkeys(rates, as_of)
+            removed_at = removed_at or {}
+            supported_changed_at = as_of if supported_changed_at is None else supported_changed_at
+            history_start = as_of if history_start is None else history_start
+        # Only the currencies we have the rates for can be converted
+        convertible = [code for code in supported if code in rates]
+        minor_units = minor_units or {}
+        precisions = {code: minor_units.get(code, DEFAULT_MINOR_UNITS) for code in rates}
+        quantizers = {code: _quantizer(units) for code, units in precisions.items()}
+        return cls(
+            version=version,
+            supported=MappingProxyType(supported),
+            ordinals=MappingProxyType({code: ordinal for ordinal, code in enumerate(convertible)}),
+            rates=MappingProxyType(rates),
+            quantizers=MappingProxyType(quantizers),
+            quantize_context=_quantize_context(max(precisions.values(), default=DEFAULT_MINOR_UNITS)),
+            e_tag=e_tag,
+            date=date,
+            timestamp=timestamp,
+            created=created,
+            as_of=as_of,
+            supported_digest=_digest(supported),
+            rates_digest=_digest({code: (str(rate), str(quantizers[code])) for code, rate in rates.items()}),
+            changed_at=MappingProxyType(changed_at),
+            removed_at=MappingProxyType(removed_at),
+            supported_changed_at=supported_changed_at,
+            history_start=history_start
+        )
+
+    def to_bytes(self) -> bytes:
+        # The rates as strings -- `Decimal` survives the round trip exactly
+        return json.dumps({
+            'version': self.version,
+            'supported': dict(self.supported),
+            'rates': {code: str(rate) for code, rate in self.rates.items()},
+            'e_tag': self.e_tag,
+            'date': self.date,
+            'timestamp': self.timestamp,
+            'created': self.created,
+            'as_of': self.as_of,
+            'changed_at': dict(self.changed_at),
+            'removed_at': dict(self.removed_at),
+            'supported_changed_at': self.supported_changed_at,
+            'history_start': self.history_start
+        }).encode()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, minor_units: Mapping[str, int] = None) -> 'RatesSnapshot':
+        return cls.create(**json.loads(data), minor_units=minor_units)
+
+    def check_currencies(self, *currencies: str):
+        ordinals = self.ordinals
+        for currency in currencies:
+            if currency not in ordinals:
+                raise UnknownCurrencyException(currency)
+
+    def cross_rates(self, input_currency: str, output_currencies: Sequence[str]) -> Dict[str, Decimal]:
+        """
+
+        Computes the input_currency->output_currencies rates. The free plan for Fixer API does not allow changing
+        the base currency, therefore we have only the EUR->currency rates. For example for GBP->CZK we take EUR->GBP
+        and EUR->CZK and compute GBP->CZK as EUR->CZK / EUR->GBP.
+
+        :param input_currency: currency to convert from
+        :param output_currencies: currencies to convert to; empty means all of them
+        :return: rates in the form of {output_currency: rate} (without the input_currency itself)
+
+        """
+        rates = self.rates
+        if len(output_currencies) > 0:
+            self.check_currencies(*output_currencies, input_currency)
+        else:
+            self.check_currencies(input_currency)
+            output_currencies = rates.keys()
+        eur_to_base = rates[input_currency]
+        return {k: rates[k] / eur_to_base for k in output_currencies if k != input_currency}
+
+    def cross_rates_matrix(self, bases: Sequence[str], targets: Sequence[str]) -> Dict[str, Dict[str, Decimal]]:
+        """
+
+        Computes the rates for all the (base, target) pairs.
+
+        :param bases: currencies to convert from
+        :param targets: currencies to convert to
+        :return: rates in the form of {base: {target: rate}}
+
+        """
+        self.check_currencies(*bases, *targets)
+        rates = self.rates
+        eur_to_targets = [(target, rates[target]) for target in targets]
+        return {
+            base: {target: eur_to_target / rates[base] for target, eur_to_target in eur_to_targets}
+            for base in bases
+        }
+
+    def tracks_changes_since(self, as_of: int) -> bool:
+        """
+
+        Tells whether the changes since a point in time can be computed -- it must lie within the history.
+
+        :param as_of: the point in time (`as_of` of an older snapshot, possibly from another process)
+        :return: True if they can
+
+        """
+        return self.history_start <= as_of <= self.as_of
+
+    def changes_since(self, as_of: int) -> Tuple[Dict[str, Decimal], Tuple[str, ...]]:
+        """
+
+        Computes the difference from older data.
+
+        :param as_of: `as_of` of the older data
+        :return: the rates changed (or added) since then and the currencies removed since then
+
+        """
+        rates = self.rates
+        changed = {code: rates[code] for code, at in self.changed_at.items() if at > as_of}
+        return changed, tuple(code for code, at in self.removed_at.items() if at > as_of)
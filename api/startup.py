@@ -0,0 +1,115 @@
+"""
+
+Startup profile of the app -- reports the most expensive imports of the `api` package (measured in a fresh
+interpreter with `-X importtime`) and the duration of the individual steps of `create_app()`.
+
+Usage: `python -m api.startup [--top N] [--check] [--budget-ms MS]`
+
+With `--check` the script exits with a non-zero code if the import of `api` pulls in any of the heavy dependencies
+which should be imported lazily, or if the whole startup takes longer than the budget.
+
+"""
+import argparse
+import subprocess
+import sys
+from typing import Dict, List, NamedTuple, Sequence
+
+# Dependencies which must not be imported just by importing the package or creating the app
+LAZY_MODULES = ('sentry_sdk', 'requests', 'brotli', 'redis')
+
+
+class ImportTime(NamedTuple):
+    module: str
+    depth: int
+    self_us: int
+    cumulative_us: int
+
+
+class StartupProfile(NamedTuple):
+    imports: List[ImportTime]
+    create_app: Dict[str, float]
+    eagerly_imported: List[str]
+
+    @property
+    def import_us(self) -> int:
+        return sum(i.cumulative_us for i in self.imports if i.depth == 0)
+
+    @property
+    def total_ms(self) -> float:
+        return self.import_us / 1000 + sum(self.create_app.values()) * 1000
+
+
+_PROBE = '''
+import json, sys
+import api
+app = api.create_app()
+print(json.dumps({
+    'create_app': app.extensions['startup_profile'],
+    'eagerly_imported': [m for m in %r if m in sys.modules]
+}))
+'''
+
+
+def _parse_importtime(stderr: str) -> List[ImportTime]:
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level in the `-X importtime` output
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append(ImportTime(module.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def profile_startup() -> StartupProfile:
+    """
+
+    Imports the package and creates the app in a fresh interpreter (so already imported modules do not skew
+    the results) and collects the timings.
+
+    :return: the startup profile
+
+    """
+    import json
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PROBE % (LAZY_MODULES,)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    result = json.loads(process.stdout.splitlines()[-1])
+    return StartupProfile(_parse_importtime(process.stderr), result['create_app'], result['eagerly_imported'])
+
+
+def _report(profile: StartupProfile, top: int):
+    print(f'Slowest imports (cumulative, top {top}):')
+    for i in sorted(profile.imports, key=lambda i: i.cumulative_us, reverse=True)[:top]:
+        print(f'  {i.cumulative_us / 1000:9.2f} ms  {i.module}')
+    print(f'Imports total: {profile.import_us / 1000:.2f} ms')
+    print('create_app():')
+    for step, duration in profile.create_app.items():
+        print(f'  {duration * 1000:9.2f} ms  {step}')
+    print(f'Startup total: {profile.total_ms:.2f} ms')
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Startup profile of the currency converter API.')
+    parser.add_argument('--top', type=int, default=15, help='number of the slowest imports to show')
+    parser.add_argument('--check', action='store_true', help='fail on eager heavy imports or exceeded budget')
+    parser.add_argument('--budget-ms', type=float, default=1500, help='maximal duration of the whole startup')
+    args = parser.parse_args(argv)
+
+    profile = profile_startup()
+    _report(profile, args.top)
+    if not args.check:
+        return 0
+    if profile.eagerly_imported:
+        print(f'FAIL: eagerly imported {", ".join(profile.eagerly_imported)}')
+        return 1
+    if profile.total_ms > args.budget_ms:
+        print(f'FAIL: startup took {profile.total_ms:.2f} ms (budget {args.budget_ms:.2f} ms)')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
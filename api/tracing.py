@@ -0,0 +1,310 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from logging.handlers import QueueListener
+from typing import Any, Dict, List, Optional
+
+from flask import Flask, current_app as app
+
+from api.logs import DroppingQueueHandler
+
+
+# `app.logger` of Flask -- the exporter is flushed at exit, without any app context
+logger = logging.getLogger('flask.app')
+# Trace of the request being processed by the current thread (greenlet with gevent) -- a plain attribute, unlike
+# `g` behind its proxy, so the spans of the requests which are not sampled cost next to nothing
+_current = threading.local()
+
+
+class Span:
+    """
+
+    Timed stage of the request processing. Used as a context manager, nested spans get the enclosing one as parent.
+
+    """
+    __slots__ = ('trace', 'name', 'parent', 'start', 'end', 'attributes')
+
+    def __init__(self, trace: 'Trace', name: str, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.parent = None
+        self.start = None
+        self.end = None
+        self.attributes = attributes
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def __enter__(self) -> 'Span':
+        self.parent = self.trace.current
+        self.trace.current = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = time.perf_counter()
+        self.trace.current = self.parent
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class _NoopSpan:
+    """
+
+    Span of the requests which are not sampled -- one shared instance which does nothing at all.
+
+    """
+    __slots__ = ()
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """
+
+    All spans recorded during processing of one request.
+
+    """
+
+    def __init__(self, name: str, exported: bool = True, debug: bool = False):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        # Traces which were not sampled are recorded only for the debug section of the response (`debug=1`)
+        self.exported = exported
+        self.debug = debug
+        # Wall clock time for the exporters, performance counter for the durations
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.current: Optional[Span] = None
+        self.spans: List[Span] = []
+
+    def span(self, name: str, **attributes: Any) -> Span:
+        span = Span(self, name, attributes)
+        self.spans.append(span)
+        return span
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def to_wall_clock(self, counter: float) -> float:
+        return self.timestamp + (counter - self.start)
+
+    def spans_to_dicts(self) -> List[Dict[str, Any]]:
+        # Only the finished spans -- the trace can be still in progress
+        span_ids = {id(span): i for i, span in enumerate(self.spans)}
+        return [
+            {
+                'id': i,
+                'parent': span_ids.get(id(span.parent)),
+                'name': span.name,
+                'offset_ms': (span.start - self.start) * 1000,
+                'duration_ms': span.duration * 1000,
+                'attributes': span.attributes
+            }
+            for i, span in enumerate(self.spans) if span.end is not None
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'timestamp': self.timestamp,
+            'duration_ms': (self.end - self.start) * 1000,
+            'spans': self.spans_to_dicts()
+        }
+
+
+# ---------------------------------------------------- Exporters ------------------------------------------------------
+
+
+class TraceFormatter(logging.Formatter):
+    """
+
+    Serializes the trace carried by the record (as its `msg`) to one JSON line -- in the writer thread.
+
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, default=str)
+
+
+class FileExporter:
+    """
+
+    Appends the traces as JSON lines to a local file for offline analysis. The requests only hand the traces over
+    to a queue the same way as the log records (see `api/logs.py`), a `QueueListener` thread serializes and writes
+    them. When the queue is full (the disk can't keep up), the traces are dropped and counted instead of blocking
+    the request -- every written trace carries the number of the traces dropped so far, so the gaps are visible.
+
+    """
+    MAX_QUEUED = 10000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._handler: Optional[DroppingQueueHandler] = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Drops already logged by `flush`
+        self._reported = 0
+        # Writes out what's left in the queue
+        atexit.register(self.flush)
+
+    @property
+    def dropped(self) -> int:
+        return self._handler.dropped if self._handler is not None else 0
+
+    def _queue_handler(self) -> DroppingQueueHandler:
+        # The writer is started by the first export in each process -- with the preloaded app a thread started in
+        # the master wouldn't survive the fork (see `api/gunicorn_config.py`)
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    output = logging.FileHandler(self.path, delay=True)
+                    output.setFormatter(TraceFormatter())
+                    handler = DroppingQueueHandler(queue.Queue(self.MAX_QUEUED))
+                    QueueListener(handler.queue, output).start()
+                    self._handler = handler
+                    self._reported = 0
+                    self._pid = pid
+        return self._handler
+
+    def export(self, trace: Trace):
+        handler = self._queue_handler()
+        entry = trace.to_dict()
+        entry['dropped'] = handler.dropped
+        # Queued as it is -- unlike `handle`, `enqueue` doesn't format the record in the request thread
+        handler.enqueue(logging.makeLogRecord({'msg': entry}))
+
+    def flush(self, timeout: float = 5.0):
+        """
+
+        Waits until all the traces queued by this process are written (but at most `timeout` seconds).
+
+        """
+        handler = self._handler
+        if handler is not None and self._pid == os.getpid():
+            traces = handler.queue
+            with traces.all_tasks_done:
+                traces.all_tasks_done.wait_for(lambda: not traces.unfinished_tasks, timeout)
+            dropped, self._reported = handler.dropped - self._reported, handler.dropped
+            if dropped:
+                logger.warning(f'{dropped} traces were dropped, the writing to {self.path} couldn\'t keep up')
+
+
+class SentryExporter:
+    """
+
+    Sends the traces to Sentry as transactions with the spans as their children (requires `SENTRY_DSN`).
+
+    """
+
+    def export(self, trace: Trace):
+        import sentry_sdk
+        transaction = sentry_sdk.start_transaction(
+            name=trace.name, op='http.server', sampled=True, start_timestamp=trace.timestamp
+        )
+        sentry_spans = {}
+        for span in trace.spans:
+            if span.end is None:
+                continue
+            parent = sentry_spans.get(id(span.parent), transaction)
+            sentry_span = parent.start_child(op=span.name, start_timestamp=trace.to_wall_clock(span.start))
+            for key, value in span.attributes.items():
+                sentry_span.set_data(key, value)
+            sentry_span.finish(end_timestamp=trace.to_wall_clock(span.end))
+            sentry_spans[id(span)] = sentry_span
+        transaction.finish(end_timestamp=trace.to_wall_clock(trace.end))
+
+
+EXPORTERS = {
+    'file': lambda config: FileExporter(config['TRACING_FILE']),
+    'sentry': lambda config: SentryExporter()
+}
+
+
+# ------------------------------------------------------- API ---------------------------------------------------------
+
+
+def init_tracing(app: Flask):
+    exporter = app.config['TRACING_EXPORTER']
+    if exporter not in EXPORTERS:
+        raise ValueError(f'Invalid TRACING_EXPORTER configuration: {exporter}!')
+    app.extensions['tracing_exporter'] = EXPORTERS[exporter](app.config)
+
+
+def start_trace(name: str, debug: bool = False):
+    """
+
+    Starts recording of the current request if it gets sampled (see `TRACING_SAMPLE_RATE`) or if it's needed for
+    the debug section of the response.
+
+    :param name: name of the trace (e.g. the endpoint)
+    :param debug: whether the request asked for the debug section
+
+    """
+    sample_rate = app.config['TRACING_SAMPLE_RATE']
+    sampled = bool(sample_rate) and random.random() < sample_rate
+    # Always set -- the thread may still hold the trace of a previous request which failed before `finish_trace`
+    _current.trace = Trace(name, exported=sampled, debug=debug) if sampled or debug else None
+
+
+def debug_trace() -> Optional[Trace]:
+    """
+
+    :return: the trace of the current request if it asked for the debug section, otherwise None
+
+    """
+    trace = getattr(_current, 'trace', None)
+    return trace if trace is not None and trace.debug else None
+
+
+def span(name: str, **attributes: Any):
+    """
+
+    Creates a span in the trace of the current request. If the request is not sampled, a no-op span is returned,
+    so the instrumented code costs just this call.
+
+    :param name: name of the stage
+    :param attributes: initial attributes of the span
+    :return: the span (to be used as a context manager)
+
+    """
+    trace = getattr(_current, 'trace', None)
+    if trace is None:
+        return NOOP_SPAN
+    return trace.span(name, **attributes)
+
+
+def finish_trace():
+    trace = getattr(_current, 'trace', None)
+    _current.trace = None
+    if trace is None or not trace.exported:
+        return
+    trace.finish()
+    try:
+        app.extensions['tracing_exporter'].export(trace)
+    except Exception as e:
+        # Tracing must never break the request itself
+        app.logger.error(f'Could not export the trace {trace.trace_id}: {e}')
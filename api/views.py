@@ -1,100 +1,331 @@
-from typing import List
+import html
+import json
+from decimal import ROUND_HALF_UP
+from typing import Iterable, Optional, Tuple
 
-from flask import Blueprint, request, jsonify, current_app as app
+from flask import Blueprint, Response, request, jsonify, current_app as app
+from flask.blueprints import BlueprintSetupState
 
+from api.cache import LRUCache
+from api.compression import PayloadCache, compress_response
 from api.exceptions import FixerApiException, UnknownSymbolException, \
-    UnknownCurrencyException, InvalidAmountException, CustomException
+    UnknownCurrencyException, InvalidAmountException, InvalidParameterException, TooManyRequestsException, \
+    CustomException
+from api.limits import admit_request, release_request
 from api.converter import CurrencyConverter
 from api.currencies import CurrencyResource
+from api.parser import ConversionRequest, MatrixRequest, RequestParser
+from api.snapshot import RatesSnapshot
+from api.tracing import Trace, debug_trace, finish_trace, span, start_trace
 
 
 currency_converter_bp = Blueprint('currency_converter', __name__)
+# Responses which change only with the currency data (not per request) -- serialized and compressed only once
+payloads = PayloadCache()
+# Negative cache -- the invalid requests (by their endpoint and query string) mapped to the prebuilt bodies of their
+# error responses. Invalid inputs tend to repeat (typos, broken or abusive clients) and the repeated ones are rejected
+# before being parsed at all. Cleared with every new snapshot (e.g. an unknown currency may become supported).
+rejections = LRUCache(1024)
+# Longer query strings are not kept -- the cache would take too much memory
+MAX_REJECTION_KEY = 1024
+# Parser of the query parameters -- a module attribute (set by `_init_parser`), so the requests don't resolve it through
+# the `current_app` proxy
+request_parser: Optional[RequestParser] = None
+# Endpoints doing the (CPU-bound) conversions -- each request takes one of the `MAX_CONCURRENT_CONVERSIONS` slots
+CONVERSION_ENDPOINTS = frozenset({'currency_converter.convert', 'currency_converter.convert_matrix'})
 
 
 # ------------------------------------------------------ Helpers ------------------------------------------------------
 
 
-def _translate_symbol(symbol: str) -> str:
-    if len(symbol) != 1:
-        return symbol.upper()
-    translated = app.config['CURRENCY_SYMBOLS'].get(symbol)
-    if translated is None:
-        raise UnknownSymbolException(symbol)
-    return translated.upper()
+@currency_converter_bp.record_once
+def _init_parser(state: BlueprintSetupState):
+    global request_parser
+    config = state.app.config
+    request_parser = RequestParser(
+        config['CURRENCY_SYMBOLS'], config['MATRIX_MAX_CURRENCIES'], config['MATRIX_MAX_AMOUNTS']
+    )
 
 
-def _get_amount() -> float:
-    amount = request.args.get('amount', default=1.0, type=str)
-    try:
-        return float(amount)
-    except ValueError:
-        raise InvalidAmountException(amount)
+def _conversion_body(amount: float, input_currency: str, result: dict) -> dict:
+    return {
+        'input': {
+            'amount': amount,
+            'currency': input_currency
+        },
+        'output': result
+    }
+
+
+def _debug_section(trace: Trace, currencies: Iterable[str]) -> dict:
+    # Built only for the requests with `debug=1` -- everything needed to reconstruct the conversion afterwards
+    snapshot = CurrencyResource.get_snapshot()
+    return {
+        'trace_id': trace.trace_id,
+        'snapshot': {
+            'version': snapshot.version,
+            'date': snapshot.date,
+            'timestamp': snapshot.timestamp,
+            'created': snapshot.created
+        },
+        # Exact EUR->currency rates the cross rates were computed from
+        'eur_rates': {code: str(snapshot.rates[code]) for code in currencies if code in snapshot.rates},
+        'stages': trace.spans_to_dicts()
+    }
+
+
+def _precompress(snapshot: RatesSnapshot, previous: Optional[RatesSnapshot]):
+    # Called whenever a new snapshot is published -- the payloads which change only with the snapshot are
+    # serialized and compressed right away, not by the first request. Those whose data didn't change since
+    # the previous snapshot (e.g. the supported currencies) are kept as they are.
+    payloads.get('supported', snapshot.supported_digest, lambda: dict(snapshot.supported))
+    for base in app.config['PRECOMPRESSED_BASES']:
+        if base in snapshot.ordinals:
+            payloads.get(('convert', base), snapshot.rates_digest, lambda: _conversion_body(
+                1.0, base, CurrencyConverter.convert_rates(
+                    1.0, snapshot.cross_rates(base, ()), snapshot.quantizers, snapshot.quantize_context
+                )
+            ))
+
+
+def _forget_rejections(snapshot: RatesSnapshot, previous: Optional[RatesSnapshot]):
+    rejections.clear()
+
+
+@currency_converter_bp.record_once
+def _register_listeners(state: BlueprintSetupState):
+    for listener in (_precompress, _forget_rejections):
+        if listener not in CurrencyResource.listeners:
+            CurrencyResource.listeners.append(listener)
+
 
+def _parse_request() -> ConversionRequest:
+    with span('parse') as s:
+        parsed = request_parser.parse(request.args)
+        s.set('output_count', len(parsed.output_currencies))
+    return parsed
 
-def _get_input_currency() -> str:
-    input_currency = request.args.get('input_currency', default='CZK', type=str)
-    return _translate_symbol(input_currency)
 
+def _parse_matrix_request() -> MatrixRequest:
+    with span('parse') as s:
+        parsed = request_parser.parse_matrix(request.args)
+        s.set('output_count', len(parsed.amounts) * len(parsed.bases) * len(parsed.targets))
+    return parsed
 
-def _get_output_currency() -> List[str]:
-    output_currency = request.args.get('output_currency', default='', type=str)
-    if not output_currency:
-        return []
-    output_currency = output_currency.split(',')
-    return list(map(_translate_symbol, output_currency))
+
+def _check_currencies(*currencies: str):
+    # Against the published snapshot as it is -- unlike `get_snapshot()`, an invalid request never triggers
+    # a refresh (and so a call to the Fixer API); before the first snapshot the conversion itself checks them
+    snapshot = CurrencyResource.snapshot
+    if snapshot is not None:
+        snapshot.check_currencies(*currencies)
 
 
 # ----------------------------------------------- Error handlers ------------------------------------------------------
 
-def _warning(e: CustomException) -> (str, int):
-    app.logger.warning(e.logger_msg)
-    return '<h1>Bad request</h1>' + e.display_msg, 400
+ERROR_TITLES = {400: 'Bad request', 429: 'Too many requests', 500: 'Internal server error'}
+
+
+def _error_bodies(status: int, display_msg: str) -> Tuple[bytes, bytes]:
+    return (
+        # The message may contain the invalid input itself
+        f'<h1>{ERROR_TITLES[status]}</h1>{html.escape(display_msg, quote=False)}'.encode(),
+        json.dumps({'error': {'status': status, 'message': display_msg}}).encode()
+    )
+
+
+def _error_response(e: CustomException, status: int) -> Response:
+    return _negotiated_response(status, *_error_bodies(status, e.display_msg))
+
 
+def _negotiated_response(status: int, html_body: bytes, json_body: bytes) -> Response:
+    # HTML unless the client prefers JSON
+    accept = request.accept_mimetypes
+    if accept and accept.best_match(('text/html', 'application/json')) == 'application/json':
+        response = Response(json_body, status, mimetype='application/json')
+    else:
+        response = Response(html_body, status, mimetype='text/html')
+    response.vary.add('Accept')
+    return response
 
-def _error(e: CustomException) -> (str, int):
-    app.logger.error(e.logger_msg)
-    return '<h1>Internal server error</h1>' + e.display_msg, 500
+
+def _log_fields(e: CustomException, status: int) -> dict:
+    # Structured fields of the log record (see `api/logs.py`) -- `event` is also what the sampling is based on
+    return {'event': type(e).__name__, 'path': request.path, 'status': status}
+
+
+def _warning(e: CustomException) -> Response:
+    app.logger.warning(e.logger_msg, extra=_log_fields(e, 400))
+    bodies = _error_bodies(400, e.display_msg)
+    query = request.query_string
+    if len(query) <= MAX_REJECTION_KEY:
+        rejections.set((request.endpoint, query), bodies)
+    return _negotiated_response(400, *bodies)
+
+
+def _error(e: CustomException) -> Response:
+    app.logger.error(e.logger_msg, extra=_log_fields(e, 500))
+    return _error_response(e, 500)
 
 
 @currency_converter_bp.errorhandler(FixerApiException)
-def handle_fixer_api_exception(e: FixerApiException) -> (str, int):
+def handle_fixer_api_exception(e: FixerApiException) -> Response:
     return _error(e)
 
 
 @currency_converter_bp.errorhandler(UnknownSymbolException)
-def handle_unknown_symbol_exception(e: UnknownSymbolException) -> (str, int):
+def handle_unknown_symbol_exception(e: UnknownSymbolException) -> Response:
     return _warning(e)
 
 
 @currency_converter_bp.errorhandler(UnknownCurrencyException)
-def handle_unknown_currency_exception(e: UnknownCurrencyException) -> (str, int):
+def handle_unknown_currency_exception(e: UnknownCurrencyException) -> Response:
     return _warning(e)
 
 
 @currency_converter_bp.errorhandler(InvalidAmountException)
-def handle_invalid_amount_exception(e: InvalidAmountException) -> (str, int):
+def handle_invalid_amount_exception(e: InvalidAmountException) -> Response:
+    return _warning(e)
+
+
+@currency_converter_bp.errorhandler(InvalidParameterException)
+def handle_invalid_parameter_exception(e: InvalidParameterException) -> Response:
     return _warning(e)
 
 
+@currency_converter_bp.errorhandler(TooManyRequestsException)
+def handle_too_many_requests_exception(e: TooManyRequestsException) -> Response:
+    # Not a warning -- under overload there are many of them and they are expected
+    app.logger.info(e.logger_msg, extra=_log_fields(e, 429))
+    response = _error_response(e, 429)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+# -------------------------------------------------- Hooks ------------------------------------------------------------
+
+
+@currency_converter_bp.before_request
+def trace():
+    start_trace(request.endpoint, debug=request_parser.parse_debug(request.args))
+
+
+@currency_converter_bp.before_request
+def admit():
+    with span('admit'):
+        admit_request(limit_concurrency=request.endpoint in CONVERSION_ENDPOINTS)
+
+
+@currency_converter_bp.before_request
+def reject():
+    # The same invalid request gets the same response (until the next snapshot) -- without the parsing, the exception
+    # and its logging (the access record is still written)
+    key = (request.endpoint, request.query_string)
+    if key in rejections:
+        bodies = rejections.get(key)
+        if bodies is not None:
+            return _negotiated_response(400, *bodies)
+
+
+@currency_converter_bp.teardown_request
+def release(e: Optional[BaseException]):
+    release_request()
+
+
+# The `after_request` functions are called in the reverse order of their registration -- the trace is exported
+# after everything else is done
+@currency_converter_bp.after_request
+def export_trace(response: Response) -> Response:
+    finish_trace()
+    return response
+
+
+@currency_converter_bp.after_request
+def release_slot(response: Response) -> Response:
+    release_request()
+    return response
+
+
+@currency_converter_bp.after_request
+def compress(response: Response) -> Response:
+    with span('compress'):
+        return compress_response(response)
+
+
 # -------------------------------------------------- Routes -----------------------------------------------------------
 
 
 @currency_converter_bp.route('/supported_currencies', methods=['GET'])
-def supported_currencies() -> (str, int):
-    result = CurrencyResource.get_supported_currencies()
-    return jsonify(result), 200
+def supported_currencies() -> Response:
+    snapshot = CurrencyResource.get_snapshot()
+    with span('serialize'):
+        return payloads.get('supported', snapshot.supported_digest, lambda: dict(snapshot.supported)).to_response()
 
 
 @currency_converter_bp.route('/currency_converter', methods=['GET'])
 def convert() -> (str, int):
-    amount = _get_amount()
-    input_currency = _get_input_currency()
-    output_currency = _get_output_currency()
-    result = CurrencyConverter.convert(amount, input_currency, output_currency)
-    return jsonify({
-        'input': {
-            'amount': amount,
-            'currency': input_currency
-        },
-        'output': result
-    }), 200
+    amount, input_currency, output_currency, rounding = _parse_request()
+    _check_currencies(input_currency, *output_currency)
+    debug = debug_trace()
+    if (
+            debug is None
+            and not output_currency
+            and amount == 1.0
+            and rounding == ROUND_HALF_UP
+            and input_currency in app.config['PRECOMPRESSED_BASES']
+    ):
+        # Conversions to all the currencies change with any of the rates
+        version = CurrencyResource.get_snapshot().rates_digest
+        payload = payloads.get(
+            ('convert', input_currency),
+            version,
+            lambda: _conversion_body(amount, input_currency, CurrencyConverter.convert(amount, input_currency, ()))
+        )
+        return payload.to_response()
+    result = CurrencyConverter.convert(amount, input_currency, output_currency, rounding)
+    body = _conversion_body(amount, input_currency, result)
+    if debug is not None:
+        body['debug'] = _debug_section(debug, (input_currency, *result))
+    with span('serialize', output_count=len(result)):
+        return jsonify(body), 200
+
+
+@currency_converter_bp.route('/currency_matrix', methods=['GET'])
+def convert_matrix() -> (str, int):
+    bases, targets, amounts, rounding = _parse_matrix_request()
+    _check_currencies(*bases, *targets)
+    result = CurrencyConverter.convert_matrix(amounts, bases, targets, rounding)
+    body = {
+        'bases': bases,
+        'targets': targets,
+        'output': [{'amount': amount, 'matrix': matrix} for amount, matrix in zip(amounts, result)]
+    }
+    debug = debug_trace()
+    if debug is not None:
+        body['debug'] = _debug_section(debug, dict.fromkeys((*bases, *targets)))
+    with span('serialize', output_count=len(amounts) * len(bases) * len(targets)):
+        return jsonify(body), 200
+
+
+@currency_converter_bp.route('/rates_changes', methods=['GET'])
+def rates_changes() -> (str, int):
+    since = request_parser.parse_since(request.args)
+    snapshot = CurrencyResource.get_snapshot()
+    # The client's data are older than the history of this process (or newer, when another process has already
+    # fetched newer ones) -- it gets everything, not a diff
+    full = not snapshot.tracks_changes_since(since)
+    if full:
+        changed, removed = snapshot.rates, ()
+    else:
+        changed, removed = snapshot.changes_since(since)
+    body = {
+        'since': since,
+        'as_of': snapshot.as_of,
+        'full': full,
+        'rates': {code: str(rate) for code, rate in changed.items()},
+        'removed': removed
+    }
+    if full or snapshot.supported_changed_at > since:
+        body['supported'] = dict(snapshot.supported)
+    with span('serialize', output_count=len(changed)):
+        return jsonify(body), 200
@@ -0,0 +1,124 @@
+"""
+
+Compares the per-request CPU time of the request parsing and validation path in `api/views.py` with the original
+one (three `request.args.get` calls, symbol translation through the config and `_check_currencies` loop).
+
+Run from the root of the repository: `python -m benchmarks.bench_parser`
+
+"""
+import os
+import timeit
+from typing import List
+
+os.environ.setdefault('FLASK_ENV', 'testing')
+os.environ.setdefault('FIXER_API_KEY', 'benchmark')
+
+from flask import request, current_app as app  # noqa: E402
+
+from api import create_app  # noqa: E402
+from api.currencies import CurrencyResource  # noqa: E402
+from api.exceptions import InvalidAmountException, UnknownCurrencyException, UnknownSymbolException  # noqa: E402
+from api.snapshot import RatesSnapshot  # noqa: E402
+from api import views  # noqa: E402
+
+
+QUERIES = [
+    'amount=240.16&input_currency=GBP&output_currency=USD,CZK,€,¥',
+    'amount=10&input_currency=£&output_currency=€,₱,¥,EUR,EUR',
+    'input_currency=usd',
+    '',
+    'amount=1.5&input_currency=EUR&output_currency=CZK,RUB,PLN,HUF,GBP,USD,JPY,CHF,SEK,NOK',
+]
+SUPPORTED = {code: code for code in (
+    'CZK', 'EUR', 'USD', 'GBP', 'JPY', 'PHP', 'RUB', 'PLN', 'HUF', 'CHF', 'SEK', 'NOK', 'BTC', 'INR', 'CNY'
+)}
+
+
+# ------------------------------------------------ Original path ------------------------------------------------------
+
+
+def _translate_symbol(symbol: str) -> str:
+    if len(symbol) != 1:
+        return symbol.upper()
+    translated = app.config['CURRENCY_SYMBOLS'].get(symbol)
+    if translated is None:
+        raise UnknownSymbolException(symbol)
+    return translated.upper()
+
+
+def _get_amount() -> float:
+    amount = request.args.get('amount', default=1.0, type=str)
+    try:
+        return float(amount)
+    except ValueError:
+        raise InvalidAmountException(amount)
+
+
+def _get_input_currency() -> str:
+    input_currency = request.args.get('input_currency', default='CZK', type=str)
+    return _translate_symbol(input_currency)
+
+
+def _get_output_currency() -> List[str]:
+    output_currency = request.args.get('output_currency', default='', type=str)
+    if not output_currency:
+        return []
+    output_currency = output_currency.split(',')
+    return list(map(_translate_symbol, output_currency))
+
+
+def _check_currencies(*currencies: str):
+    supported = SUPPORTED
+    for currency in currencies:
+        if currency not in supported.keys():
+            raise UnknownCurrencyException(currency)
+
+
+def original_path():
+    amount = _get_amount()
+    input_currency = _get_input_currency()
+    output_currency = _get_output_currency()
+    if len(output_currency) > 0:
+        output_currency.append(input_currency)
+    else:
+        _check_currencies(input_currency)
+    _check_currencies(*output_currency)
+    return amount, input_currency, output_currency
+
+
+# -------------------------------------------------- New path ---------------------------------------------------------
+
+
+def new_path():
+    # The very functions the view calls
+    amount, input_currency, output_currency, _ = views._parse_request()
+    views._check_currencies(input_currency, *output_currency)
+    return amount, input_currency, output_currency
+
+
+# ---------------------------------------------------- Main -----------------------------------------------------------
+
+
+def _measure(app, path, number: int) -> float:
+    total = 0.0
+    for query in QUERIES:
+        with app.test_request_context(f'/currency_converter?{query}'):
+            # The request arguments are parsed lazily -- do it before measuring, it is the same for both paths
+            request.args
+            total += min(timeit.repeat(path, number=number, repeat=5)) / number
+    return total / len(QUERIES)
+
+
+def main(number: int = 20000):
+    app = create_app()
+    with app.app_context():
+        CurrencyResource.snapshot = RatesSnapshot.create(1, SUPPORTED, {code: 1 for code in SUPPORTED})
+        original = _measure(app, original_path, number)
+        new = _measure(app, new_path, number)
+    print(f'original path: {original * 1e6:8.2f} us/request')
+    print(f'new path:      {new * 1e6:8.2f} us/request')
+    print(f'reduction:     {(1 - new / original) * 100:8.1f} %')
+
+
+if __name__ == '__main__':
+    main()
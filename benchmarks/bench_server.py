@@ -0,0 +1,158 @@
+"""
+
+Validates the gunicorn worker profiles (see `api/gunicorn_config.py`) -- starts the server with each of them against
+a local Fixer stand-in, replays the same trace over HTTP and compares the throughput and the latencies.
+
+Run from the root of the repository (requires gunicorn; the `gevent` profile also gevent, which is not
+in `requirements.txt` -- without it the profile is reported as skipped):
+`python -m benchmarks.bench_server [--trace trace.gz] [--profiles sync,gthread,gevent] [--concurrency 32]
+[--fixer-latency 0.2] [--min-rps 100] [-o results.json]`
+
+Without `--trace` a synthetic one (a mix of all the endpoints) is used. Fails if the server of any profile doesn't
+start, drops requests, responds with a server error or (with `--min-rps`) is too slow.
+
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+from benchmarks.fixer_stub import CURRENCIES, FixerStub
+from benchmarks.replay import TraceEntry, _http_sender, load_trace, replay
+
+
+PROFILES = ('sync', 'gthread', 'gevent')
+# Optional packages the worker classes of the profiles need
+PROFILE_PACKAGES = {'gevent': 'gevent'}
+
+
+def synthetic_trace(requests: int, seed: int = 0) -> List[TraceEntry]:
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(requests):
+        kind = rng.random()
+        if kind < 0.5:
+            outputs = ','.join(rng.sample(CURRENCIES, rng.randint(1, 5)))
+            paths.append(f'/currency_converter?amount={rng.randint(1, 1000)}&input_currency={rng.choice(CURRENCIES)}'
+                         f'&output_currency={outputs}')
+        elif kind < 0.75:
+            # Full-output conversions -- the most expensive requests
+            paths.append(f'/currency_converter?amount={rng.randint(1, 1000)}&input_currency={rng.choice(CURRENCIES)}')
+        elif kind < 0.9:
+            paths.append(f'/currency_matrix?bases={",".join(rng.sample(CURRENCIES, 5))}&amounts=1,10')
+        else:
+            paths.append('/supported_currencies')
+    return [TraceEntry(0.0, path) for path in paths]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_ready(port: int, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The server exited with code {process.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/supported_currencies')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start in time')
+
+
+def missing_package(profile: str) -> Optional[str]:
+    package = PROFILE_PACKAGES.get(profile)
+    return package if package is not None and importlib.util.find_spec(package) is None else None
+
+
+def run_profile(profile: str, entries: Sequence[TraceEntry], stub: FixerStub, concurrency: int) -> Dict:
+    port = _free_port()
+    env = {
+        **os.environ,
+        'FLASK_ENV': 'production',
+        'FIXER_API_KEY': os.getenv('FIXER_API_KEY', 'benchmark'),
+        'FIXER_LATEST_URL': f'{stub.url}/latest',
+        'FIXER_SUPPORTED_URL': f'{stub.url}/symbols',
+        'GUNICORN_PROFILE': profile,
+        'GUNICORN_BIND': f'127.0.0.1:{port}'
+    }
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'api/gunicorn_config.py', 'api:create_app()'], env=env
+    )
+    try:
+        _wait_until_ready(port, process)
+        send, close = _http_sender(f'http://127.0.0.1:{port}')
+        try:
+            return replay(entries, send, 0, concurrency)
+        finally:
+            close()
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def check(profile: str, report: Dict, min_rps: float = None) -> List[str]:
+    errors = []
+    failed = sum(count for status, count in report['statuses'].items() if status == '0' or status.startswith('5'))
+    if failed:
+        errors.append(f'{profile}: {failed} requests failed')
+    if min_rps is not None and report['throughput_rps'] < min_rps:
+        errors.append(f'{profile}: {report["throughput_rps"]:.1f} requests/s is below {min_rps}')
+    return errors
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks the gunicorn worker profiles.')
+    parser.add_argument('--trace', help='trace recorded by `benchmarks.replay record`; synthetic if not given')
+    parser.add_argument('--requests', type=int, default=5000, help='size of the synthetic trace')
+    parser.add_argument('--profiles', default=','.join(PROFILES))
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--fixer-latency', type=float, default=0.0, help='delay (in seconds) of the Fixer stand-in')
+    parser.add_argument('--min-rps', type=float, help='fail if any profile is slower')
+    parser.add_argument('-o', '--output', help='where to store the reports (JSON)')
+    args = parser.parse_args(argv)
+
+    entries = load_trace(args.trace) if args.trace else synthetic_trace(args.requests)
+    reports, errors = {}, []
+    with FixerStub(latency=args.fixer_latency) as stub:
+        for profile in args.profiles.split(','):
+            package = missing_package(profile)
+            if package is not None:
+                print(f'{profile}: skipped, the `{package}` package is not installed', file=sys.stderr)
+                continue
+            try:
+                reports[profile] = run_profile(profile, entries, stub, args.concurrency)
+            except RuntimeError as e:
+                # The other profiles are still run and reported
+                errors.append(f'{profile}: {e}')
+                continue
+            errors.extend(check(profile, reports[profile], args.min_rps))
+
+    print(f'{"profile":10} {"req/s":>10} {"p50 ms":>10} {"p99 ms":>10} {"max ms":>10}')
+    for profile, report in reports.items():
+        latency = report['latency_ms']
+        print(f'{profile:10} {report["throughput_rps"]:10.1f} {latency["p50"]:10.2f} {latency["p99"]:10.2f} '
+              f'{latency["max"]:10.2f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+    for error in errors:
+        print(error, file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+
+Local stand-in of the Fixer API for benchmarks and load tests -- serves `/api/latest` and `/api/symbols` with
+deterministic rates for all the currencies the real API supports (including the ETag handling of the symbols).
+
+Run from the root of the repository: `python -m benchmarks.fixer_stub [--port PORT]` and point the app to it with
+the `FIXER_LATEST_URL` and `FIXER_SUPPORTED_URL` environment variables.
+
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlsplit
+
+
+CURRENCIES = (
+    'AED AFN ALL AMD ANG AOA ARS AUD AWG AZN BAM BBD BDT BGN BHD BIF BMD BND BOB BRL BSD BTC BTN BWP BYN BYR BZD '
+    'CAD CDF CHF CLF CLP CNY COP CRC CUC CUP CVE CZK DJF DKK DOP DZD EGP ERN ETB EUR FJD FKP GBP GEL GGP GHS GIP '
+    'GMD GNF GTQ GYD HKD HNL HRK HTG HUF IDR ILS IMP INR IQD IRR ISK JEP JMD JOD JPY KES KGS KHR KMF KPW KRW KWD '
+    'KYD KZT LAK LBP LKR LRD LSL LTL LVL LYD MAD MDL MGA MKD MMK MNT MOP MRO MUR MVR MWK MXN MYR MZN NAD NGN NIO '
+    'NOK NPR NZD OMR PAB PEN PGK PHP PKR PLN PYG QAR RON RSD RUB RWF SAR SBD SCR SDG SEK SGD SHP SLL SOS SRD STD '
+    'SVC SYP SZL THB TJS TMT TND TOP TRY TTD TWD TZS UAH UGX USD UYU UZS VEF VND VUV WST XAF XAG XAU XCD XDR XOF '
+    'XPF YER ZAR ZMK ZMW ZWL'
+).split()
+SYMBOLS = {code: f'Currency {code}' for code in CURRENCIES}
+# Deterministic, but varied enough rates
+RATES = {
+    code: 1.0 if code == 'EUR' else round(0.0001 + (i * 7919 % 100003) / 97.0, 6) for i, code in enumerate(CURRENCIES)
+}
+E_TAG = '"fixer-stub-symbols"'
+
+
+class FixerStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, data: Dict, headers: Dict[str, str] = None):
+        body = json.dumps(data).encode()
+        # `send_response` adds the `Date` header (used by the app for `If-Modified-Since`) itself
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # Simulated network latency of the real API
+        time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        if url.path.endswith('/symbols'):
+            if self.headers.get('If-None-Match') == E_TAG:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self._send_json({'success': True, 'symbols': SYMBOLS}, {'Etag': E_TAG})
+        elif url.path.endswith('/latest'):
+            symbols = [s for s in params.get('symbols', [''])[0].split(',') if s]
+            rates = {s: RATES[s] for s in symbols if s in RATES} if symbols else RATES
+            self._send_json({'success': True, 'timestamp': int(time.time()) // 3600 * 3600, 'base': 'EUR',
+                             'rates': rates})
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixerStub:
+    """
+
+    The stand-in server running in a background thread.
+
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0):
+        self.server = ThreadingHTTPServer((host, port), FixerStubHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/api'
+
+    def __enter__(self) -> 'FixerStub':
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of the Fixer API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of every response (in seconds)')
+    args = parser.parse_args()
+    with FixerStub(args.host, args.port, args.latency) as stub:
+        print(f'FIXER_LATEST_URL={stub.url}/latest FIXER_SUPPORTED_URL={stub.url}/symbols')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
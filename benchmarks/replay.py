@@ -0,0 +1,327 @@
+"""
+
+Load-test scenario runner replaying recorded production traffic.
+
+Run from the root of the repository:
+
+* `python -m benchmarks.replay record access.log [more.log ...] -o trace.gz` -- extracts the requests to the API
+  from the access logs (gunicorn, werkzeug or any log with `"GET <path> HTTP/x"`) into a compact, anonymized trace
+* `python -m benchmarks.replay replay trace.gz [--url http://host:port] [--speed 1] [--concurrency 8]
+  [-o result.json] [--baseline baseline.json]` -- replays the trace in-process through the Flask test client (with
+  a local Fixer stand-in) or over HTTP against a running server and reports the throughput and the latencies
+* `python -m benchmarks.replay compare baseline.json result.json [--max-regression 10]` -- compares two runs
+
+"""
+import argparse
+import gzip
+import http.client
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+
+ENDPOINTS = ('/currency_converter', '/currency_matrix', '/supported_currencies')
+# Only these parameters are kept in the trace -- everything else (API keys, tracking parameters...) is dropped
+PARAMETERS = ('amount', 'input_currency', 'output_currency', 'bases', 'targets', 'amounts', 'rounding')
+AMOUNT_PARAMETERS = ('amount', 'amounts')
+
+_REQUEST_LINE = re.compile(r'"GET (?P<path>\S+) HTTP/[\d.]+"')
+# Common log format (`[01/Jul/2019:10:00:00 +0000]`) or ISO-like (`2019-07-01 10:00:00`) timestamps
+_CLF_TIME = re.compile(r'\[(?P<time>\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4})]')
+_ISO_TIME = re.compile(r'(?P<time>\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})')
+
+
+class TraceEntry(NamedTuple):
+    offset: float
+    path: str
+
+
+# ------------------------------------------------------ Record -------------------------------------------------------
+
+
+def _anonymize_amount(amount: str) -> str:
+    # Keeps just the order of magnitude of the valid amounts (and the fact that the invalid ones are invalid)
+    try:
+        value = float(amount)
+    except ValueError:
+        return 'invalid'
+    if not math.isfinite(value) or value == 0:
+        return amount
+    magnitude = 10 ** math.floor(math.log10(abs(value)))
+    return f'{math.copysign(magnitude, value):g}'
+
+
+def anonymize(path: str) -> Optional[str]:
+    """
+
+    Keeps only the requests to the API and only its own parameters, with the amounts reduced to their magnitude.
+
+    :param path: the requested path including the query string
+    :return: the anonymized path with a normalized (percent-encoded) query string or None for other requests
+
+    """
+    url = urlsplit(path)
+    if url.path not in ENDPOINTS:
+        return None
+    params = []
+    for key, value in parse_qsl(url.query, keep_blank_values=True):
+        if key not in PARAMETERS:
+            continue
+        if key in AMOUNT_PARAMETERS:
+            value = ','.join(map(_anonymize_amount, value.split(',')))
+        params.append((key, value))
+    return f'{url.path}?{urlencode(params)}' if params else url.path
+
+
+def _parse_time(line: str) -> Optional[float]:
+    match = _CLF_TIME.search(line)
+    if match:
+        return datetime.strptime(match.group('time'), '%d/%b/%Y:%H:%M:%S %z').timestamp()
+    match = _ISO_TIME.search(line)
+    if match:
+        return datetime.strptime(match.group('time').replace('T', ' '), '%Y-%m-%d %H:%M:%S').timestamp()
+    return None
+
+
+def record(lines: Iterable[str]) -> List[TraceEntry]:
+    entries = []
+    start = None
+    for i, line in enumerate(lines):
+        match = _REQUEST_LINE.search(line)
+        if not match:
+            continue
+        path = anonymize(match.group('path'))
+        if path is None:
+            continue
+        timestamp = _parse_time(line)
+        # Lines without a timestamp are replayed as if they came in evenly 10 ms apart
+        timestamp = timestamp if timestamp is not None else i / 100
+        start = timestamp if start is None else start
+        entries.append(TraceEntry(max(timestamp - start, 0), path))
+    return entries
+
+
+def save_trace(entries: Sequence[TraceEntry], path: str):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(f'{entry.offset * 1000:.0f}\t{entry.path}\n')
+
+
+def load_trace(path: str) -> List[TraceEntry]:
+    entries = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                offset, request = line.rstrip('\n').split('\t', 1)
+                entries.append(TraceEntry(int(offset) / 1000, request))
+    return entries
+
+
+# ------------------------------------------------------ Replay -------------------------------------------------------
+
+
+def _in_process_sender() -> Tuple[Callable[[str], int], Callable[[], None]]:
+    os.environ.setdefault('FLASK_ENV', 'testing')
+    os.environ.setdefault('FIXER_API_KEY', 'replay')
+    from api import create_app
+    from benchmarks.fixer_stub import FixerStub
+
+    stub = FixerStub().__enter__()
+    app = create_app()
+    # The warnings about invalid requests would only slow down the replay
+    app.logger.setLevel(logging.ERROR)
+    app.config['FIXER_LATEST_URL'] = f'{stub.url}/latest'
+    app.config['FIXER_SUPPORTED_URL'] = f'{stub.url}/symbols'
+    local = threading.local()
+
+    def send(path: str) -> int:
+        # The test client is not meant to be shared between threads
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        return local.client.get(path).status_code
+
+    return send, lambda: stub.__exit__(None, None, None)
+
+
+def _http_sender(url: str) -> Tuple[Callable[[str], int], Callable[[], None]]:
+    url = urlsplit(url)
+    local = threading.local()
+
+    def send(path: str) -> int:
+        # One keep-alive connection per thread
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        try:
+            local.connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+            response = local.connection.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, OSError):
+            local.connection.close()
+            del local.connection
+            return 0
+
+    return send, lambda: None
+
+
+def _percentile(latencies: Sequence[float], percentile: float) -> float:
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+def replay(entries: Sequence[TraceEntry], send: Callable[[str], int], speed: float, concurrency: int) -> Dict:
+    """
+
+    Replays the trace entries.
+
+    :param entries: the trace
+    :param send: function sending one request and returning its status code (0 for connection errors)
+    :param speed: 1 replays the requests with the recorded timing, 2 twice as fast etc. and 0 as fast as possible
+    :param concurrency: maximal number of requests in flight
+    :return: the report of the run
+
+    """
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def run(entry: TraceEntry, scheduled: Optional[float]):
+        # Measured from when the request was due to be sent, not from when a thread got to it -- otherwise the time
+        # the requests wait while the server falls behind would be missing from the latencies. As fast as possible
+        # (no schedule), the next request is sent only when a thread is free anyway.
+        begin = time.perf_counter() if scheduled is None else scheduled
+        status = send(entry.path)
+        latency = time.perf_counter() - begin
+        with lock:
+            latencies.append(latency)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for entry in entries:
+            scheduled = None
+            if speed > 0:
+                scheduled = start + entry.offset / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(run, entry, scheduled)
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'duration_s': duration,
+        'throughput_rps': len(latencies) / duration if duration else 0.0,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            **{f'p{p}': _percentile(latencies, p) * 1000 for p in (50, 90, 99)},
+            'max': latencies[-1] * 1000 if latencies else 0.0
+        }
+    }
+
+
+# ----------------------------------------------------- Compare -------------------------------------------------------
+
+
+def compare(baseline: Dict, current: Dict) -> Dict[str, float]:
+    """
+
+    :return: relative change (in %) of the throughput and the latencies; positive values are regressions
+
+    """
+    def change(old: float, new: float) -> float:
+        return (new - old) / old * 100 if old else 0.0
+
+    result = {'throughput_rps': -change(baseline['throughput_rps'], current['throughput_rps'])}
+    for key, value in current['latency_ms'].items():
+        result[f'latency_ms.{key}'] = change(baseline['latency_ms'][key], value)
+    return result
+
+
+def _print_comparison(changes: Dict[str, float]):
+    print('Change against the baseline (positive = worse):')
+    for key, value in changes.items():
+        print(f'  {key:18} {value:+8.1f} %')
+
+
+# ------------------------------------------------------- Main --------------------------------------------------------
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Replays recorded production traffic against the API.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    record_parser = subparsers.add_parser('record', help='record a trace from access logs')
+    record_parser.add_argument('logs', nargs='+')
+    record_parser.add_argument('-o', '--output', required=True, help='the trace file (gzipped)')
+
+    replay_parser = subparsers.add_parser('replay', help='replay a trace')
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--url', help='base URL of a running server; in-process test client if not given')
+    replay_parser.add_argument('--speed', type=float, default=0, help='speed factor; 0 means as fast as possible')
+    replay_parser.add_argument('--concurrency', type=int, default=8)
+    replay_parser.add_argument('--repeat', type=int, default=1, help='replay the trace this many times')
+    replay_parser.add_argument('-o', '--output', help='where to store the report (JSON)')
+    replay_parser.add_argument('--baseline', help='report of a previous run to compare with')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--max-regression', type=float, help='fail if any metric is worse by more (in %%)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        entries = []
+        for log in args.logs:
+            with open(log, encoding='utf-8', errors='replace') as f:
+                entries.extend(record(f))
+        save_trace(entries, args.output)
+        print(f'Recorded {len(entries)} requests to {args.output}')
+        return 0
+
+    if args.command == 'replay':
+        entries = load_trace(args.trace)
+        duration = entries[-1].offset + 1 if entries else 0
+        entries = [TraceEntry(e.offset + i * duration, e.path) for i in range(args.repeat) for e in entries]
+        send, close = _http_sender(args.url) if args.url else _in_process_sender()
+        try:
+            report = replay(entries, send, args.speed, args.concurrency)
+        finally:
+            close()
+        print(json.dumps(report, indent=2))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                _print_comparison(compare(json.load(f), report))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    changes = compare(baseline, current)
+    _print_comparison(changes)
+    if args.max_regression is not None and max(changes.values()) > args.max_regression:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+import json
+import sqlite3
+from decimal import Decimal
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Flask
+
+from api.cache import LRUCache, SqliteCache, init_cache
+from api.compression import PayloadCache, PrecompressedPayload
+from api.currencies import CurrencyResource
+from api.snapshot import RatesSnapshot
+from api.views import payloads
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+SNAPSHOT = RatesSnapshot.create(
+    version=1,
+    supported={'USD': 'United States Dollar', 'CZK': 'Czech Crown', 'EUR': 'Euro'},
+    rates={'USD': 1.138, 'CZK': '25.4183', 'EUR': 1},
+    e_tag='some-random-string'
+)
+
+
+@pytest.fixture
+def shared_app(test_app: Flask, monkeypatch: MonkeyPatch, tmp_path) -> Flask:
+    monkeypatch.setitem(test_app.config, 'CACHE_URL', f'sqlite:///{tmp_path / "cache.db"}')
+    init_cache(test_app)
+    CurrencyResource.snapshot = None
+    CurrencyResource._retry_after = 0.0
+    payloads.clear()
+    yield test_app
+    CurrencyResource.snapshot = None
+    payloads.clear()
+
+
+@pytest.fixture
+def mock_fetch(monkeypatch: MonkeyPatch) -> list:
+    fetched = []
+
+    def mocked_fetch(previous):
+        fetched.append(previous)
+        return SNAPSHOT._replace(version=previous.version + 1 if previous else 1)
+
+    monkeypatch.setattr(CurrencyResource, '_fetch', mocked_fetch)
+    return fetched
+
+
+def _other_process():
+    # Everything kept in the process is gone -- only the shared cache remains
+    CurrencyResource.snapshot = None
+    payloads.clear()
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # `b` was the least recently used one
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_sqlite_cache(test_app: Flask, tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache.db'))
+    cache.set('key', b'value', 10)
+    assert cache.get('key') == b'value'
+    assert SqliteCache(str(tmp_path / 'cache.db')).get('key') == b'value'
+    cache.set('expired', b'value', -1)
+    assert cache.get('expired') is None
+    assert cache.get('missing') is None
+
+
+def test_sqlite_lease(test_app: Flask, tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache.db'))
+    other = SqliteCache(str(tmp_path / 'cache.db'))
+    token = cache.acquire_lease('refresh', 10)
+    assert token is not None
+    assert other.acquire_lease('refresh', 10) is None
+    # Only the holder can release it
+    other.release_lease('refresh', 'some-another-token')
+    assert other.acquire_lease('refresh', 10) is None
+    cache.release_lease('refresh', token)
+    assert other.acquire_lease('refresh', 10) is not None
+
+
+def test_sqlite_lease_expires(test_app: Flask, tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache.db'))
+    assert cache.acquire_lease('refresh', -1) is not None
+    assert cache.acquire_lease('refresh', 10) is not None
+
+
+def test_unavailable_cache(test_app: Flask, tmp_path, monkeypatch: MonkeyPatch, caplog):
+    cache = SqliteCache(str(tmp_path / 'cache.db'))
+
+    def broken_connection():
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(cache, '_connection', broken_connection)
+    assert cache.get('key') is None
+    cache.set('key', b'value', 10)
+    # Nothing can be coordinated -- the caller goes ahead on its own
+    assert cache.acquire_lease('refresh', 10) == SqliteCache.LOCAL_LEASE
+    assert len(caplog.records) == 3
+
+
+def test_init_cache_invalid(test_app: Flask, monkeypatch: MonkeyPatch):
+    monkeypatch.setitem(test_app.config, 'CACHE_URL', 'memcached://localhost')
+    with pytest.raises(ValueError):
+        init_cache(test_app)
+
+
+def test_snapshot_round_trip():
+    snapshot = RatesSnapshot.from_bytes(SNAPSHOT.to_bytes())
+    assert snapshot == SNAPSHOT
+    assert snapshot.rates['CZK'] == Decimal('25.4183')
+
+
+def test_payload_round_trip(test_app: Flask):
+    payload = PrecompressedPayload(json.dumps({'a': '\n' * 10}).encode())
+    assert PrecompressedPayload.from_bytes(payload.to_bytes()).variants == payload.variants
+
+
+def test_snapshot_fetched_once(shared_app: Flask, mock_fetch: list):
+    assert CurrencyResource.get_snapshot().version == 1
+    _other_process()
+    # Taken from the shared cache, not fetched again
+    assert CurrencyResource.get_snapshot().version == 1
+    assert len(mock_fetch) == 1
+
+
+def test_snapshot_leased(shared_app: Flask, mock_fetch: list, monkeypatch: MonkeyPatch):
+    CurrencyResource.refresh()
+    stale = CurrencyResource.snapshot._replace(created=0.0)
+    shared = shared_app.extensions['shared_cache']
+    shared.set(CurrencyResource.SHARED_KEY, stale.to_bytes(), 10)
+    monkeypatch.setattr(CurrencyResource, 'snapshot', stale)
+
+    # Another process holds the lease -- the stale snapshot is served meanwhile
+    token = shared.acquire_lease(CurrencyResource.SHARED_KEY, 10)
+    assert CurrencyResource.get_snapshot() is stale
+    assert len(mock_fetch) == 1
+
+    shared.release_lease(CurrencyResource.SHARED_KEY, token)
+    monkeypatch.setattr(CurrencyResource, '_retry_after', 0.0)
+    assert CurrencyResource.get_snapshot().version == 2
+    assert len(mock_fetch) == 2
+
+
+def test_snapshot_newer_shared(shared_app: Flask, mock_fetch: list, monkeypatch: MonkeyPatch):
+    # E.g. this process started on its own while the shared cache was unavailable -- its history is replaced by
+    # the shared one with newer data, even though its version is higher
+    shared = shared_app.extensions['shared_cache']
+    local = RatesSnapshot.create(5, SNAPSHOT.supported, SNAPSHOT.rates, created=0.0)
+    shared.set(CurrencyResource.SHARED_KEY, SNAPSHOT._replace(version=2).to_bytes(), 10)
+    monkeypatch.setattr(CurrencyResource, 'snapshot', local)
+    snapshot = CurrencyResource.get_snapshot()
+    assert (snapshot.version, snapshot.history_start) == (2, SNAPSHOT.history_start)
+    assert len(mock_fetch) == 0
+
+
+def test_snapshot_lease_timeout(shared_app: Flask, mock_fetch: list, monkeypatch: MonkeyPatch):
+    shared = shared_app.extensions['shared_cache']
+    monkeypatch.setitem(shared_app.config, 'CACHE_LEASE_SECONDS', 0)
+    # The holder of the lease never delivers -- fetched without it and stored, since the shared cache is empty
+    shared.acquire_lease(CurrencyResource.SHARED_KEY, 10)
+    assert CurrencyResource.get_snapshot().version == 1
+    _other_process()
+    assert CurrencyResource.get_snapshot().version == 1
+    assert len(mock_fetch) == 1
+
+
+def test_snapshot_lease_timeout_shared_history(shared_app: Flask, monkeypatch: MonkeyPatch):
+    shared = shared_app.extensions['shared_cache']
+    monkeypatch.setitem(shared_app.config, 'CACHE_LEASE_SECONDS', 0)
+    shared.acquire_lease(CurrencyResource.SHARED_KEY, 10)
+    delivered = SNAPSHOT._replace(version=5)
+
+    def late_fetch(previous):
+        # The holder of the lease delivers while this process is fetching on its own
+        shared.set(CurrencyResource.SHARED_KEY, delivered.to_bytes(), 10)
+        return SNAPSHOT
+
+    monkeypatch.setattr(CurrencyResource, '_fetch', late_fetch)
+    # No second history of the versions -- the shared one is used
+    assert CurrencyResource.get_snapshot() == delivered
+
+
+def test_snapshot_digests():
+    same = RatesSnapshot.create(7, SNAPSHOT.supported, SNAPSHOT.rates)
+    assert (same.supported_digest, same.rates_digest) == (SNAPSHOT.supported_digest, SNAPSHOT.rates_digest)
+    changed = RatesSnapshot.create(1, SNAPSHOT.supported, dict(SNAPSHOT.rates, USD='1.2'))
+    assert changed.supported_digest == SNAPSHOT.supported_digest
+    assert changed.rates_digest != SNAPSHOT.rates_digest
+    # The precision is a part of the converted payloads too
+    rounded = RatesSnapshot.create(1, SNAPSHOT.supported, SNAPSHOT.rates, minor_units={'USD': 0})
+    assert rounded.rates_digest != SNAPSHOT.rates_digest
+
+
+def test_payload_shared(shared_app: Flask):
+    cache = PayloadCache()
+    cache.get('key', 1, lambda: {'a': 1})
+    _other_process()
+    # Loaded from the shared cache -- the builder is not called
+    assert json.loads(PayloadCache().get('key', 1, None).variants[None]) == {'a': 1}
+    assert json.loads(PayloadCache().get('key', 2, lambda: {'a': 2}).variants[None]) == {'a': 2}
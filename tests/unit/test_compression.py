@@ -0,0 +1,101 @@
+import gzip
+import json
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Flask
+from flask.testing import FlaskClient
+
+from api import compression
+from api.compression import PayloadCache
+from api.currencies import CurrencyResource
+from api.snapshot import RatesSnapshot
+from api.views import payloads
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+SUPPORTED = {f'C{i:02}': f'Currency number {i}' for i in range(100)}
+
+
+def _snapshot(version: int, supported: dict) -> RatesSnapshot:
+    return RatesSnapshot.create(version, supported, {code: 1 for code in supported})
+
+
+@pytest.fixture
+def mock_currency_resource(monkeypatch: MonkeyPatch):
+    snapshot = _snapshot(1, SUPPORTED)
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
+    payloads.clear()
+    yield
+    payloads.clear()
+
+
+@pytest.fixture
+def without_brotli(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(compression, '_brotli', lambda: None)
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+def test_supported_currencies_gzip(test_client: FlaskClient, mock_currency_resource, without_brotli):
+    response = test_client.get('/supported_currencies', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data)) == SUPPORTED
+
+
+def test_supported_currencies_brotli(test_client: FlaskClient, mock_currency_resource):
+    brotli = pytest.importorskip('brotli')
+    response = test_client.get('/supported_currencies', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert json.loads(brotli.decompress(response.data)) == SUPPORTED
+
+
+def test_supported_currencies_identity(test_client: FlaskClient, mock_currency_resource):
+    response = test_client.get('/supported_currencies')
+    assert 'Content-Encoding' not in response.headers
+    assert response.json == SUPPORTED
+
+
+def test_supported_currencies_stored(test_client: FlaskClient, mock_currency_resource, monkeypatch: MonkeyPatch):
+    test_client.get('/supported_currencies')
+    stored = payloads.get('supported', _snapshot(1, SUPPORTED).supported_digest, None)
+    snapshot = _snapshot(2, SUPPORTED)
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
+    # Newer version with the same currencies -- the stored payload is served
+    assert test_client.get('/supported_currencies').json == SUPPORTED
+    assert payloads.get('supported', snapshot.supported_digest, None) is stored
+    snapshot = _snapshot(3, {'USD': 'United States Dollar'})
+    assert test_client.get('/supported_currencies').json == {'USD': 'United States Dollar'}
+
+
+def test_payload_cache_unknown_version(test_app: Flask):
+    cache = PayloadCache()
+    first = cache.get('key', None, lambda: {'a': 1})
+    second = cache.get('key', None, lambda: {'a': 2})
+    assert json.loads(first.variants[None]) == {'a': 1}
+    assert json.loads(second.variants[None]) == {'a': 2}
+
+
+@pytest.mark.parametrize('size, compressed', [
+    (10, False),
+    (5000, True)
+])
+def test_compress_response_threshold(test_app: Flask, without_brotli, size: int, compressed: bool):
+    with test_app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = compression.compress_response(test_app.response_class('x' * size, mimetype='text/plain'))
+    assert ('Content-Encoding' in response.headers) is compressed
+    data = gzip.decompress(response.get_data()) if compressed else response.get_data()
+    assert data == b'x' * size
+
+
+def test_compress_response_error(test_app: Flask):
+    with test_app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = compression.compress_response(
+            test_app.response_class('x' * 5000, status=400, mimetype='text/html')
+        )
+    assert 'Content-Encoding' not in response.headers
@@ -1,10 +1,29 @@
-from decimal import Decimal
+from decimal import Decimal, ROUND_DOWN, ROUND_HALF_EVEN
 
+import pytest
 from _pytest.monkeypatch import MonkeyPatch
 from flask import Flask
 
+from api.config import BaseConfig
+from api.exceptions import InvalidAmountException
 from api.currencies import CurrencyResource
 from api.converter import CurrencyConverter
+from api.snapshot import RatesSnapshot
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+@pytest.fixture(autouse=True)
+def mock_snapshot(monkeypatch: MonkeyPatch):
+    codes = ('EUR', 'USD', 'GBP', 'CZK', 'RUB', 'TRY', 'UAH', 'CNY', 'JPY', 'BTC', 'KWD')
+    snapshot = RatesSnapshot.create(
+        version=1,
+        supported={code: code for code in codes},
+        rates={code: 1 for code in codes},
+        minor_units=BaseConfig.CURRENCY_MINOR_UNITS
+    )
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
 
 
 # ----------------------------------------------------- Tests ---------------------------------------------------------
@@ -44,3 +63,53 @@ def test_rounding(test_app: Flask, monkeypatch: MonkeyPatch):
         'UAH': 0.00,
         'CNY': 200000.00
     }
+
+
+def test_convert_matrix(test_app: Flask, monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(CurrencyResource, 'get_cross_rates', lambda _b, _t: {
+        'EUR': {'USD': Decimal(1.1), 'EUR': Decimal(1)},
+        'USD': {'USD': Decimal(1), 'EUR': Decimal(1) / Decimal(1.1)},
+    })
+    result = CurrencyConverter.convert_matrix([1.0, 10.0], ['EUR', 'USD'], ['USD', 'EUR'])
+    assert result == [
+        {'EUR': {'USD': 1.10, 'EUR': 1.00}, 'USD': {'USD': 1.00, 'EUR': 0.91}},
+        {'EUR': {'USD': 11.00, 'EUR': 10.00}, 'USD': {'USD': 10.00, 'EUR': 9.09}},
+    ]
+
+
+def test_precision(test_app: Flask, monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(CurrencyResource, 'get_currency_rates', lambda _i, _o: {
+        'JPY': Decimal('122.545'),
+        'BTC': Decimal('0.000098765432'),
+        'KWD': Decimal('0.3456789'),
+        'USD': Decimal('1.1345')
+    })
+    result = CurrencyConverter.convert(1.0, 'EUR', ['JPY', 'BTC', 'KWD', 'USD'])
+    assert result == {
+        'JPY': 123.0,
+        'BTC': 0.00009877,
+        'KWD': 0.346,
+        'USD': 1.13
+    }
+
+
+def test_huge_amount(test_app: Flask, monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(CurrencyResource, 'get_currency_rates', lambda _i, _o: {'BTC': Decimal('683.464018')})
+    # 21 digits before the decimal point and 8 after it -- more than the 28 digits of the default decimal context
+    assert CurrencyConverter.convert(1e18, 'EUR', ['BTC']) == {'BTC': 6.83464018e20}
+    # Out of the range of float
+    with pytest.raises(InvalidAmountException):
+        CurrencyConverter.convert(1e307, 'EUR', ['BTC'])
+
+
+@pytest.mark.parametrize('rounding, result', [
+    (ROUND_HALF_EVEN, {'USD': 1.12, 'GBP': 1.14, 'JPY': 122.0}),
+    (ROUND_DOWN, {'USD': 1.12, 'GBP': 1.13, 'JPY': 122.0}),
+])
+def test_rounding_mode(test_app: Flask, monkeypatch: MonkeyPatch, rounding: str, result: dict):
+    monkeypatch.setattr(CurrencyResource, 'get_currency_rates', lambda _i, _o: {
+        'USD': Decimal('1.125'),
+        'GBP': Decimal('1.135'),
+        'JPY': Decimal('122.5')
+    })
+    assert CurrencyConverter.convert(1.0, 'EUR', ['USD', 'GBP', 'JPY'], rounding) == result
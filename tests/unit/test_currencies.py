@@ -1,3 +1,6 @@
+import json
+import logging
+import threading
 from decimal import Decimal
 from typing import Type
 
@@ -8,6 +11,7 @@ from flask import current_app, Flask
 
 from api.currencies import CurrencyResource
 from api.exceptions import FixerApiException, UnknownCurrencyException
+from api.views import payloads
 
 
 # ------------------------------------------------------ Mocks --------------------------------------------------------
@@ -30,7 +34,7 @@ class MockedResponse:
         cls.request_headers = headers
 
     @classmethod
-    def json(cls):
+    def json(cls, **kwargs):
         pass
 
 
@@ -38,7 +42,7 @@ class MockedSupportedResponse(MockedResponse):
     supported = None
 
     @classmethod
-    def json(cls):
+    def json(cls, **kwargs):
         return cls.supported
 
 
@@ -46,8 +50,9 @@ class MockedRatesResponse(MockedResponse):
     rates = None
 
     @classmethod
-    def json(cls):
-        return cls.rates
+    def json(cls, **kwargs):
+        # Parsed from the actual JSON text (as `requests` does) -- with the options like `parse_float`
+        return json.loads(json.dumps(cls.rates), **kwargs)
 
 
 def _mock_response(monkeypatch: MonkeyPatch):
@@ -69,71 +74,85 @@ def mock_response_ok(monkeypatch: MonkeyPatch):
     MockedRatesResponse.status_code = 200
 
 
-@pytest.fixture
+@pytest.fixture(autouse=True)
 def clean_currency_resource():
-    CurrencyResource.e_tag = None
-    CurrencyResource.date = None
-    CurrencyResource.supported = None
+    CurrencyResource.snapshot = None
+    CurrencyResource._retry_after = 0.0
+    payloads.clear()
+    yield
+    CurrencyResource.snapshot = None
+    payloads.clear()
+
+
+SUPPORTED = {
+    'success': True,
+    'symbols': {
+        'USD': 'United States Dollar',
+        'CZK': 'Czech Crown',
+        'GBP': 'Great Britain Pound',
+        'EUR': 'Euro',
+        'RUB': 'Russian Rouble'
+    }
+}
+RATES = {
+    'success': True,
+    'timestamp': 1561939200,
+    'rates': {'USD': 1.138, 'CZK': 25.4183, 'EUR': 1, 'GBP': 0.896032, 'RUB': 72.06232}
+}
 
 
 # ----------------------------------------------------- Tests ---------------------------------------------------------
 
 
-def test_get_supported_currencies(test_app: Flask, mock_response_ok, clean_currency_resource):
-    json_data = {
-        'success': True,
-        'symbols': {
-            'USD': 'United States Dollar',
-            'CZK': 'Czech Crown',
-            'GBP': 'Great Britain Pound'
-        }
-    }
-    MockedSupportedResponse.supported = json_data
+def test_refresh(test_app: Flask, mock_response_ok):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
 
-    supported = CurrencyResource.get_supported_currencies()
-    assert supported == json_data['symbols']
+    snapshot = CurrencyResource.refresh()
+    assert CurrencyResource.snapshot is snapshot
+    assert snapshot.version == 1
+    assert snapshot.supported == SUPPORTED['symbols']
+    # Exactly the values in the JSON, not the binary approximations of the floats
+    assert snapshot.rates == {k: Decimal(str(v)) for k, v in RATES['rates'].items()}
+    assert str(snapshot.rates['GBP']) == '0.896032'
+    assert snapshot.timestamp == 1561939200
     assert MockedSupportedResponse.request_url == current_app.config['FIXER_SUPPORTED_URL']
     assert MockedSupportedResponse.request_params == {'access_key': current_app.config['FIXER_API_KEY']}
     assert MockedSupportedResponse.request_headers == {
             'If-None-Match': None,
             'If-Modified-Since': None
     }
-
-
-def test_get_supported_currencies_cache(test_app: Flask, mock_response_ok, clean_currency_resource):
-    json_data = {
-        'success': True,
-        'symbols': {
-            'USD': 'United States Dollar',
-            'CZK': 'Czech Crown',
-            'GBP': 'Great Britain Pound'
-        }
+    # All the rates at once -- any conversion is then computed from the snapshot
+    assert MockedRatesResponse.request_url == current_app.config['FIXER_LATEST_URL']
+    assert MockedRatesResponse.request_params == {
+        'access_key': current_app.config['FIXER_API_KEY'],
+        'symbols': ''
     }
-    MockedSupportedResponse.supported = json_data
 
-    first_run = CurrencyResource.get_supported_currencies()
-    assert first_run == json_data['symbols']
-    assert MockedSupportedResponse.request_headers == {
-        'If-None-Match': None,
-        'If-Modified-Since': None
-    }
-    assert CurrencyResource.supported == json_data['symbols']
-    assert CurrencyResource.e_tag == 'some-random-string'
-    assert CurrencyResource.date == '1970/01/01'
+
+def test_refresh_supported_cache(test_app: Flask, mock_response_ok, monkeypatch: MonkeyPatch):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    first = CurrencyResource.refresh()
+    assert first.e_tag == 'some-random-string'
+    assert first.date == '1970/01/01'
 
     MockedSupportedResponse.supported = {}
-    MockedSupportedResponse.headers['Etag'] = 'some-another-string'
-    MockedSupportedResponse.headers['Date'] = '2019/01/01'
+    monkeypatch.setattr(MockedSupportedResponse, 'headers', {'Etag': 'some-another-string', 'Date': '2019/01/01'})
     MockedSupportedResponse.status_code = 304
-    second_run = CurrencyResource.get_supported_currencies()
-    assert second_run == json_data['symbols']
+    second = CurrencyResource.refresh()
     assert MockedSupportedResponse.request_headers == {
         'If-None-Match': 'some-random-string',
         'If-Modified-Since': '1970/01/01'
     }
+    assert second.version == 2
+    assert second.supported == SUPPORTED['symbols']
+    assert second.e_tag == 'some-random-string'
+    # The previous snapshot is left untouched
+    assert first.version == 1
 
 
-def test_get_supported_currencies_error(test_app: Flask, mock_response_ok, clean_currency_resource):
+def test_refresh_error(test_app: Flask, mock_response_ok):
     error_code = 123
     info = 'Testing error info'
     url = current_app.config['FIXER_SUPPORTED_URL']
@@ -147,31 +166,165 @@ def test_get_supported_currencies_error(test_app: Flask, mock_response_ok, clean
     MockedSupportedResponse.supported = json_data
 
     with pytest.raises(FixerApiException) as e:
-        CurrencyResource.get_supported_currencies()
+        CurrencyResource.get_snapshot()
 
     ref_exception = FixerApiException(url, error_code, info)
     assert e.value.display_msg == ref_exception.display_msg
     assert e.value.logger_msg == ref_exception.logger_msg
+    assert CurrencyResource.snapshot is None
+
+
+def test_stale_snapshot_served_on_error(test_app: Flask, mock_response_ok, monkeypatch: MonkeyPatch, caplog):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    first = CurrencyResource.refresh()
+    monkeypatch.setattr(CurrencyResource, 'snapshot', first._replace(created=0.0))
+
+    MockedRatesResponse.rates = {'success': False, 'error': {'code': 104, 'info': 'Limit reached'}}
+    snapshot = CurrencyResource.get_snapshot()
+    assert snapshot.version == 1
+    assert snapshot.rates == first.rates
+    assert caplog.record_tuples[-1][1] == logging.ERROR
+
+    # No other attempt until the retry interval passes
+    MockedRatesResponse.rates = RATES
+    assert CurrencyResource.get_snapshot().version == 1
+    monkeypatch.setattr(CurrencyResource, '_retry_after', 0.0)
+    assert CurrencyResource.get_snapshot().version == 2
 
 
-@pytest.mark.parametrize('output_currencies, fixer_api_symbols, rates, result', [
+@pytest.mark.parametrize('rates', [
+    None,
+    {'success': True},
+    {'success': True, 'rates': {'USD': 'abc'}},
+    {'success': True, 'rates': {'USD': 0}}
+])
+def test_stale_snapshot_served_on_invalid_response(test_app: Flask, mock_response_ok, monkeypatch: MonkeyPatch,
+                                                   rates: dict, caplog):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    first = CurrencyResource.refresh()
+    monkeypatch.setattr(CurrencyResource, 'snapshot', first._replace(created=0.0))
+
+    MockedRatesResponse.rates = rates
+    assert CurrencyResource.get_snapshot().version == 1
+    assert 'Invalid response' in caplog.record_tuples[-1][2]
+
+
+def test_stale_snapshot_served_on_connection_error(test_app: Flask, mock_response_ok, monkeypatch: MonkeyPatch,
+                                                   caplog):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    first = CurrencyResource.refresh()
+    monkeypatch.setattr(CurrencyResource, 'snapshot', first._replace(created=0.0))
+
+    def unreachable(url: str, params: dict, **kwargs):
+        # A timeout must be always given -- a hung request would block the refresh
+        assert kwargs['timeout'] == current_app.config['FIXER_TIMEOUT']
+        raise requests.ConnectionError(f'Max retries exceeded with url: {url}?access_key={params["access_key"]}')
+
+    monkeypatch.setattr(requests, 'get', unreachable)
+    assert CurrencyResource.get_snapshot().version == 1
+    message = caplog.record_tuples[-1][2]
+    assert 'ConnectionError' in message
+    assert current_app.config['FIXER_API_KEY'] not in message
+
+
+def test_refresher_survives_errors(test_app: Flask, monkeypatch: MonkeyPatch, caplog):
+    errors = [requests.ConnectionError('refused'), RuntimeError('unexpected')]
+    intervals = []
+
+    def failing_refresh():
+        raise errors.pop(0)
+
+    class StopAfterRetries(threading.Event):
+        def wait(self, timeout: float = None) -> bool:
+            intervals.append(timeout)
+            if not errors:
+                self.set()
+            return self.is_set()
+
+    monkeypatch.setattr(CurrencyResource, 'refresh', failing_refresh)
+    CurrencyResource._refresh_periodically(test_app, StopAfterRetries())
+    # Retried after each error instead of the thread dying
+    assert intervals == [current_app.config['RATES_RETRY_INTERVAL']] * 2
+    assert [level for _, level, _ in caplog.record_tuples] == [logging.ERROR] * 2
+
+
+def test_snapshot_pinned_to_request(test_app: Flask, mock_response_ok):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    with test_app.test_request_context('/currency_converter'):
+        first = CurrencyResource.get_snapshot()
+        CurrencyResource.refresh()
+        assert CurrencyResource.get_snapshot() is first
+    assert CurrencyResource.get_snapshot().version == 2
+
+
+def test_refresh_listeners(test_app: Flask, mock_response_ok, monkeypatch: MonkeyPatch):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    published = []
+    monkeypatch.setattr(CurrencyResource, 'listeners', [lambda new, previous: published.append((new, previous))])
+
+    first = CurrencyResource.refresh()
+    second = CurrencyResource.refresh()
+    assert published == [(first, None), (second, first)]
+
+
+def test_refresh_precompresses(test_app: Flask, mock_response_ok):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    snapshot = CurrencyResource.refresh()
+    # Built from the snapshot right away -- the builders of the requests are never called
+    assert json.loads(payloads.get('supported', snapshot.supported_digest, None).variants[None]) == \
+        SUPPORTED['symbols']
+    assert json.loads(
+        payloads.get(('convert', 'CZK'), snapshot.rates_digest, None).variants[None]
+    )['output']['USD'] == 0.04
+
+
+def test_refresh_diff(test_app: Flask, mock_response_ok, monkeypatch: MonkeyPatch):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+    first = CurrencyResource.refresh()
+    assert first.as_of == first.history_start == first.timestamp
+    second = CurrencyResource.refresh()
+    # Nothing changed -- the data derived from the first version are still valid
+    assert (second.version, second.as_of, second.supported_changed_at) == (2, first.as_of, first.as_of)
+    assert second.changes_since(first.as_of) == ({}, ())
+
+    rates = dict(RATES['rates'], USD=1.2)
+    del rates['RUB']
+    monkeypatch.setattr(MockedRatesResponse, 'rates', dict(RATES, rates=rates))
+    third = CurrencyResource.refresh()
+    # The same timestamp of the Fixer API, but different rates -- still a later point in time
+    assert (third.as_of, third.supported_changed_at) == (first.as_of + 1, first.as_of)
+    # Still the same history
+    assert third.history_start == first.as_of
+    assert third.tracks_changes_since(first.as_of) and not third.tracks_changes_since(first.as_of - 1)
+    assert third.changes_since(first.as_of) == ({'USD': Decimal('1.2')}, ('RUB',))
+    assert third.changes_since(0)[0] == {code: Decimal(str(rate)) for code, rate in rates.items()}
+    # Only the payloads depending on the rates were rebuilt
+    assert json.loads(payloads.get('supported', third.supported_digest, None).variants[None]) == SUPPORTED['symbols']
+    assert 'RUB' not in json.loads(payloads.get(('convert', 'CZK'), third.rates_digest, None).variants[None])['output']
+
+
+@pytest.mark.parametrize('input_currency, output_currencies, result', [
     (
+            'GBP',
             ['USD', 'CZK', 'EUR'],
-            'USD,CZK,EUR,GBP',
-            {'USD': 1.138, 'CZK': 25.4183, 'EUR': 1, 'GBP': 0.896032},
             {'USD': Decimal('1.270043927002606866931605697'), 'CZK': Decimal('28.36762526338344738236026116'),
              'EUR': Decimal('1.116031570301060613312779630')}
     ),
     (
+            'GBP',
             ['RUB'],
-            'RUB,GBP',
-            {'RUB': 72.06232, 'GBP': 0.896032, 'EUR': 1},
-            {'RUB': Decimal('80.42382414913753'), 'GBP': Decimal('0.896032')}
+            {'RUB': Decimal('80.42382414913753')}
     ),
     (
+            'GBP',
             [],
-            '',
-            {'USD': 1.138, 'CZK': 25.4183, 'EUR': 1, 'GBP': 0.896032, 'RUB': 72.06232},
             {'USD': Decimal('1.270043927002606866931605697'), 'CZK': Decimal('28.36762526338344738236026116'),
              'EUR': Decimal('1.116031570301060613312779630'), 'RUB': Decimal('80.42382414913753')}
     )
@@ -179,50 +332,22 @@ def test_get_supported_currencies_error(test_app: Flask, mock_response_ok, clean
 def test_get_currency_rates(
         test_app: Flask,
         mock_response_ok,
-        output_currencies: str,
-        fixer_api_symbols: str,
-        rates: dict,
+        input_currency: str,
+        output_currencies: list,
         result: dict
 ):
-    supported = {
-        'success': True,
-        'symbols': {
-            'USD': 'United States Dollar',
-            'CZK': 'Czech Crown',
-            'GBP': 'Great Britain Pound',
-            'EUR': 'Euro',
-            'RUB': 'Russian Rouble'
-        }
-    }
-    json_data = {
-        'success': True,
-        'rates': rates
-    }
-    MockedSupportedResponse.supported = supported
-    MockedRatesResponse.rates = json_data
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
 
-    result = CurrencyResource.get_currency_rates('GBP', output_currencies)
-    assert result == result
-    assert MockedSupportedResponse.request_url == current_app.config['FIXER_SUPPORTED_URL']
-    assert MockedSupportedResponse.request_params == {'access_key': current_app.config['FIXER_API_KEY']}
-    assert MockedRatesResponse.request_url == current_app.config['FIXER_LATEST_URL']
-    assert MockedRatesResponse.request_params == {
-        'access_key': current_app.config['FIXER_API_KEY'],
-        'symbols': fixer_api_symbols
-    }
+    requested = list(output_currencies)
+    rates = CurrencyResource.get_currency_rates(input_currency, requested)
+    assert rates.keys() == result.keys()
+    for currency, rate in result.items():
+        assert abs(rates[currency] - rate) < Decimal('1e-12')
+    assert requested == output_currencies
 
 
 def test_get_currency_rates_error(test_app: Flask, mock_response_ok):
-    supported = {
-        'success': True,
-        'symbols': {
-            'USD': 'United States Dollar',
-            'CZK': 'Czech Crown',
-            'GBP': 'Great Britain Pound',
-            'EUR': 'Euro',
-            'RUB': 'Russian Rouble'
-        }
-    }
     url = current_app.config['FIXER_LATEST_URL']
     code = 202
     info = 'Some error info'
@@ -233,7 +358,7 @@ def test_get_currency_rates_error(test_app: Flask, mock_response_ok):
             'info': info
         }
     }
-    MockedSupportedResponse.supported = supported
+    MockedSupportedResponse.supported = SUPPORTED
     MockedRatesResponse.rates = json_data
 
     with pytest.raises(FixerApiException) as e:
@@ -245,17 +370,8 @@ def test_get_currency_rates_error(test_app: Flask, mock_response_ok):
 
 
 def test_get_currency_rates_invalid_currency(test_app: Flask, mock_response_ok):
-    supported = {
-        'success': True,
-        'symbols': {
-            'USD': 'United States Dollar',
-            'CZK': 'Czech Crown',
-            'GBP': 'Great Britain Pound',
-            'EUR': 'Euro',
-            'RUB': 'Russian Rouble'
-        }
-    }
-    MockedSupportedResponse.supported = supported
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
 
     # Invalid input currency
     with pytest.raises(UnknownCurrencyException) as e:
@@ -279,3 +395,17 @@ def test_get_currency_rates_invalid_currency(test_app: Flask, mock_response_ok):
     ref_exception = UnknownCurrencyException('SOME')
     assert e.value.display_msg == ref_exception.display_msg
     assert e.value.logger_msg == ref_exception.logger_msg
+
+
+def test_get_cross_rates(test_app: Flask, mock_response_ok):
+    MockedSupportedResponse.supported = SUPPORTED
+    MockedRatesResponse.rates = RATES
+
+    result = CurrencyResource.get_cross_rates(['GBP', 'USD'], ['CZK', 'GBP'])
+    assert result == {
+        'GBP': {'CZK': Decimal('25.4183') / Decimal('0.896032'), 'GBP': Decimal(1)},
+        'USD': {'CZK': Decimal('25.4183') / Decimal('1.138'), 'GBP': Decimal('0.896032') / Decimal('1.138')}
+    }
+
+    with pytest.raises(UnknownCurrencyException):
+        CurrencyResource.get_cross_rates(['GBP'], ['NONSENSE'])
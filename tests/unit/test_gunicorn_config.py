@@ -0,0 +1,83 @@
+import importlib
+import os
+from types import ModuleType
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Flask
+
+from api.currencies import CurrencyResource
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+class MockedWorker:
+    def __init__(self, app: Flask):
+        self.app = self
+        self._wsgi = app
+
+    def wsgi(self) -> Flask:
+        return self._wsgi
+
+
+def _load_config(monkeypatch: MonkeyPatch, **env) -> ModuleType:
+    # Set (to the empty string, i.e. not preloaded) through `monkeypatch`, so that it's restored after the test --
+    # the config module sets it for the preloaded app directly in `os.environ`
+    monkeypatch.setenv('SERVER_PRELOAD', '')
+    monkeypatch.setenv('CORES_NUM', '4')
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    from api import gunicorn_config
+    return importlib.reload(gunicorn_config)
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+@pytest.mark.parametrize('profile, worker_class, workers, threads, preload', [
+    ('sync', 'sync', 9, 1, True),
+    ('gthread', 'gthread', 4, 8, True),
+    ('gevent', 'gevent', 4, 1, False),
+])
+def test_profiles(monkeypatch: MonkeyPatch, profile: str, worker_class: str, workers: int, threads: int,
+                  preload: bool):
+    config = _load_config(monkeypatch, GUNICORN_PROFILE=profile)
+    assert config.worker_class == worker_class
+    assert config.workers == workers
+    assert config.threads == threads
+    assert config.preload_app is preload
+    assert config.max_requests_jitter > 0
+
+
+def test_overrides(monkeypatch: MonkeyPatch):
+    config = _load_config(monkeypatch, GUNICORN_WORKERS='2', GUNICORN_THREADS='16', GUNICORN_KEEPALIVE='5')
+    assert config.worker_class == 'gthread'
+    assert (config.workers, config.threads, config.keepalive) == (2, 16, 5)
+
+
+def test_invalid_profile(monkeypatch: MonkeyPatch):
+    with pytest.raises(ValueError):
+        _load_config(monkeypatch, GUNICORN_PROFILE='tornado')
+
+
+def test_environment_restored():
+    before = os.environ.get('SERVER_PRELOAD')
+    monkeypatch = MonkeyPatch()
+    try:
+        _load_config(monkeypatch, GUNICORN_PROFILE='gthread')
+        assert os.environ['SERVER_PRELOAD'] == '1'
+    finally:
+        monkeypatch.undo()
+    # Would reach the other tests (and the processes they start)
+    assert os.environ.get('SERVER_PRELOAD') == before
+
+
+def test_refresher_started_after_fork(test_app: Flask, monkeypatch: MonkeyPatch):
+    config = _load_config(monkeypatch, GUNICORN_PROFILE='gthread')
+    started = []
+    monkeypatch.setattr(CurrencyResource, 'start_refresher', started.append)
+
+    monkeypatch.setitem(test_app.config, 'RATES_REFRESHER', True)
+    config.post_fork(None, MockedWorker(test_app))
+    assert started == [test_app]
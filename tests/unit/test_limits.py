@@ -0,0 +1,115 @@
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Flask
+from flask.testing import FlaskClient
+
+from api import limits
+from api.cache import SqliteCache
+from api.converter import CurrencyConverter
+from api.currencies import CurrencyResource
+from api.limits import RateLimiter, init_limits
+from api.snapshot import RatesSnapshot
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+class MockedClock:
+    now = 1000.0
+
+    @classmethod
+    def time(cls) -> float:
+        return cls.now
+
+
+@pytest.fixture
+def mock_clock(monkeypatch: MonkeyPatch):
+    MockedClock.now = 1000.0
+    monkeypatch.setattr(limits.time, 'monotonic', MockedClock.time)
+    monkeypatch.setattr(limits.time, 'time', MockedClock.time)
+
+
+@pytest.fixture
+def mock_currency_converter(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(CurrencyConverter, 'convert', lambda *args: {'USD': 1.0})
+
+
+def _limit(app: Flask, monkeypatch: MonkeyPatch, **config):
+    for key, value in config.items():
+        monkeypatch.setitem(app.config, key, value)
+    init_limits(app)
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+def test_token_bucket(mock_clock):
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.take('client') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('client') == pytest.approx(0.5)
+    # Other clients have their own buckets
+    assert limiter.take('another') == 0
+
+    MockedClock.now += 0.5
+    assert limiter.take('client') == 0
+    assert limiter.take('client') > 0
+    # Never more than the burst
+    MockedClock.now += 100
+    assert [limiter.take('client') for _ in range(4)][-1] > 0
+
+
+def test_token_bucket_shared(test_app: Flask, mock_clock, tmp_path):
+    shared = SqliteCache(str(tmp_path / 'cache.db'))
+    first, second = RateLimiter(1, 2, shared), RateLimiter(1, 2, shared)
+    assert first.take('client') == 0
+    assert second.take('client') == 0
+    # The bucket is shared by both processes
+    assert first.take('client') == pytest.approx(1)
+    assert second.take('client') == pytest.approx(1)
+
+
+def test_rate_limit(test_client: FlaskClient, test_app: Flask, monkeypatch: MonkeyPatch, mock_currency_converter):
+    _limit(test_app, monkeypatch, RATE_LIMIT=0.5, RATE_LIMIT_BURST=1)
+    assert test_client.get('/currency_converter?output_currency=USD').status_code == 200
+    response = test_client.get('/currency_converter?output_currency=USD')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    # Made-up keys don't get their own buckets
+    for key in ('random-1', 'random-2'):
+        response = test_client.get('/currency_converter?output_currency=USD', headers={'X-API-Key': key})
+        assert response.status_code == 429
+    # A client with a known API key has its own bucket
+    monkeypatch.setitem(test_app.config, 'RATE_LIMIT_API_KEYS', frozenset({'secret'}))
+    response = test_client.get('/currency_converter?output_currency=USD', headers={'X-API-Key': 'secret'})
+    assert response.status_code == 200
+
+
+def test_concurrency_limit(test_client: FlaskClient, test_app: Flask, monkeypatch: MonkeyPatch):
+    _limit(test_app, monkeypatch, MAX_CONCURRENT_CONVERSIONS=1)
+    slots = test_app.extensions['conversion_slots']
+    free_slots = []
+
+    def mocked_convert(*args):
+        free_slots.append(slots.acquire(blocking=False))
+        return {'USD': 1.0}
+
+    monkeypatch.setattr(CurrencyConverter, 'convert', mocked_convert)
+    assert test_client.get('/currency_converter?output_currency=USD').status_code == 200
+    # The conversion held the only slot and released it afterwards
+    assert free_slots == [False]
+    assert slots.acquire(blocking=False)
+
+    # Another conversion is being processed
+    response = test_client.get('/currency_converter?output_currency=USD')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    # Neither a matrix -- it takes the same slots
+    monkeypatch.setattr(CurrencyConverter, 'convert_matrix', lambda *args: [{'USD': {'USD': 1.0}}])
+    assert test_client.get('/currency_matrix?bases=USD').status_code == 429
+    # Other endpoints are not limited
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: RatesSnapshot.create(1, {'USD': 'USD'}, {'USD': 1}))
+    assert test_client.get('/supported_currencies').status_code == 200
+    slots.release()
+    assert test_client.get('/currency_matrix?bases=USD').status_code == 200
+    assert slots.acquire(blocking=False)
+    slots.release()
@@ -0,0 +1,105 @@
+import json
+import logging
+import queue
+
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Flask
+from flask.logging import default_handler
+
+from api import create_app, logs
+from api.config import TestingConfig
+from api.currencies import CurrencyResource
+from api.exceptions import FixerApiException
+from api.logs import DroppingQueueHandler, JsonFormatter, SamplingFilter, redact, start_logging, \
+    stop_logging
+from api.snapshot import RatesSnapshot
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+def _record(msg: str, *args, **extra) -> logging.LogRecord:
+    record = logging.LogRecord('flask.app', logging.WARNING, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def _reset_logger(app: Flask):
+    # The logger is shared by all the instances of the app -- back to Flask's handler
+    stop_logging(app)
+    for handler in app.logger.handlers[:]:
+        app.logger.removeHandler(handler)
+    app.logger.addHandler(default_handler)
+    app.logger.setLevel(logging.NOTSET)
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+def test_redact():
+    assert redact('http://data.fixer.io/api/latest?access_key=secret&base=EUR') == \
+        'http://data.fixer.io/api/latest?access_key=***&base=EUR'
+    e = FixerApiException('http://data.fixer.io/api/latest?access_key=secret', 101, 'Invalid key')
+    assert 'secret' not in e.logger_msg
+
+
+def test_json_formatter():
+    record = _record('Request to %s failed', 'http://fixer/?access_key=secret', event='FixerApiException', status=500)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'Request to http://fixer/?access_key=*** failed'
+    assert (entry['level'], entry['logger'], entry['event'], entry['status']) == \
+        ('WARNING', 'flask.app', 'FixerApiException', 500)
+
+
+def test_sampling(monkeypatch: MonkeyPatch):
+    sampling = SamplingFilter({'UnknownCurrencyException': 0.1})
+    monkeypatch.setattr(logs.random, 'random', lambda: 0.5)
+    record = _record('Unknown currency: XYZ', event='UnknownCurrencyException')
+    assert not sampling.filter(record)
+    monkeypatch.setattr(logs.random, 'random', lambda: 0.05)
+    assert sampling.filter(record)
+    assert record.sample_rate == 0.1
+    # Other events are never sampled
+    monkeypatch.setattr(logs.random, 'random', lambda: 0.99)
+    assert sampling.filter(_record('Rates unavailable', event='FixerApiException'))
+
+
+def test_full_queue():
+    handler = DroppingQueueHandler(queue.Queue(1))
+    handler.handle(_record('first'))
+    handler.handle(_record('second'))
+    assert handler.dropped == 1
+    assert handler.queue.qsize() == 1
+
+
+def test_start_logging(test_app: Flask, monkeypatch: MonkeyPatch, capsys):
+    monkeypatch.setitem(test_app.config, 'LOG_SAMPLE_RATES', {})
+    start_logging(test_app)
+    try:
+        assert default_handler not in test_app.logger.handlers
+        test_app.logger.warning('Unknown currency: XYZ', extra={'event': 'UnknownCurrencyException'})
+        stop_logging(test_app)
+        line = capsys.readouterr().err.strip()
+        assert json.loads(line)['event'] == 'UnknownCurrencyException'
+    finally:
+        _reset_logger(test_app)
+
+
+def test_access_log(monkeypatch: MonkeyPatch, capsys):
+    monkeypatch.setattr(TestingConfig, 'LOG_FORMAT', 'json')
+    snapshot = RatesSnapshot.create(1, {'USD': 'United States Dollar'}, {'USD': 1.1})
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
+    app = create_app()
+    try:
+        app.test_client().get('/supported_currencies?access_key=secret')
+        app.test_client().get('/currency_converter?output_currency=XYZ')
+        stop_logging(app)
+        entries = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    finally:
+        _reset_logger(app)
+    access = [entry for entry in entries if entry['event'] == 'access']
+    assert [(entry['path'], entry['status']) for entry in access] == \
+        [('/supported_currencies', 200), ('/currency_converter', 400)]
+    assert access[0]['message'] == 'GET /supported_currencies?access_key=*** 200'
+    assert access[0]['method'] == 'GET' and access[0]['size'] > 0
+    assert all(entry['duration_ms'] >= 0 for entry in access)
@@ -0,0 +1,104 @@
+from decimal import ROUND_HALF_EVEN
+
+import pytest
+from werkzeug.datastructures import ImmutableMultiDict
+
+from api.config import BaseConfig
+from api.exceptions import InvalidAmountException, InvalidParameterException, UnknownSymbolException
+from api.parser import ConversionRequest, MatrixRequest, RequestParser
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+@pytest.fixture
+def parser() -> RequestParser:
+    return RequestParser(BaseConfig.CURRENCY_SYMBOLS)
+
+
+@pytest.mark.parametrize('args, result', [
+    ({}, ConversionRequest(1.0, 'CZK', ())),
+    ({'amount': '12.5', 'input_currency': 'gbp', 'output_currency': 'usd'}, ConversionRequest(12.5, 'GBP', ('USD',))),
+    ({'input_currency': '£', 'output_currency': '€,₿,¥'}, ConversionRequest(1.0, 'GBP', ('EUR', 'BTC', 'JPY'))),
+    ({'input_currency': '', 'output_currency': ''}, ConversionRequest(1.0, '', ())),
+    ({'output_currency': 'EUR,eur,€,RUB,EUR'}, ConversionRequest(1.0, 'CZK', ('EUR', 'RUB'))),
+    ({'rounding': 'Half_Even'}, ConversionRequest(1.0, 'CZK', (), ROUND_HALF_EVEN)),
+])
+def test_parse(parser: RequestParser, args: dict, result: ConversionRequest):
+    assert parser.parse(args) == result
+
+
+def test_parse_query_args(parser: RequestParser):
+    # The request's `MultiDict` -- the missing parameters get their defaults
+    args = ImmutableMultiDict([('input_currency', 'usd'), ('debug', '1')])
+    assert parser.parse(args) == ConversionRequest(1.0, 'USD', ())
+    assert parser.parse_debug(args)
+    assert not parser.parse_debug(ImmutableMultiDict())
+
+
+def test_parse_interned(parser: RequestParser):
+    first = parser.parse({'input_currency': ''.join(['u', 's', 'd'])})
+    second = parser.parse({'output_currency': ''.join(['U', 'S', 'D'])})
+    assert first.input_currency is second.output_currencies[0]
+
+
+@pytest.mark.parametrize('args', [
+    {'input_currency': '%'},
+    {'output_currency': 'USD,@'}
+])
+def test_parse_unknown_symbol(parser: RequestParser, args: dict):
+    with pytest.raises(UnknownSymbolException):
+        parser.parse(args)
+
+
+def test_parse_invalid_rounding(parser: RequestParser):
+    with pytest.raises(InvalidParameterException):
+        parser.parse({'rounding': 'bankers'})
+
+
+@pytest.mark.parametrize('amount', ['', 'one', '1.234ee', 'nan', 'inf', '-Infinity'])
+def test_parse_invalid_amount(parser: RequestParser, amount: str):
+    with pytest.raises(InvalidAmountException):
+        parser.parse({'amount': amount})
+
+
+@pytest.mark.parametrize('amounts', ['nan', '1,inf'])
+def test_parse_matrix_invalid_amount(parser: RequestParser, amounts: str):
+    with pytest.raises(InvalidAmountException):
+        parser.parse_matrix({'bases': 'USD', 'amounts': amounts})
+
+
+@pytest.mark.parametrize('since, result', [(None, 0), ('', 0), ('0', 0), ('42', 42)])
+def test_parse_since(parser: RequestParser, since: str, result: int):
+    assert parser.parse_since({'since': since} if since is not None else {}) == result
+
+
+@pytest.mark.parametrize('since', ['-1', 'one', '1.5'])
+def test_parse_since_invalid(parser: RequestParser, since: str):
+    with pytest.raises(InvalidParameterException):
+        parser.parse_since({'since': since})
+
+
+def test_tokens_bounded(parser: RequestParser):
+    for i in range(2 * RequestParser.MAX_TOKENS):
+        parser.parse({'input_currency': f'X{i}'})
+    assert len(parser._tokens) == RequestParser.MAX_TOKENS
+
+
+@pytest.mark.parametrize('args, result', [
+    ({'bases': 'usd,€', 'targets': 'CZK'}, MatrixRequest(('USD', 'EUR'), ('CZK',), (1.0,))),
+    ({'bases': 'USD,EUR'}, MatrixRequest(('USD', 'EUR'), ('USD', 'EUR'), (1.0,))),
+    ({'targets': 'USD', 'amounts': '10,1.5,10'}, MatrixRequest(('USD',), ('USD',), (10.0, 1.5))),
+])
+def test_parse_matrix(parser: RequestParser, args: dict, result: MatrixRequest):
+    assert parser.parse_matrix(args) == result
+
+
+@pytest.mark.parametrize('args', [
+    {},
+    {'bases': ','.join(f'C{i:02}' for i in range(51))},
+    {'bases': 'USD', 'amounts': ','.join(map(str, range(11)))},
+])
+def test_parse_matrix_invalid(parser: RequestParser, args: dict):
+    with pytest.raises(InvalidParameterException):
+        parser.parse_matrix(args)
@@ -0,0 +1,102 @@
+import marshal
+import pickle
+import pstats
+import tracemalloc
+from decimal import Decimal
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from flask.testing import FlaskClient
+
+from api import create_app
+from api.config import TestingConfig
+from api.currencies import CurrencyResource
+from api.snapshot import RatesSnapshot
+
+
+AUTHORIZATION = {'Authorization': 'Bearer secret'}
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+@pytest.fixture
+def profiling_client(monkeypatch: MonkeyPatch) -> FlaskClient:
+    monkeypatch.setattr(TestingConfig, 'PROFILING_TOKEN', 'secret')
+    monkeypatch.setattr(CurrencyResource, 'get_currency_rates', lambda _i, _o: {'USD': Decimal(1.1)})
+    snapshot = RatesSnapshot.create(1, {'USD': 'United States Dollar'}, {'USD': 1.1})
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
+    app = create_app()
+    yield app.test_client()
+    session = app.extensions.get('profiling_session')
+    if session is not None:
+        session.finish()
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+def test_disabled_without_token(test_client: FlaskClient):
+    response = test_client.post('/_profile/start?requests=1', headers=AUTHORIZATION)
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer wrong'}, {'Authorization': 'secret'}])
+def test_unauthorized(profiling_client: FlaskClient, headers: dict):
+    response = profiling_client.post('/_profile/start?requests=1', headers=headers)
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize('params', ['', 'requests=0', 'seconds=-1', 'seconds=100000'])
+def test_invalid_limits(profiling_client: FlaskClient, params: str):
+    response = profiling_client.post(f'/_profile/start?{params}', headers=AUTHORIZATION)
+    assert response.status_code == 400
+
+
+def test_profile_requests(profiling_client: FlaskClient):
+    response = profiling_client.post('/_profile/start?requests=2', headers=AUTHORIZATION)
+    assert response.status_code == 202
+    assert profiling_client.post('/_profile/start?requests=2', headers=AUTHORIZATION).status_code == 409
+    assert profiling_client.get('/_profile/cpu', headers=AUTHORIZATION).status_code == 409
+
+    for _ in range(2):
+        response = profiling_client.get('/currency_converter?input_currency=EUR&output_currency=USD')
+        assert response.status_code == 200
+
+    response = profiling_client.get('/_profile', headers=AUTHORIZATION)
+    assert response.json == {'finished': True, 'seconds': None, 'requests': 2, 'profiled_requests': 2}
+
+    response = profiling_client.get('/_profile/cpu', headers=AUTHORIZATION)
+    assert response.status_code == 200
+    stats = pstats.Stats()
+    stats.stats = marshal.loads(response.data)
+    assert any(function == 'convert' for _file, _line, function in stats.stats)
+
+    response = profiling_client.get('/_profile/allocations', headers=AUTHORIZATION)
+    assert isinstance(pickle.loads(response.data), tracemalloc.Snapshot)
+    response = profiling_client.get('/_profile/allocations?format=text&top=5', headers=AUTHORIZATION)
+    assert len(response.data.decode('utf-8').splitlines()) <= 5
+    assert not tracemalloc.is_tracing()
+
+
+def test_profile_seconds(profiling_client: FlaskClient, monkeypatch: MonkeyPatch):
+    response = profiling_client.post('/_profile/start?seconds=60', headers=AUTHORIZATION)
+    assert response.status_code == 202
+    profiling_client.get('/currency_converter?input_currency=EUR&output_currency=USD')
+    assert profiling_client.get('/_profile', headers=AUTHORIZATION).json['finished'] is False
+
+    session = profiling_client.application.extensions['profiling_session']
+    monkeypatch.setattr(session, 'deadline', 0)
+    response = profiling_client.get('/_profile', headers=AUTHORIZATION)
+    assert response.json['finished'] is True
+    assert response.json['profiled_requests'] == 1
+
+
+def test_profile_seconds_idle(profiling_client: FlaskClient):
+    response = profiling_client.post('/_profile/start?seconds=0.05', headers=AUTHORIZATION)
+    assert response.status_code == 202
+    # Finished by the timer -- no request polls the session meanwhile
+    session = profiling_client.application.extensions['profiling_session']
+    session._timer.join(5)
+    assert session.finished
+    assert not tracemalloc.is_tracing()
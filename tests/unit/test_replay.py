@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from benchmarks import replay
+from benchmarks.replay import TraceEntry
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+@pytest.mark.parametrize('path, result', [
+    ('/currency_converter?amount=240.16&input_currency=GBP&access_key=SECRET',
+     '/currency_converter?amount=100&input_currency=GBP'),
+    ('/currency_converter?amount=-0.05&output_currency=', '/currency_converter?amount=-0.01&output_currency='),
+    ('/currency_converter?amount=abc&input_currency=%E2%82%AC',
+     '/currency_converter?amount=invalid&input_currency=%E2%82%AC'),
+    ('/currency_matrix?bases=USD,EUR&amounts=1,25', '/currency_matrix?bases=USD%2CEUR&amounts=1%2C10'),
+    ('/supported_currencies?utm_source=x', '/supported_currencies'),
+    ('/favicon.ico', None),
+])
+def test_anonymize(path: str, result: str):
+    assert replay.anonymize(path) == result
+
+
+def test_record_and_load(tmp_path):
+    lines = [
+        '1.2.3.4 - - [01/Jul/2019:10:00:00 +0000] "GET /supported_currencies HTTP/1.1" 200 10',
+        '1.2.3.4 - - [01/Jul/2019:10:00:02 +0000] "POST /currency_converter HTTP/1.1" 405 10',
+        '1.2.3.4 - - [01/Jul/2019:10:00:03 +0000] "GET /currency_converter?input_currency=USD HTTP/1.1" 200 10',
+    ]
+    entries = replay.record(lines)
+    assert entries == [
+        TraceEntry(0, '/supported_currencies'),
+        TraceEntry(3, '/currency_converter?input_currency=USD')
+    ]
+    path = str(tmp_path / 'trace.gz')
+    replay.save_trace(entries, path)
+    assert replay.load_trace(path) == entries
+
+
+def test_replay_and_compare():
+    sent = []
+    entries = [TraceEntry(0, '/a'), TraceEntry(0, '/b'), TraceEntry(0, '/c')]
+    report = replay.replay(entries, lambda path: sent.append(path) or (200 if path != '/c' else 400), 0, 2)
+    assert sorted(sent) == ['/a', '/b', '/c']
+    assert report['requests'] == 3
+    assert report['statuses'] == {'200': 2, '400': 1}
+
+    worse = {**report, 'throughput_rps': report['throughput_rps'] / 2}
+    assert replay.compare(report, worse)['throughput_rps'] == pytest.approx(50)
+
+
+def test_replay_includes_queueing():
+    entries = [TraceEntry(0, '/a'), TraceEntry(0, '/b')]
+    # One thread and both requests due at once -- the second one waits for the first and that's a part of its latency
+    report = replay.replay(entries, lambda path: time.sleep(0.05) or 200, 1, 1)
+    assert report['latency_ms']['max'] >= 100
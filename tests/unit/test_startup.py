@@ -0,0 +1,45 @@
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from api import create_app, startup
+from api.config import TestingConfig
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+def test_no_eager_heavy_imports():
+    profile = startup.profile_startup()
+    assert profile.eagerly_imported == []
+    assert set(profile.create_app.keys()) == {
+        'load_config', 'set_logging', 'set_sentry', 'set_tracing', 'set_cache', 'set_limits', 'register_blueprints',
+        'start_refresher'
+    }
+
+
+def test_startup_budget():
+    # Regression check -- the budget is generous, it should catch only something like an accidental eager import
+    # of a heavy dependency or expensive work at the import time
+    assert startup.main(['--check', '--budget-ms', '3000']) == 0
+
+
+def test_parse_importtime():
+    stderr = '\n'.join([
+        'import time: self [us] | cumulative | imported package',
+        'import time:       100 |        100 |   _abc',
+        'import time:       200 |        300 | abc',
+        'import time:        50 |         50 | api',
+    ])
+    imports = startup._parse_importtime(stderr)
+    assert imports == [
+        startup.ImportTime('_abc', 1, 100, 100),
+        startup.ImportTime('abc', 0, 200, 300),
+        startup.ImportTime('api', 0, 50, 50),
+    ]
+    assert startup.StartupProfile(imports, {'load_config': 0.001}, []).total_ms == pytest.approx(1.35)
+
+
+def test_missing_api_key(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(TestingConfig, 'FIXER_API_KEY', None)
+    with pytest.raises(KeyError):
+        create_app()
@@ -0,0 +1,174 @@
+import json
+import sys
+import threading
+import types
+from decimal import Decimal
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Flask
+from flask.testing import FlaskClient
+
+from api import tracing
+from api.currencies import CurrencyResource
+from api.snapshot import RatesSnapshot
+from api.tracing import NOOP_SPAN, SentryExporter, Trace
+
+
+# ------------------------------------------------------ Mocks --------------------------------------------------------
+
+
+class MockedSentrySpan:
+    def __init__(self, op: str = None, name: str = None, start_timestamp: float = None, **kwargs):
+        self.op = op
+        self.name = name
+        self.start_timestamp = start_timestamp
+        self.end_timestamp = None
+        self.data = {}
+        self.children = []
+
+    def start_child(self, op: str, start_timestamp: float):
+        child = MockedSentrySpan(op=op, start_timestamp=start_timestamp)
+        self.children.append(child)
+        return child
+
+    def set_data(self, key: str, value):
+        self.data[key] = value
+
+    def finish(self, end_timestamp: float):
+        self.end_timestamp = end_timestamp
+
+
+@pytest.fixture
+def mock_currency_resource(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(CurrencyResource, 'get_currency_rates', lambda _i, _o: {'USD': Decimal(1.1)})
+    snapshot = RatesSnapshot.create(1, {'USD': 'United States Dollar'}, {'USD': 1.1})
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
+
+
+@pytest.fixture
+def trace_file(test_app: Flask, monkeypatch: MonkeyPatch, tmp_path) -> str:
+    path = str(tmp_path / 'traces.jsonl')
+    monkeypatch.setitem(test_app.config, 'TRACING_SAMPLE_RATE', 1.0)
+    monkeypatch.setitem(test_app.extensions, 'tracing_exporter', tracing.FileExporter(path))
+    return path
+
+
+def _flush(app: Flask):
+    app.extensions['tracing_exporter'].flush()
+
+
+# ----------------------------------------------------- Tests ---------------------------------------------------------
+
+
+def test_file_export(test_client: FlaskClient, mock_currency_resource, trace_file: str):
+    response = test_client.get('/currency_converter?input_currency=EUR&output_currency=USD,USD')
+    assert response.status_code == 200
+    # Written by the background thread
+    _flush(test_client.application)
+
+    with open(trace_file) as f:
+        traces = [json.loads(line) for line in f]
+    assert len(traces) == 1
+    assert traces[0]['name'] == 'currency_converter.convert'
+    spans = {span['name']: span for span in traces[0]['spans']}
+    assert set(spans) == {'admit', 'parse', 'convert', 'serialize', 'compress'}
+    assert spans['parse']['attributes'] == {'output_count': 1}
+    assert spans['convert']['attributes'] == {'output_count': 1}
+    assert all(span['duration_ms'] >= 0 for span in spans.values())
+
+
+def test_not_sampled(test_client: FlaskClient, mock_currency_resource, trace_file: str, monkeypatch: MonkeyPatch):
+    monkeypatch.setitem(test_client.application.config, 'TRACING_SAMPLE_RATE', 0.0)
+    test_client.get('/currency_converter?input_currency=EUR&output_currency=USD')
+    _flush(test_client.application)
+    with pytest.raises(FileNotFoundError):
+        open(trace_file)
+    assert tracing.span('anything') is NOOP_SPAN
+
+
+def test_debug_not_exported(test_client: FlaskClient, mock_currency_resource, trace_file: str,
+                            monkeypatch: MonkeyPatch):
+    monkeypatch.setitem(test_client.application.config, 'TRACING_SAMPLE_RATE', 0.0)
+    response = test_client.get('/currency_converter?input_currency=EUR&output_currency=USD&debug=1')
+    assert response.get_json()['debug']['stages']
+    # Recorded only for the response, not sampled
+    _flush(test_client.application)
+    with pytest.raises(FileNotFoundError):
+        open(trace_file)
+
+
+def test_file_export_full_queue(test_app: Flask, monkeypatch: MonkeyPatch, tmp_path, caplog):
+    path = str(tmp_path / 'traces.jsonl')
+    exporter = tracing.FileExporter(path)
+    monkeypatch.setattr(exporter, 'MAX_QUEUED', 1)
+    taken, writing = threading.Event(), threading.Event()
+
+    def stuck_format(self, record) -> str:
+        taken.set()
+        writing.wait()
+        return json.dumps(record.msg)
+
+    monkeypatch.setattr(tracing.TraceFormatter, 'format', stuck_format)
+    trace = Trace('test')
+    trace.finish()
+    try:
+        exporter.export(trace)
+        taken.wait(5)
+        # The writer is stuck on the first trace and the second fills the queue -- the request doesn't wait for it
+        exporter.export(trace)
+        exporter.export(trace)
+        assert exporter.dropped == 1
+    finally:
+        writing.set()
+    exporter.flush()
+    with open(path) as f:
+        assert [json.loads(line)['dropped'] for line in f] == [0, 0]
+    assert '1 traces were dropped' in caplog.text
+
+
+def test_nested_spans(test_app: Flask):
+    trace = Trace('test')
+    with trace.span('outer', a=1):
+        with trace.span('inner') as inner:
+            inner.set('b', 2)
+    with pytest.raises(ValueError):
+        with trace.span('failing'):
+            raise ValueError
+    trace.finish()
+
+    outer, inner, failing = trace.to_dict()['spans']
+    assert outer['parent'] is None and outer['attributes'] == {'a': 1}
+    assert inner['parent'] == outer['id'] and inner['attributes'] == {'b': 2}
+    assert failing['parent'] is None and failing['attributes'] == {'error': 'ValueError'}
+
+
+def test_sentry_export(monkeypatch: MonkeyPatch):
+    transactions = []
+
+    def start_transaction(**kwargs):
+        transactions.append(MockedSentrySpan(**kwargs))
+        return transactions[-1]
+
+    monkeypatch.setitem(sys.modules, 'sentry_sdk', types.SimpleNamespace(start_transaction=start_transaction))
+
+    trace = Trace('test')
+    with trace.span('outer'):
+        with trace.span('inner', cache='hit'):
+            pass
+    trace.finish()
+    SentryExporter().export(trace)
+
+    transaction, = transactions
+    assert (transaction.name, transaction.op) == ('test', 'http.server')
+    assert transaction.end_timestamp >= transaction.start_timestamp
+    outer, = transaction.children
+    inner, = outer.children
+    assert (outer.op, inner.op) == ('outer', 'inner')
+    assert inner.data == {'cache': 'hit'}
+
+
+def test_invalid_exporter(test_app: Flask, monkeypatch: MonkeyPatch):
+    monkeypatch.setitem(test_app.config, 'TRACING_EXPORTER', 'nonsense')
+    with pytest.raises(ValueError):
+        tracing.init_tracing(test_app)
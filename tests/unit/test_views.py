@@ -1,14 +1,19 @@
 import logging
-from typing import Type, List, Dict
+from decimal import ROUND_FLOOR, ROUND_HALF_UP
+from typing import Type, Sequence, Dict
 
 import pytest
 from _pytest.monkeypatch import MonkeyPatch
 from flask.testing import FlaskClient
 
+from api.config import BaseConfig
 from api.converter import CurrencyConverter
 from api.currencies import CurrencyResource
 from api.exceptions import FixerApiException, CustomException, UnknownSymbolException, UnknownCurrencyException, \
     InvalidAmountException
+from api.snapshot import RatesSnapshot
+from api.parser import RequestParser
+from api.views import payloads, rejections
 
 
 # ------------------------------------------------------ Mocks --------------------------------------------------------
@@ -18,27 +23,38 @@ class MockedCurrencyConverter:
     amount = None
     input_currency = None
     output_currency = None
+    rounding = None
 
     @classmethod
-    def convert(cls, amount: float, input_currency: str, output_currency: List[str]) -> Dict[str, float]:
+    def convert(
+            cls, amount: float, input_currency: str, output_currency: Sequence[str], rounding: str = ROUND_HALF_UP
+    ) -> Dict[str, float]:
         cls.amount = amount
         cls.input_currency = input_currency
         cls.output_currency = output_currency
+        cls.rounding = rounding
         return {
             'OUTPUT_CURRENCY': 123.321
         }
 
 
-@pytest.fixture
+@pytest.fixture(autouse=True)
 def mock_currency_resource(monkeypatch: MonkeyPatch):
-    def mocked_get():
-        return {
+    snapshot = RatesSnapshot.create(
+        version=1,
+        supported={
             'USD': 'United States Dollar',
             'CZK': 'Czech Crown',
             'GBP': 'Great Britain Pound'
-        }
-
-    monkeypatch.setattr(CurrencyResource, 'get_supported_currencies', mocked_get)
+        },
+        rates={'USD': 1.138, 'CZK': 25.4183, 'GBP': 0.896032}
+    )
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
+    payloads.clear()
+    rejections.clear()
+    yield snapshot
+    payloads.clear()
+    rejections.clear()
 
 
 @pytest.fixture
@@ -57,13 +73,13 @@ def mock_raising_exception(monkeypatch: MonkeyPatch, exception_type: Type[Custom
         mock_exception(monkeypatch, exception_type)
         raise exception_type
 
-    monkeypatch.setattr(CurrencyResource, 'get_supported_currencies', mocked_get)
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', mocked_get)
 
 
 # ----------------------------------------------------- Tests ---------------------------------------------------------
 
 
-def test_supported_currencies(test_client: FlaskClient, mock_currency_resource):
+def test_supported_currencies(test_client: FlaskClient):
     response = test_client.get('/supported_currencies')
     assert response.status_code == 200
     assert response.json == {
@@ -77,37 +93,37 @@ def test_supported_currencies(test_client: FlaskClient, mock_currency_resource):
     ('100', 'AUD', 'RUB', {
         'amount': 100.00,
         'input_currency': 'AUD',
-        'output_currency': ['RUB']
+        'output_currency': ('RUB',)
     }),
     ('-10', 'CZK', 'CZK,CZK,CZK,CZK,CZK', {
         'amount': -10.00,
         'input_currency': 'CZK',
-        'output_currency': ['CZK', 'CZK', 'CZK', 'CZK', 'CZK']
+        'output_currency': ('CZK',)
     }),
     ('1', 'PHP', 'JavaScript,£,Python,₹', {
         'amount': 1.00,
         'input_currency': 'PHP',
-        'output_currency': ['JAVASCRIPT', 'GBP', 'PYTHON', 'INR']
+        'output_currency': ('JAVASCRIPT', 'GBP', 'PYTHON', 'INR')
     }),
     ('', '', '', {
         'amount': 1.00,
         'input_currency': 'CZK',
-        'output_currency': []
+        'output_currency': ()
     }),
     ('9999999999999999999999999999999999999999999999999999999999999999999', '123', '!@$%^*(),_}{":?><', {
         'amount': 9999999999999999999999999999999999999999999999999999999999999999999.00,
         'input_currency': '123',
-        'output_currency': ['!@$%^*()', '_}{":?><']
+        'output_currency': ('!@$%^*()', '_}{":?><')
     }),
     ('0.0000000000000001e16', '&&&&&&&&&&&', '///////\\\\\\\\??????????', {
         'amount': 1.00,
         'input_currency': '',
-        'output_currency': ['///////\\\\\\\\??????????']
+        'output_currency': ('///////\\\\\\\\??????????',)
     }),
     ('', 'czk', 'rub,eur,php,jpy', {
         'amount': 1.00,
         'input_currency': 'CZK',
-        'output_currency': ['RUB', 'EUR', 'PHP', 'JPY']
+        'output_currency': ('RUB', 'EUR', 'PHP', 'JPY')
     })
 ])
 def test_convert(
@@ -146,7 +162,181 @@ def test_convert_symbols(test_client: FlaskClient, mock_currency_converter):
     response = test_client.get('/currency_converter?input_currency=£&output_currency=₺,₽,₦,₿')
     assert response.status_code == 200
     assert MockedCurrencyConverter.input_currency == 'GBP'
-    assert MockedCurrencyConverter.output_currency == ['TRY', 'RUB', 'NGN', 'BTC']
+    assert MockedCurrencyConverter.output_currency == ('TRY', 'RUB', 'NGN', 'BTC')
+
+
+def test_convert_rounding(test_client: FlaskClient, mock_currency_converter):
+    response = test_client.get('/currency_converter?output_currency=USD&rounding=FLOOR')
+    assert response.status_code == 200
+    assert MockedCurrencyConverter.rounding == ROUND_FLOOR
+
+    response = test_client.get('/currency_converter?output_currency=USD&rounding=bankers')
+    assert response.status_code == 400
+    assert 'Invalid parameter `rounding`' in response.data.decode('utf-8')
+
+
+def test_convert_debug(test_client: FlaskClient):
+    response = test_client.get('/currency_converter?input_currency=USD&output_currency=CZK&debug=1')
+    assert response.status_code == 200
+    debug = response.get_json()['debug']
+    assert debug['snapshot']['version'] == 1
+    assert debug['eur_rates'] == {'USD': '1.138', 'CZK': '25.4183'}
+    stages = {stage['name'] for stage in debug['stages']}
+    assert {'admit', 'parse', 'convert'} <= stages
+    assert all(stage['duration_ms'] >= 0 for stage in debug['stages'])
+
+    # Not even the precompressed responses are served to the debug requests
+    response = test_client.get('/currency_converter?input_currency=USD&debug=1')
+    assert 'debug' in response.get_json()
+    response = test_client.get('/currency_converter?input_currency=USD&output_currency=CZK')
+    assert 'debug' not in response.get_json()
+
+
+def test_unknown_currency_fast_fail(test_client: FlaskClient, monkeypatch: MonkeyPatch, mock_currency_resource):
+    monkeypatch.setattr(CurrencyResource, 'snapshot', mock_currency_resource)
+
+    def unexpected(*args):
+        raise AssertionError('The invalid request went past the validation')
+
+    monkeypatch.setattr(CurrencyResource, 'refresh', unexpected)
+    monkeypatch.setattr(CurrencyConverter, 'convert', unexpected)
+    for _ in range(3):
+        response = test_client.get('/currency_converter?input_currency=USD&output_currency=XYZ')
+        assert response.status_code == 400
+        assert response.data.decode('utf-8').startswith('<h1>Bad request</h1>Unknown currency XYZ.')
+    # Kept only once for the repeated input
+    assert len(rejections) == 1
+    response = test_client.get('/currency_matrix?bases=USD&targets=XYZ')
+    assert response.status_code == 400
+
+
+def test_negative_cache(test_client: FlaskClient, monkeypatch: MonkeyPatch, mock_currency_resource, caplog):
+    monkeypatch.setattr(CurrencyResource, 'snapshot', mock_currency_resource)
+    caplog.set_level(logging.WARNING)
+    path = '/currency_converter?input_currency=USD&output_currency=XYZ'
+    assert test_client.get(path).status_code == 400
+    warnings = len(caplog.records)
+
+    def unexpected(*args):
+        raise AssertionError('The rejected request was parsed again')
+
+    monkeypatch.setattr(RequestParser, 'parse', unexpected)
+    response = test_client.get(path, headers={'Accept': 'application/json'})
+    assert response.status_code == 400
+    assert response.get_json()['error']['message'].startswith('Unknown currency XYZ.')
+    # Neither logged again
+    assert len(caplog.records) == warnings
+
+    # The currency may be supported by the next snapshot
+    CurrencyResource._publish(mock_currency_resource._replace(version=2))
+    assert len(rejections) == 0
+
+
+def test_negative_cache_long_query(test_client: FlaskClient, mock_currency_resource):
+    response = test_client.get(f'/currency_converter?amount={"x" * 2000}')
+    assert response.status_code == 400
+    assert len(rejections) == 0
+
+
+def test_error_content_negotiation(test_client: FlaskClient):
+    response = test_client.get('/currency_converter?amount=abc', headers={'Accept': 'application/json'})
+    assert response.status_code == 400
+    assert response.mimetype == 'application/json'
+    assert response.get_json() == {
+        'error': {'status': 400, 'message': 'Invalid parameter `amount`. abc is not a number'}
+    }
+    assert 'Accept' in response.vary
+
+    response = test_client.get('/currency_converter?amount=<b>', headers={'Accept': 'text/html,*/*'})
+    assert response.mimetype == 'text/html'
+    assert response.data.decode('utf-8') == '<h1>Bad request</h1>Invalid parameter `amount`. &lt;b&gt; is not a number'
+
+
+@pytest.mark.parametrize('path', [
+    '/currency_converter?amount=nan',
+    '/currency_converter?amount=inf',
+    '/currency_matrix?bases=USD&amounts=1,nan',
+    '/currency_matrix?bases=USD&amounts=inf'
+])
+def test_non_finite_amount(test_client: FlaskClient, path: str):
+    response = test_client.get(path)
+    assert response.status_code == 400
+    assert 'Invalid parameter `amount`' in response.data.decode('utf-8')
+
+
+@pytest.mark.parametrize('path', [
+    '/currency_converter?input_currency=EUR&output_currency=BTC&amount=1e18',
+    '/currency_converter?input_currency=EUR&amount=1e18',
+    '/currency_matrix?bases=EUR&targets=BTC&amounts=1e18',
+    '/currency_matrix?bases=USD,EUR&targets=EUR,BTC&amounts=1,1e18'
+])
+def test_huge_amount(test_client: FlaskClient, monkeypatch: MonkeyPatch, path: str):
+    # Far more digits (with the 8 decimals of BTC) than the default decimal context holds
+    snapshot = RatesSnapshot.create(
+        version=1,
+        supported={'EUR': 'Euro', 'USD': 'United States Dollar', 'BTC': 'Bitcoin'},
+        rates={'EUR': 1, 'USD': 1.138, 'BTC': 683.464018},
+        minor_units=BaseConfig.CURRENCY_MINOR_UNITS
+    )
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: snapshot)
+    payloads.clear()
+    response = test_client.get(path)
+    assert response.status_code == 200
+    if 'output_currency=BTC' in path:
+        assert response.get_json()['output'] == {'BTC': 6.83464018e20}
+
+    response = test_client.get(path.replace('1e18', '1e307'))
+    assert response.status_code == 400
+    assert 'Invalid parameter `amount`. 1e+307 is too large to convert' in response.data.decode('utf-8')
+
+
+def test_rates_changes(test_client: FlaskClient, monkeypatch: MonkeyPatch):
+    supported = {'USD': 'United States Dollar', 'CZK': 'Czech Crown', 'GBP': 'Great Britain Pound'}
+    first = RatesSnapshot.create(1, supported, {'USD': 1.138, 'CZK': 25.4183, 'GBP': 0.896032}, timestamp=100)
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: first)
+    response = test_client.get('/rates_changes')
+    assert response.status_code == 200
+    assert response.get_json() == {
+        'since': 0,
+        'as_of': 100,
+        'full': True,
+        'rates': {'USD': '1.138', 'CZK': '25.4183', 'GBP': '0.896032'},
+        'removed': [],
+        'supported': supported
+    }
+
+    changed = RatesSnapshot.create(2, supported, {'USD': 1.2, 'CZK': 25.4183}, timestamp=200, previous=first)
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: changed)
+    response = test_client.get('/rates_changes?since=100')
+    assert response.get_json() == {
+        'since': 100,
+        'as_of': 200,
+        'full': False,
+        'rates': {'USD': '1.2'},
+        'removed': ['GBP']
+    }
+    body = test_client.get('/rates_changes?since=150').get_json()
+    assert (body['full'], body['rates'], body['removed']) == (False, {'USD': '1.2'}, ['GBP'])
+
+
+def test_rates_changes_other_process(test_client: FlaskClient, monkeypatch: MonkeyPatch):
+    # E.g. another worker (without the shared cache) -- the same data are as of the same point in time there, but
+    # only what happened since it started is known
+    supported = {'USD': 'United States Dollar', 'CZK': 'Czech Crown'}
+    started = RatesSnapshot.create(1, supported, {'USD': 1.138, 'CZK': 25.4183}, timestamp=200, created=0.0)
+    changed = RatesSnapshot.create(2, supported, {'USD': 1.2, 'CZK': 25.4183}, timestamp=300, previous=started)
+    monkeypatch.setattr(CurrencyResource, 'get_snapshot', lambda: changed)
+    body = test_client.get('/rates_changes?since=200').get_json()
+    assert (body['as_of'], body['full'], body['rates']) == (300, False, {'USD': '1.2'})
+
+    # The client's data are older than the history or newer than the data of the process -- a full resync
+    for since in (100, 400):
+        response = test_client.get(f'/rates_changes?since={since}')
+        assert response.status_code == 200
+        body = response.get_json()
+        assert (body['since'], body['as_of'], body['full']) == (since, 300, True)
+        assert (body['rates'], body['removed']) == ({'USD': '1.2', 'CZK': '25.4183'}, [])
+        assert body['supported'] == supported
 
 
 def test_fixer_api_error(test_client: FlaskClient, monkeypatch: MonkeyPatch, caplog):
@@ -201,3 +391,26 @@ def test_amount_error(test_client: FlaskClient, monkeypatch: MonkeyPatch, caplog
         ('flask.app', logging.WARNING, 'logger_msg')
     ]
     assert response.data.decode('utf-8') == '<h1>Bad request</h1>' + 'display_msg'
+
+
+def test_convert_matrix(test_client: FlaskClient, monkeypatch: MonkeyPatch):
+    def mocked_convert_matrix(amounts, bases, targets, rounding):
+        return [{base: {target: amount for target in targets} for base in bases} for amount in amounts]
+
+    monkeypatch.setattr(CurrencyConverter, 'convert_matrix', mocked_convert_matrix)
+    response = test_client.get('/currency_matrix?bases=USD,£&targets=CZK&amounts=1,2.5')
+    assert response.status_code == 200
+    assert response.json == {
+        'bases': ['USD', 'GBP'],
+        'targets': ['CZK'],
+        'output': [
+            {'amount': 1.0, 'matrix': {'USD': {'CZK': 1.0}, 'GBP': {'CZK': 1.0}}},
+            {'amount': 2.5, 'matrix': {'USD': {'CZK': 2.5}, 'GBP': {'CZK': 2.5}}}
+        ]
+    }
+
+
+def test_convert_matrix_invalid(test_client: FlaskClient, caplog):
+    response = test_client.get('/currency_matrix')
+    assert response.status_code == 400
+    assert response.data.decode('utf-8').startswith('<h1>Bad request</h1>Invalid parameter `bases`.')